@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# -*- coding:utf8 -*-
+
+"""
+Name: aws_clients.py
+
+Shared boto3 session and client factory for cfn_launch.py and the config-ansible-website lambdas.
+config-ansible-website/aws_clients.py is a copy packaged with the lambdas, refreshed by
+sls_start.sh and checked by test_lambda_package.py.
+
+Functions:
+1. One boto3 session per profile and one client per (service, region, profile), created once
+   per process and reused, so repeated client creation and TLS handshakes drop out of hot paths.
+2. Clients use a larger connection pool for the thread pools in cfn_launch.py, adaptive retry
+   mode and explicit connect/read timeouts instead of the botocore defaults.
+3. batch=True clients do not retry in botocore, for calls wrapped by cfn_throttle.call_with_backoff,
+   so throttling is retried at one layer only.
+
+Usage:
+    from aws_clients import get_client
+    cfn_conn = get_client('cloudformation', region='ap-southeast-2')
+"""
+
+import threading
+
+import boto3
+from botocore.config import Config
+
+
+CLIENT_CONFIG = Config(
+    max_pool_connections=50,
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    connect_timeout=5,
+    read_timeout=60
+)
+# calls going through call_with_backoff: one attempt, the token bucket retries throttling
+BATCH_CLIENT_CONFIG = CLIENT_CONFIG.merge(Config(retries={'mode': 'standard', 'total_max_attempts': 1}))
+
+_lock = threading.Lock()
+_sessions = {}
+_clients = {}
+
+
+def get_session(profile=None):
+    with _lock:
+        if profile not in _sessions:
+            _sessions[profile] = boto3.session.Session(profile_name=profile)
+        return _sessions[profile]
+
+
+def get_client(service, region=None, profile=None, batch=False):
+    """Return the cached client for (service, region, profile, batch). Clients are thread safe."""
+    key = (service, region, profile, batch)
+    client = _clients.get(key)
+    if client is None:
+        session = get_session(profile)
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = session.client(service, region_name=region,
+                    config=BATCH_CLIENT_CONFIG if batch else CLIENT_CONFIG)
+    return client
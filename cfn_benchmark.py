@@ -0,0 +1,191 @@
+#!/usr/bin/python
+# -*- coding:utf8 -*-
+
+"""
+Name: cfn_benchmark.py
+
+Stack lifecycle benchmark of CfnClient against a local CloudFormation stand-in (moto server mode).
+
+Dependencies:
+pip install "moto[server]"
+
+Functions:
+1. Start a moto server on a free local port (or use --endpoint-url) and point every boto3 client at it
+   through AWS_ENDPOINT_URL, with dummy credentials.
+2. For each stack count (default 1, 10, 100, 500) run create, describe (from the API), describe again
+   (served by the stack store), update through change sets and delete on a fresh stack store.
+3. Report wall time, AWS API calls (counted by cfn_metrics.recorder) and tracemalloc peak memory
+   above the memory in use before each operation. Results are printed and written to a JSON file,
+   so that diffing two result files shows regressions in query_cfn_status, the stack store or
+   the create/delete paths.
+
+Usage:
+    python cfn_benchmark.py --counts 1,10,100 --output benchmark-results.json
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import tempfile
+import platform
+import datetime
+import subprocess
+import tracemalloc
+from collections import Counter
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_COUNTS = "1,10,100,500"
+# rate limits are lifted so that the benchmark measures the client, not the token buckets
+BENCH_RATE_LIMIT = 1000
+MOTO_START_TIMEOUT = 30
+REGION = "ap-southeast-2"
+
+TEMPLATE = {
+    "AWSTemplateFormatVersion": "2010-09-09",
+    "Parameters": {"SSHLocation": {"Type": "String"}},
+    "Resources": {
+        "Queue": {"Type": "AWS::SQS::Queue", "Properties": {"Tags": [{"Key": "SSHLocation", "Value": {"Ref": "SSHLocation"}}]}}
+    },
+    "Outputs": {"QueueUrl": {"Value": {"Ref": "Queue"}}}
+}
+UPDATED_TEMPLATE = dict(TEMPLATE, Resources=dict(TEMPLATE["Resources"], Topic={"Type": "AWS::SNS::Topic"}))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_moto_server():
+    """Start moto in server mode in a child process, so its memory stays out of tracemalloc."""
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, '-m', 'moto.server', '-p', str(port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + MOTO_START_TIMEOUT
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc, "http://127.0.0.1:{0}".format(port)
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("moto server did not start on port {0}".format(port))
+
+
+class LifecycleBenchmark(object):
+    def __init__(self, work_dir):
+        # cfn_launch creates its clients from the environment, import it once the endpoint is set
+        import cfn_launch
+        from cfn_metrics import recorder
+        from cfn_throttle import TokenBucket
+        self.cfn_launch = cfn_launch
+        self.recorder = recorder
+        self.TokenBucket = TokenBucket
+        self.work_dir = work_dir
+        self.results = []
+
+    def measure(self, count, operation, func):
+        """Run func() once and record wall time, API calls and peak traced memory above the baseline."""
+        calls_before = self.recorder.call_counts('api')
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        value = func()
+        wall = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        calls = Counter(self.recorder.call_counts('api')) - Counter(calls_before)
+        result = {
+            "stacks": count,
+            "operation": operation,
+            "wall_seconds": round(wall, 4),
+            "api_calls": sum(calls.values()),
+            "api_calls_by_name": dict(sorted(calls.items())),
+            "peak_memory_delta_bytes": peak
+        }
+        self.results.append(result)
+        print("{0:>6} {1:<16} {2:>10.3f} {3:>10} {4:>12}".format(count, operation, wall, result["api_calls"], peak))
+        return value
+
+    def run(self, count):
+        L = self.cfn_launch
+        cfn_dir = tempfile.mkdtemp(prefix="cfn-bench-{0}-".format(count), dir=self.work_dir)
+        template_file = os.path.join(cfn_dir, 'bench.json')
+        updated_file = os.path.join(cfn_dir, 'bench-updated.json')
+        with open(template_file, 'w') as fh:
+            json.dump(TEMPLATE, fh)
+        with open(updated_file, 'w') as fh:
+            json.dump(UPDATED_TEMPLATE, fh)
+
+        client = L.CfnClient(cfn_dir, region=REGION, local_ip='203.0.113.10', confirm=L.always_confirm)
+        client.create_limiter = self.TokenBucket(BENCH_RATE_LIMIT)
+        stack_name = "bench{0}-{1}".format(count, datetime.datetime.now().strftime("%Y%m%d%H%M%S"))
+
+        if count == 1:
+            stack_ids = [self.measure(count, "create", lambda: client.create_stack(template_file, stack_name)).stack_id]
+        else:
+            result = self.measure(count, "create", lambda: client.create_stacks(template_file, stack_name, count))
+            stack_ids = [s.stack_id for s in result.created]
+        self.measure(count, "describe", lambda: client.describe_stacks(stack_ids))
+        self.measure(count, "describe-cached", lambda: client.describe_stacks(stack_ids))
+
+        def update_all():
+            with ThreadPoolExecutor(max_workers=L.BATCH_MAX_WORKERS) as pool:
+                return list(pool.map(lambda stack_id: client.update_stack(updated_file, stack_id), stack_ids))
+        self.measure(count, "update", update_all)
+        self.measure(count, "delete", lambda: client.delete_stacks(stack_ids))
+        shutil.rmtree(cfn_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description="Benchmark CfnClient create, describe, update and delete against moto server")
+    parser.add_argument('--counts', dest='counts',
+        help='Comma separated stack counts. Default: {0}'.format(DEFAULT_COUNTS),
+        default=DEFAULT_COUNTS, action='store')
+    parser.add_argument('--endpoint-url', dest='endpoint_url',
+        help='Use a running CloudFormation stand-in instead of starting moto server.',
+        default='', action='store')
+    parser.add_argument('-o', '--output', dest='output',
+        help='JSON result file. Default: benchmark-results.json',
+        default='benchmark-results.json', action='store')
+    args = parser.parse_args()
+
+    proc = None
+    endpoint_url = args.endpoint_url
+    if not endpoint_url:
+        proc, endpoint_url = start_moto_server()
+    os.environ['AWS_ENDPOINT_URL'] = endpoint_url
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    os.environ['AWS_DEFAULT_REGION'] = REGION
+
+    # cfn_launch writes cfn_template/cfn-parameters.json and its log relative to the working dir
+    work_dir = tempfile.mkdtemp(prefix="cfn-bench-")
+    os.makedirs(os.path.join(work_dir, 'cfn_template'))
+    output = os.path.abspath(args.output)
+    os.chdir(work_dir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    try:
+        tracemalloc.start()
+        bench = LifecycleBenchmark(work_dir)
+        print("{0:>6} {1:<16} {2:>10} {3:>10} {4:>12}".format("Stacks", "Operation", "Wall(s)", "API calls", "Peak delta"))
+        for count in [int(c) for c in args.counts.split(',') if c.strip()]:
+            bench.run(count)
+        with open(output, 'w') as fh:
+            json.dump({
+                "date": datetime.datetime.now().isoformat(),
+                "python": platform.python_version(),
+                "endpoint_url": endpoint_url,
+                "results": bench.results
+            }, fh, indent=2)
+        print("Results written to {0}".format(output))
+    finally:
+        if proc is not None:
+            proc.terminate()
+        shutil.rmtree(work_dir, ignore_errors=True)
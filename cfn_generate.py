@@ -34,16 +34,22 @@ https://github.com/cloudtools/troposphere/blob/master/troposphere/cloudformation
 """
 import re
 import os
-import json
 import yaml
 import sys
 import signal
-import logging
-import logging.handlers
 import datetime
+import time
+import copy
+import json
+import hashlib
+import shutil
+import tempfile
+import multiprocessing
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 from warnings import filterwarnings
 
+import troposphere
 from troposphere import Base64, Select, FindInMap, GetAtt, GetAZs, Join, Sub, Output, If, And, Not, Or, Equals, Condition
 from troposphere import Parameter, Ref, Tags, Template
 from troposphere.cloudformation import Init, InitFile, InitFiles, Metadata, InitConfig, Authentication, AuthenticationBlock
@@ -52,19 +58,15 @@ from troposphere.cloudfront import Origin, DefaultCacheBehavior
 from troposphere.ec2 import PortRange
 from troposphere.ec2 import SecurityGroupIngress
 from troposphere.ec2 import SecurityGroup
-from troposphere.ec2 import Instance, NetworkInterfaceProperty, PrivateIpAddressSpecification
+from troposphere.ec2 import Instance, NetworkInterfaceProperty, PrivateIpAddressSpecification, LaunchTemplate
+from troposphere.autoscaling import AutoScalingGroup
 from troposphere.policies import CreationPolicy, ResourceSignal
 
-from cfn_launch import CfnClient
+from cfn_launch import CfnClient, CfnError, interactive_confirm, run_create, print_table, log_dir
+from log_setup import set_up_logging
+from cfn_templates import stream_template, MATRIX_MANIFEST
 
 
-LOG_LEVELS = { 'debug':logging.DEBUG,
-            'info':logging.INFO,
-            'warning':logging.WARNING,
-            'error':logging.ERROR,
-            'critical':logging.CRITICAL
-            }
-
 def exception_hook(exc_type, exc_value, exc_traceback):
     logger.error(
                 "Uncaught exception",
@@ -76,24 +78,38 @@ sys.excepthook = exception_hook
 def log():
     def decorator(func):
         def wrapper(*args, **kw):
-            logger.info("Running {0}()...".format(func.__name__))
+            logger.info("Running %s()...", func.__name__)
             a=func(*args, **kw) 
             return a
         return wrapper
     return decorator
 
-def set_up_logging(log_level):
-    """Set up logger."""
-    logger = logging.getLogger('GenerateAnsibleLogger')
-    logger.setLevel(LOG_LEVELS[log_level])
-    log_file=os.path.join(os.getcwd(), 'logs', 'cfn_generate.log')
-    formatter = logging.Formatter('[%(asctime)s  %(levelname)s] %(message)s')
-    handler = logging.handlers.TimedRotatingFileHandler(log_file, when='D', backupCount=10)
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    return logger
+logger = set_up_logging('GenerateAnsibleLogger', os.path.join(log_dir(), 'cfn_generate.log'), 'info')
+
+# --matrix: server counts generated for every usage set. MATRIX_MANIFEST is written next to the templates
+MATRIX_COUNTS = "1,3,5,10"
+
+# --fleet: slaves as one Instance resource each, or as one auto scaling group of SLAVE_COUNT_PARAMETER servers
+FLEET_TYPES = ("instances", "asg")
+SLAVE_COUNT_PARAMETER = "SlaveCount"
+
+# input fingerprint stored next to each template, generation is skipped while it matches
+FINGERPRINT_SUFFIX = ".fingerprint"
+# init files written by gen_server_info, covered by the fingerprint through the count and usage
+GENERATED_INIT_FILES = ("hosts.txt", "ssh_config.txt")
+# DEFAULT_CONFIG sections read by CfnGenerator, the Ansible ones only for usage ansible
+CONFIG_SECTIONS = ("Version", "Mapping", "Description", "Parameter", "Metadata", "SecurityGroup", "SecurityGroupIngress", "Instance")
+ANSIBLE_CONFIG_SECTIONS = ("AnsibleParameter", "AnsibleMetadata")
+
+# ref_<Section>__<name> tokens in config values, resolved by CfnGenerator.resolve_refs
+REF_TOKEN = re.compile(r'ref_(?P<section>[A-Za-z0-9]+)__(?P<name>\w+)')
 
-logger = set_up_logging('info')
+
+class InvalidReferenceError(ValueError):
+    """ref_ tokens that do not resolve. errors: [(path, token, reason)]"""
+    def __init__(self, errors):
+        self.errors = errors
+        ValueError.__init__(self, "Invalid references: " + "; ".join("{0}: {1} ({2})".format(*e) for e in errors))
 
 
 DEFAULT_CONFIG = {
@@ -387,6 +403,21 @@ aws s3 cp s3://ansible-test-kaiyuan/$rfb_pkg /opt
 done
 #rpm -qa | grep boost | tr -s '\n' ' '| xargs rpm -e
 tar xvf /opt/boost_rpms.tgz && yum -y localinstall boost*.rpm && rm -rf boost*.rpm
+""",
+        "slave_discovery": """
+# slave_discovery: slaves of the auto scaling group, found by their tags
+for attempt in $(seq 1 30); do
+  slave_ips=$(aws ec2 describe-instances --region ${AWS::Region} --output text --query 'Reservations[].Instances[].PrivateIpAddress' --filters "Name=tag:aws:autoscaling:groupName,Values=${slave_group}" "Name=tag:Type,Values=Slave" "Name=instance-state-name,Values=running" || true)
+  [ $(echo $slave_ips | wc -w) -ge ${SlaveCount} ] && break
+  sleep 10
+done
+n=1
+for ip in $slave_ips; do
+  echo "$ip slave$n" >> /etc/hosts
+  echo "Host slave$n" >> /home/ec2-user/.ssh/config
+  echo "IdentityFile ~/.ssh/MyEC2KeyPair.pem" >> /home/ec2-user/.ssh/config
+  n=$((n+1))
+done
 """,
         "cfn_signal": """
 # cfn_signal
@@ -405,13 +436,14 @@ bash /tmp/config_root_ssh_control.sh
 
 
 class CfnGenerator(object):
-    def __init__(self, template_name, config_dir, cfn_usage, server_count, input_config=DEFAULT_CONFIG):
+    def __init__(self, template_name, config_dir, cfn_usage, server_count, input_config=DEFAULT_CONFIG, fleet="instances"):
         self.template = Template()
         self.template_name = template_name
         self.config_dir = config_dir
         self.input_config = input_config
         self.cfn_usage = cfn_usage
         self.server_count = server_count
+        self.fleet = fleet
 
         self.ref_stack_id = Ref('AWS::StackId')
         self.ref_stack_region = Ref('AWS::Region')
@@ -468,46 +500,83 @@ yum update -y aws-cfn-bootstrap
             try:
                 self.template_config["Parameter"][k] = self.template.add_parameter(Parameter.from_dict(k,v))
             except Exception as e:
-                logger.error("add_parameter {0} error. {1}".format(k, e))
+                logger.error("add_parameter %s error. %s", k, e)
         self.template.add_metadata(self.input_config['Metadata'])
 
-    @log()
-    def sub_ref_val(self):
-        info = json.dumps(self.input_config)
-        #logger.info("self.input_config",self.input_config)
-
-
-        for conf_name, conf in self.input_config.items():
-            if self.template_config.get(conf_name) is not None:
-                logger.info(conf_name)
-                def _get_config(matched):
-                    ParamStr = matched.group("param")
-                    logger.info("   "+ParamStr)
-                    if conf_name == 'Parameter':
-                        #logger.info(Ref(self.template_config[conf_name][ParamStr]))
-                        #return '!Ref '+self.template_config[conf_name][ParamStr]
-                        return Ref(self.template_config[conf_name][ParamStr])
-                    else:
-                        return Ref(self.input_config[conf_name][ParamStr])
-                #info = re.sub('ref_'+conf_name+'_{2}(?P<param>\w+)', "Ref(self.input_config['"+conf_name+"']['\g<param>'])", info)
-                info = re.sub('ref_'+conf_name+'_{2}(?P<param>\w+)', _get_config, info)
-                
-        self.input_config = json.loads(info)
-
-
- 
+    def ref_index(self):
+        """{(section, name): Ref target} of the ref_<Section>__<name> tokens that resolve now.
+
+        Parameters resolve to their Parameter, other sections to the value in input_config,
+        e.g. ref_SecurityGroup__resource_name to the security group's logical name once it is added.
+        """
+        index = {("Parameter", k): v for k, v in self.template_config["Parameter"].items()}
+        for section in self.template_config:
+            if section != "Parameter" and isinstance(self.input_config.get(section), dict):
+                index.update(((section, k), v) for k, v in self.input_config[section].items() if isinstance(v, str) and v)
+        return index
+
+    def resolve_refs(self, node, path=""):
+        """Return node with its ref_<Section>__<name> tokens resolved, in one walk over node.
+
+        A string that is a token becomes a Ref, a string with tokens in other text a Sub.
+        Dicts and lists without tokens are returned as is. Raises InvalidReferenceError
+        with the path of every token that does not resolve.
+        """
+        index = self.ref_index()
+        errors = []
+        resolved = self._resolve_node(node, path, index, errors)
+        if errors:
+            raise InvalidReferenceError(errors)
+        return resolved
+
+    def _resolve_node(self, node, path, index, errors):
+        if isinstance(node, str):
+            return self._resolve_str(node, path, index, errors) if "ref_" in node else node
+        if isinstance(node, dict):
+            changed = {}
+            for k, v in node.items():
+                resolved = self._resolve_node(v, "{0}.{1}".format(path, k) if path else k, index, errors)
+                if resolved is not v:
+                    changed[k] = resolved
+            return dict(node, **changed) if changed else node
+        if isinstance(node, list):
+            resolved = [self._resolve_node(v, "{0}[{1}]".format(path, i), index, errors) for i, v in enumerate(node)]
+            return resolved if any(r is not v for r, v in zip(resolved, node)) else node
+        return node
+
+    def _resolve_str(self, value, path, index, errors):
+        matches = list(REF_TOKEN.finditer(value))
+        if not matches:
+            return value
+        missing = [m for m in matches if (m.group("section"), m.group("name")) not in index]
+        for m in missing:
+            section, name = m.group("section"), m.group("name")
+            if section not in self.template_config:
+                reason = "unknown section {0}".format(section)
+            elif name in self.input_config.get(section, {}):
+                reason = "{0} {1} is not added yet".format(section, name)
+            else:
+                reason = "{0} has no {1}".format(section, name)
+            errors.append((path, m.group(0), reason))
+        if missing:
+            return value
+        if len(matches) == 1 and matches[0].group(0) == value:
+            return Ref(index[(matches[0].group("section"), matches[0].group("name"))])
+
+        def _logical_name(m):
+            target = index[(m.group("section"), m.group("name"))]
+            return "${" + (target if isinstance(target, str) else target.title) + "}"
+        return Sub(REF_TOKEN.sub(_logical_name, value.replace("${", "${!")))
 
     # add_resource("SecurityGroup", "TestSecurityGroup")
     # add_resource("Instance", "AnsibleControl", UserDataFile='cfn_userdata.txt', MetaData={'buckets':buckets, 'sources': sources, 'files': files, 'commands': commands}})
     @log()
     def add_resource(self, resource_type, resource_name, **resource_data):
-        #self.sub_ref_val()
-
-        content = {k:v for k,v in self.input_config[resource_type].items() if k not in ['resource_name', 'CreationPolicy', 'Metadata']}
+        content = self.resolve_refs({k:v for k,v in self.input_config[resource_type].items() if k not in ['resource_name', 'CreationPolicy', 'Metadata']},
+            resource_type)
 
         if resource_type.startswith("SecurityGroup"):
             if resource_type == "SecurityGroup":
-                content["VpcId"] = Ref(self.template_config["Parameter"]["VpcId"])
                 content["SecurityGroupIngress"].append({
                       "IpProtocol": "tcp",
                       "CidrIp": Ref(self.template_config["Parameter"]["SSHLocation"]),
@@ -517,12 +586,9 @@ yum update -y aws-cfn-bootstrap
                 })
 
             elif resource_type == "SecurityGroupIngress":
-                content["GroupId"] = Ref(self.input_config["SecurityGroup"]["resource_name"])
-                content["SourceSecurityGroupId"] = Ref(self.input_config["SecurityGroup"]["resource_name"])
-                
                 content1 = {k:v for k,v in content.items()}
                 content1.update({"IpProtocol": "udp"})
-                logger.info(content1)
+                logger.debug("%s", content1)
                 self.template_config[resource_type][resource_name+'Udp'] = eval(resource_type).from_dict(resource_name+'Udp',content1)
                 self.template.add_resource(self.template_config[resource_type][resource_name+'Udp'])
                 
@@ -535,36 +601,70 @@ yum update -y aws-cfn-bootstrap
 
 
         elif resource_type == 'Instance':
-            content["InstanceType"] = Ref(self.template_config['Parameter']['InstanceType'])
-            content["IamInstanceProfile"] = Ref(self.template_config['Parameter']['RoleName'])
-            content["KeyName"] = Ref(self.template_config['Parameter']['KeyName'])
-            content["SecurityGroupIds"] = [Ref(self.input_config["SecurityGroup"]["resource_name"])]
             if "Control" in resource_name:
                 content["Tags"] = [{ "Key": "Type", "Value": "Control"}]
 
-            logger.info(resource_name, content)
+            logger.debug("%s %s", resource_name, content)
             ec2_instance = eval(resource_type).from_dict(resource_name, content)
             ec2_instance.ImageId = FindInMap('AWSRegionArch2AMI', Ref('AWS::Region'), FindInMap('AWSInstanceType2Arch',
           Ref(self.template_config['Parameter']['InstanceType']), 'Arch')) 
 
             if "Control" in resource_name and int(self.server_count) > 1:
-                ec2_instance.DependsOn = [re.sub('Control','Slave',resource_name)+str(i) for i in range(1,int(self.server_count))]
+                if self.fleet == "asg":
+                    ec2_instance.DependsOn = [re.sub('Control','SlaveGroup',resource_name)]
+                else:
+                    ec2_instance.DependsOn = [re.sub('Control','Slave',resource_name)+str(i) for i in range(1,int(self.server_count))]
 
 
             if resource_data.get('Metadata') is not None:
-                logger.info(resource_data['Metadata'])
+                logger.debug("%s", resource_data['Metadata'])
                 ec2_instance.Metadata = self.compile_meta_data(resource_data['Metadata'], resource_name)
             if resource_data.get('CreationPolicy') is not None:
                 ec2_instance.CreationPolicy = resource_data['CreationPolicy']
 
             if resource_data.get('UserData') is not None:
-                ec2_instance.UserData = Base64(Sub(re.sub("server_name", resource_name, resource_data['UserData'])))
+                user_data = re.sub("server_name", resource_name, resource_data['UserData'])
+                ec2_instance.UserData = Base64(Sub(re.sub("slave_group", re.sub('Control','SlaveGroup',resource_name), user_data)))
             elif content.get('UserData') is not None:
                 ec2_instance.UserData = Base64(Sub(content['UserData']))
 
 
             self.template_config[resource_type][resource_name] = self.template.add_resource(ec2_instance)
 
+    # add_slave_fleet("AnsibleSlave", 300, UserData=slave_userdata)
+    @log()
+    def add_slave_fleet(self, resource_name, slave_count, **resource_data):
+        """Add the slaves as one LaunchTemplate and one AutoScalingGroup instead of an Instance each.
+
+        The group size is the SlaveCount parameter (default slave_count), so the template is the
+        same for 3 or 300 slaves. Slaves carry the Instance tags of the config (Type: Slave), the
+        control finds them by these tags with the slave_discovery user data.
+        """
+        self.template_config["Parameter"][SLAVE_COUNT_PARAMETER] = self.template.add_parameter(Parameter.from_dict(SLAVE_COUNT_PARAMETER, {
+            "Description": "Number of slave servers in the auto scaling group",
+            "Type": "Number",
+            "Default": str(slave_count),
+            "MinValue": "0"
+        }))
+        content = self.resolve_refs({k:v for k,v in self.input_config["Instance"].items() if k not in ['resource_name', 'Tags']}, "Instance")
+        content["IamInstanceProfile"] = {"Name": content["IamInstanceProfile"]}
+        content["ImageId"] = FindInMap('AWSRegionArch2AMI', Ref('AWS::Region'), FindInMap('AWSInstanceType2Arch',
+          Ref(self.template_config['Parameter']['InstanceType']), 'Arch'))
+        if resource_data.get('UserData') is not None:
+            content["UserData"] = Base64(Sub(re.sub("server_name", resource_name+"Group", resource_data['UserData'])))
+
+        launch_template = self.template.add_resource(LaunchTemplate.from_dict(resource_name+"LaunchTemplate", {"LaunchTemplateData": content}))
+        slave_count_ref = Ref(self.template_config["Parameter"][SLAVE_COUNT_PARAMETER])
+        slave_group = AutoScalingGroup.from_dict(resource_name+"Group", {
+            "LaunchTemplate": {"LaunchTemplateId": Ref(launch_template), "Version": GetAtt(launch_template, "LatestVersionNumber")},
+            "MinSize": slave_count_ref,
+            "MaxSize": slave_count_ref,
+            "DesiredCapacity": slave_count_ref,
+            "Tags": [dict(tag, PropagateAtLaunch=True) for tag in self.input_config["Instance"]["Tags"]]
+        })
+        slave_group.AvailabilityZones = GetAZs('')
+        self.template_config["Instance"][resource_name+"Group"] = self.template.add_resource(slave_group)
+
     @log()
     def compile_meta_data(self, metadata, resource_name):
         Metadata_InitFiles_input = {}
@@ -573,7 +673,7 @@ yum update -y aws-cfn-bootstrap
 
         # files: {"/etc/cfn/cfn-hup.conf": "cfn-hup.conf"}
         if metadata.get('files'):
-            logger.info(metadata.get('files'))
+            logger.debug("%s", metadata.get('files'))
             index = 1
             for k, v in metadata.get('files').items():
                 Metadata_InitFiles_input[k] = InitFile.from_dict("file"+str(index), {
@@ -641,35 +741,69 @@ yum update -y aws-cfn-bootstrap
         for k,v in self.output_config.items():
             self.output = self.template.add_output(Output.from_dict(k,v))
 
-    def gen_cfn_template(self, cfn_dir):
-        print(self.template.to_yaml())
-        with open(os.path.join(cfn_dir,self.template_name), 'w') as f:
-            f.write(self.template.to_yaml())
-        print("Successfully generated template: {0}, under dir: {1}.\nTo be launched by:\npython cfn_launch.py -m create -t {0}".format(self.template_name, cfn_dir))
+    @log()
+    def gen_cfn_template(self, cfn_dir, verbose=True, echo=False):
+        """Write the template to cfn_dir, compact JSON for a .json template name, YAML otherwise.
+
+        The template dict is built once and streamed to the file, echo also streams it to stdout.
+        Returns (bytes written, number of resources).
+        """
+        template = self.template.to_dict()
+        fmt = "json" if self.template_name.endswith(".json") else "yaml"
+        template_file = os.path.join(cfn_dir, self.template_name)
+        with open(template_file + '.tmp', 'w') as fh:
+            stream_template(template, fh, fmt)
+        os.replace(template_file + '.tmp', template_file)
+        size, resource_count = os.path.getsize(template_file), len(template.get("Resources", {}))
+        logger.info("%s written: %d bytes, %d resources", template_file, size, resource_count)
+        if echo:
+            stream_template(template, sys.stdout, fmt)
+        if verbose:
+            print("Successfully generated template: {0} ({2} bytes, {3} resources), under dir: {1}.\nTo be launched by:\npython cfn_launch.py -m create -t {0}".format(
+                self.template_name, cfn_dir, size, resource_count))
+        return size, resource_count
 
 @log()
-def gen_meta_config(cfn_usage):
+def gen_meta_config(cfn_usage, fleet="instances"):
+    # commands and sources are updated in place below, keep META_CONFIG as it is
+    META = copy.deepcopy(META_CONFIG)
     meta_config = {}
     for mk in ["buckets", "creation_policy", "files"]:
-        meta_config[mk] = META_CONFIG[mk]
+        meta_config[mk] = META[mk]
     meta_config["sources"] = {}
-    meta_config["commands"] = META_CONFIG["commands"]["control"]
+    meta_config["commands"] = META["commands"]["control"]
     control_userdata = ""
-    #meta_config["slave_userdata"] = META_CONFIG["userdata"]["pre_config"]
-    meta_config["slave_userdata"] = '\n'.join([META_CONFIG["userdata"].get(x, '') for x in ['pre_config'] + [y for y in cfn_usage if y != 'ansible']]) 
+    #meta_config["slave_userdata"] = META["userdata"]["pre_config"]
+    meta_config["slave_userdata"] = '\n'.join([META["userdata"].get(x, '') for x in ['pre_config'] + [y for y in cfn_usage if y != 'ansible']]) 
     for usage in cfn_usage:
-        control_userdata +=  META_CONFIG["userdata"].get(usage, '')
+        control_userdata +=  META["userdata"].get(usage, '')
         for init_item in ["sources", "commands"]:
             try:
-                meta_config[init_item].update(META_CONFIG[init_item].get(usage,''))
+                meta_config[init_item].update(META[init_item].get(usage,''))
             except TypeError as e:
-                logger.info("No {0} for {1}".format(init_item, usage))
-    default_control_userdata = [META_CONFIG["userdata"][x] for x in ["pre_config", "cfn_init", "cfn_signal"]]
+                logger.info("No %s for %s", init_item, usage)
+    # the slaves of an auto scaling group are looked up after cfn-init wrote /etc/hosts and the ssh config
+    default_control_userdata = [META["userdata"][x] for x in ["pre_config", "cfn_init"] + (["slave_discovery"] if fleet == "asg" else []) + ["cfn_signal"]]
     meta_config["control_userdata"] = "\n".join(default_control_userdata[:-1]+[control_userdata]+default_control_userdata[-1:])
     return meta_config
 
+def file_holds(path, content):
+    try:
+        with open(path) as fh:
+            return fh.read() == content
+    except (IOError, OSError):
+        return False
+
+def write_if_changed(path, content):
+    """Write content to path unless it already holds it, so that its mtime only moves on change."""
+    if file_holds(path, content):
+        return False
+    with open(path, 'w') as fh:
+        fh.write(content)
+    return True
+
 @log()
-def gen_server_info(count, dir, **meta_config):
+def gen_server_info(count, server_name_pre, fleet="instances", **meta_config):
 
     server_info = {}
     ctl_metadata = {k:v for k,v in meta_config.items() if not re.search("^creation|userdata$", k)}
@@ -685,30 +819,168 @@ def gen_server_info(count, dir, **meta_config):
     if control_userdata:
         server_info[server_name_pre+"Control"]["UserData"] = control_userdata
 
-    if int(count) > 1:
+    # asg: the slaves are added by CfnGenerator.add_slave_fleet, and the control finds them at boot
+    if int(count) > 1 and fleet != "asg":
         for i in range(1,int(count)):
             server_info[server_name_pre+"Slave"+str(i)] = {
                 "Metadata": slv_metadata
             }
             if slave_userdata:
                 server_info[server_name_pre+"Slave"+str(i)]["UserData"] = slave_userdata
-    with open(os.path.join(dir,"hosts.txt"),'w') as fh:
-        fh.write("""127.0.0.1   localhost localhost.localdomain localhost4 localhost4.localdomain4 control
-::1         localhost6 localhost6.localdomain6\n""")
-        for key in server_info.keys():
-            if re.search("[Cc]ontrol", key):
-                fh.write("{0}\n".format('control'))
-            else:
-                fh.write("${{{0}.PrivateIp}} {1}\n".format(key, "slave"+re.findall('\d+',key)[-1]))
-    with open(os.path.join(dir,"ssh_config.txt"),'w') as fh:
-
-        for key in server_info.keys():
-            if re.search("[Cc]ontrol", key):
-                fh.write("Host {}\nIdentityFile ~/.ssh/MyEC2KeyPair.pem\n".format(key))
-            else:
-                fh.write("Host {}\nIdentityFile ~/.ssh/MyEC2KeyPair.pem\n".format("slave"+re.findall('\d+',key)[-1]))
     return server_info
 
+def gen_init_files(server_info):
+    """Contents of the GENERATED_INIT_FILES for server_info: {file name: content}."""
+    hosts = ["""127.0.0.1   localhost localhost.localdomain localhost4 localhost4.localdomain4 control
+::1         localhost6 localhost6.localdomain6\n"""]
+    ssh_config = []
+    for key in server_info.keys():
+        if re.search("[Cc]ontrol", key):
+            hosts.append("{0}\n".format('control'))
+            ssh_config.append("Host {}\nIdentityFile ~/.ssh/MyEC2KeyPair.pem\n".format(key))
+        else:
+            hosts.append("${{{0}.PrivateIp}} {1}\n".format(key, "slave"+re.findall('\d+',key)[-1]))
+            ssh_config.append("Host {}\nIdentityFile ~/.ssh/MyEC2KeyPair.pem\n".format("slave"+re.findall('\d+',key)[-1]))
+    return {"hosts.txt": "".join(hosts), "ssh_config.txt": "".join(ssh_config)}
+
+def template_names(cfn_usage, server_count, template_name=None, fmt="yaml", fleet="instances"):
+    """(server name prefix, template file name) of a usage list and server count."""
+    if template_name:
+        return "".join(map(lambda x: x.capitalize(), re.split(r'_|\.',template_name)[:-1])), template_name
+    return "".join(map(lambda x: x.capitalize(), cfn_usage)), "cfn_"+"_".join(cfn_usage+(["asg"] if fleet == "asg" else []))+'_'+str(server_count)+'.'+fmt
+
+def template_fingerprint(cfn_usage, server_count, config_dir, template_name, fleet="instances"):
+    """SHA-256 over everything a generated template depends on.
+
+    Covers the arguments, the DEFAULT_CONFIG sections and META_CONFIG entries used for cfn_usage,
+    the init files read from config_dir, the troposphere version and this script.
+    """
+    config = {k: DEFAULT_CONFIG[k] for k in CONFIG_SECTIONS + (ANSIBLE_CONFIG_SECTIONS if "ansible" in cfn_usage else ())}
+    inputs = {
+        "args": [list(cfn_usage), int(server_count), template_name, fleet],
+        "config": config,
+        "meta": gen_meta_config(cfn_usage, fleet),
+        "troposphere": troposphere.__version__
+    }
+    sha = hashlib.sha256(json.dumps(inputs, sort_keys=True, default=lambda o: o.to_dict() if hasattr(o, 'to_dict') else str(o)).encode('utf8'))
+    for init_file in sorted(set(META_CONFIG["files"].values()) - set(GENERATED_INIT_FILES)):
+        sha.update(init_file.encode('utf8'))
+        try:
+            with open(os.path.join(config_dir, init_file), 'rb') as fh:
+                sha.update(fh.read())
+        except (IOError, OSError):
+            sha.update(b"missing")
+    with open(os.path.abspath(__file__), 'rb') as fh:
+        sha.update(fh.read())
+    return sha.hexdigest()
+
+def check_fingerprint(cfn_usage, server_count, cfn_dir, config_dir, template_name=None, fmt="yaml", fleet="instances"):
+    """(fingerprint, stored entry) of a template. stored is None unless the template exists and its inputs are unchanged."""
+    template_name = template_names(cfn_usage, server_count, template_name, fmt, fleet)[1]
+    fingerprint = template_fingerprint(cfn_usage, server_count, config_dir, template_name, fleet)
+    template_file = os.path.join(cfn_dir, template_name)
+    try:
+        with open(template_file + FINGERPRINT_SUFFIX) as fh:
+            stored = json.load(fh)
+    except (IOError, OSError, ValueError):
+        return fingerprint, None
+    if stored.get("fingerprint") != fingerprint or not os.path.exists(template_file):
+        return fingerprint, None
+    return fingerprint, stored
+
+@log()
+def generate_template(cfn_usage, server_count, cfn_dir, config_dir, template_name=None, verbose=True, force=False, fmt="yaml", echo=False,
+        fleet="instances"):
+    """Generate the template of cfn_usage with server_count servers into cfn_dir.
+
+    Works on its own copy of DEFAULT_CONFIG and META_CONFIG, so that several templates can be
+    generated by one process. hosts.txt and ssh_config.txt are written to config_dir.
+    Nothing is generated or written when the input fingerprint matches the stored one, unless force.
+    fmt (yaml, json) applies to generated names, echo prints the template, verbose the result.
+    fleet asg puts the slaves in one auto scaling group, see CfnGenerator.add_slave_fleet.
+    Returns (template file name, number of resources, generated).
+    """
+    server_name_pre, template_name = template_names(cfn_usage, server_count, template_name, fmt, fleet)
+    fingerprint, stored = check_fingerprint(cfn_usage, server_count, cfn_dir, config_dir, template_name, fleet=fleet)
+    # a single server has no slaves to discover
+    meta_config = gen_meta_config(cfn_usage, fleet if int(server_count) > 1 else "instances")
+    server_info = gen_server_info(server_count, server_name_pre, fleet, **meta_config)
+    init_files = gen_init_files(server_info)
+    # config_dir is shared by all templates, its init files may be those of another one
+    if stored is not None and not force and all(file_holds(os.path.join(config_dir, f), c) for f, c in init_files.items()):
+        logger.info("%s is up to date (%s), generation skipped", template_name, fingerprint)
+        if verbose:
+            print("Template {0} under dir {1} is up to date.".format(template_name, cfn_dir))
+        return template_name, stored.get("resources"), False
+
+    for init_file, content in init_files.items():
+        write_if_changed(os.path.join(config_dir, init_file), content)
+
+    cfn_generator = CfnGenerator(template_name, config_dir, cfn_usage, server_count, input_config=copy.deepcopy(DEFAULT_CONFIG), fleet=fleet)
+    cfn_generator.add_resource("SecurityGroup", "TestSecurityGroup")
+    cfn_generator.add_resource("SecurityGroupIngress", "TestSecurityGroupIngress")
+    if fleet == "asg" and int(server_count) > 1:
+        cfn_generator.add_slave_fleet(server_name_pre+"Slave", int(server_count) - 1, UserData=meta_config["slave_userdata"])
+
+    for server, v in server_info.items():
+        cfn_generator.add_resource("Instance", server, **v)
+
+    cfn_generator.add_output()
+    size, resource_count = cfn_generator.gen_cfn_template(cfn_dir, verbose, echo)
+    with open(os.path.join(cfn_dir, template_name) + FINGERPRINT_SUFFIX, 'w') as fh:
+        json.dump({"fingerprint": fingerprint, "resources": resource_count, "generated": datetime.datetime.now().isoformat()}, fh)
+    return template_name, resource_count, True
+
+def matrix_job(cfn_usage, server_count, cfn_dir, config_dir, force=False, fmt="yaml", fleet="instances"):
+    """Generate one matrix template in a private copy of config_dir. Returns its manifest entry."""
+    start = time.time()
+    template_name = template_names(cfn_usage, server_count, fmt=fmt, fleet=fleet)[1]
+    entry = {"template": template_name, "usage": cfn_usage, "server_count": server_count}
+    work_dir = None
+    try:
+        fingerprint, stored = check_fingerprint(cfn_usage, server_count, cfn_dir, config_dir, fmt=fmt, fleet=fleet)
+        if stored is not None and not force:
+            entry.update(resources=stored.get("resources"), generated=False)
+        else:
+            work_dir = tempfile.mkdtemp(prefix="cfn-matrix-")
+            if os.path.isdir(config_dir):
+                shutil.copytree(config_dir, work_dir, dirs_exist_ok=True)
+            template_name, resource_count, generated = generate_template(cfn_usage, server_count, cfn_dir, work_dir,
+                verbose=False, force=True, fmt=fmt, fleet=fleet)
+            entry.update(resources=resource_count, generated=generated)
+        entry["bytes"] = os.path.getsize(os.path.join(cfn_dir, template_name))
+    except Exception as e:
+        logger.error("%s error. %s", entry["template"], e)
+        entry["error"] = str(e)
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    entry["seconds"] = round(time.time() - start, 3)
+    return entry
+
+@log()
+def generate_matrix(usage_sets, server_counts, cfn_dir, config_dir, max_workers=None, force=False, fmt="yaml", fleet="instances"):
+    """Generate a template for every usage set and server count on a process pool.
+
+    Workers are spawned, so each imports troposphere and this module once and starts from
+    an untouched DEFAULT_CONFIG. Templates with unchanged inputs are skipped unless force.
+    Writes MATRIX_MANIFEST to cfn_dir and returns it.
+    """
+    jobs = [(usage, count) for usage in usage_sets for count in server_counts]
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(matrix_job, usage, count, cfn_dir, config_dir, force, fmt, fleet) for usage, count in jobs]
+        entries = [f.result() for f in futures]
+    manifest = {
+        "generated": datetime.datetime.now().isoformat(),
+        "seconds": round(time.time() - start, 3),
+        "templates": entries
+    }
+    with open(os.path.join(cfn_dir, MATRIX_MANIFEST), 'w') as fh:
+        json.dump(manifest, fh, indent=2)
+    return manifest
+
+
 if __name__ == '__main__':
 
     parser = ArgumentParser(description="Generate cloudformation template")
@@ -729,40 +1001,58 @@ if __name__ == '__main__':
     parser.add_argument('-l', '--launch', dest='cfn_launch', 
         help='Cloudformation launch. Default: True. No launch: False',
         default=True, action='store')
+    parser.add_argument('--matrix', dest='matrix', type=str, nargs='+',
+        help='Generate one template per usage set and --counts server count in parallel, without launch. Usages of a set are comma separated, e.g. --matrix awstest ansible,docker serverless',
+        default=None)
+    parser.add_argument('--counts', dest='server_counts',
+        help='Matrix: comma separated server counts. Default: {0}'.format(MATRIX_COUNTS),
+        default=MATRIX_COUNTS, action='store')
+    parser.add_argument('-f', '--format', dest='template_format', choices=['yaml', 'json'],
+        help='Format of generated template names: yaml or compact json. -t names ending in .json are written as json. Default: yaml',
+        default='yaml', action='store')
+    parser.add_argument('--fleet', dest='fleet', choices=FLEET_TYPES,
+        help='Slaves as one instance resource each, or as one auto scaling group sized by the SlaveCount parameter (asg). The role needs ec2:DescribeInstances for asg. Default: instances',
+        default='instances', action='store')
+    parser.add_argument('--echo', dest='echo',
+        help='Also print the generated template to stdout.',
+        default=False, action='store_true')
+    parser.add_argument('--force', dest='force',
+        help='Generate even if the inputs match the fingerprint stored with the template.',
+        default=False, action='store_true')
+    parser.add_argument('--workers', dest='workers', type=int,
+        help='Matrix: number of worker processes. Default: number of CPUs',
+        default=None, action='store')
 
 
 
     args = parser.parse_args() 
-
-    logger.info("""script start. \n{0}""".format(args))    
-
-    if args.template_name:
-        server_name_pre = "".join(map(lambda x: x.capitalize(), re.split(r'_|\.',args.template_name)[:-1]))
-        template_name = args.template_name
-    else:
-        server_name_pre = "".join(map(lambda x: x.capitalize(), args.cfn_usage))
-        template_name = "cfn_"+"_".join(args.cfn_usage)+'_'+args.server_count+'.yaml'
-
-
-    meta_config = gen_meta_config(args.cfn_usage)
-    server_info = gen_server_info(args.server_count, args.config_dir, **meta_config)
-    #logger.info(server_info)
-
-
-
-    cfn_generator = CfnGenerator(template_name, args.config_dir, args.cfn_usage, args.server_count)
-    cfn_generator.add_resource("SecurityGroup", "TestSecurityGroup")
-    cfn_generator.add_resource("SecurityGroupIngress", "TestSecurityGroupIngress")
-
-
-    for server, v in server_info.items():
-        cfn_generator.add_resource("Instance", server, **v)
-
-    cfn_generator.add_output()
-    cfn_generator.gen_cfn_template(args.cfn_dir)
+    # the launch path logs through cfn_launch and cfn_store, to cfn_launch.log as cfn_launch.py does
+    set_up_logging('ConfigAnsibleLogger', os.path.join(log_dir(), 'cfn_launch.log'), 'info')
+
+    logger.info("""script start. \n%s""", args)    
+
+    if args.matrix:
+        manifest = generate_matrix([u.split(',') for u in args.matrix], [int(c) for c in args.server_counts.split(',') if c.strip()],
+            args.cfn_dir, args.config_dir, args.workers, args.force, args.template_format, args.fleet)
+        rows = [[t["template"], t.get("bytes", ""), t.get("resources", ""), t["seconds"],
+            t.get("error", "GENERATED" if t.get("generated") else "UP TO DATE")] for t in manifest["templates"]]
+        print_table(["Template", "Bytes", "Resources", "Seconds", "Result"], rows)
+        failed = [t["template"] for t in manifest["templates"] if "error" in t]
+        sys.exit("{0} of {1} templates ready in {2}s, manifest: {3}. Exit now!".format(len(rows) - len(failed), len(rows),
+            manifest["seconds"], os.path.join(args.cfn_dir, MATRIX_MANIFEST)))
+
+    try:
+        template_name, resource_count, generated = generate_template(args.cfn_usage, args.server_count, args.cfn_dir, args.config_dir,
+            args.template_name, force=args.force, fmt=args.template_format, echo=args.echo, fleet=args.fleet)
+    except InvalidReferenceError as e:
+        logger.error(e)
+        sys.exit("{0} Exit now!".format(e))
 
     if args.cfn_launch == True:
         # launch cfn template
         stack_name = '-'.join(re.findall("([0-9a-zA-Z]+)",template_name)[:-1]+[datetime.datetime.now().strftime("%Y%m%d%H%M%S")])
-        cfn_client = CfnClient(args.cfn_dir)
-        cfn_client.build_cfn(os.path.join(args.cfn_dir,template_name), stack_name)
\ No newline at end of file
+        cfn_client = CfnClient(args.cfn_dir, confirm=interactive_confirm)
+        try:
+            run_create(cfn_client, os.path.join(args.cfn_dir,template_name), stack_name)
+        except CfnError as e:
+            sys.exit("{0} Exit now!".format(e))
\ No newline at end of file
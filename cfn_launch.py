@@ -23,8 +23,34 @@ Functions:
 4. Describe stack will generate Xshell access config file for stacks in "CREATE_COMPLETE" status.
 5. Describe stack will show stack information until "DELETE_COMPLETE".
 6. Delete stack will delete Xshell access config file of the stack.
-7. Serialize stack info data to cfn-StackInfo.json.
-8. Serialize stack parameters to cfn-parameters.json with local ip information.
+7. Keep stack info in the cfn-StackInfo.db stack store (see cfn_store.py). Stable stacks are served locally.
+8. Serialize stack parameters to cfn-parameters.json with local ip information. The ip is looked up on several
+   endpoints concurrently and cached for an hour in ~/.cfn-local-ip.json. --local-ip overrides it, --offline uses
+   the cached value.
+9. Follow stack events with --mode wait (or create --wait) until stacks complete or fail.
+10. Batch create many stacks of one template with --count and/or --param-matrix, rate limited.
+11. Cache validate_template results by template SHA-256. --mode validate-all checks a whole template dir concurrently.
+12. Templates over the 51200 byte inline limit are staged in S3 under their SHA-256 and passed as TemplateURL.
+13. Update a stack in place with --mode update through a change set. Empty change sets are skipped.
+14. Record wall time, retries and response size of every AWS call to cfn_timings.jsonl. --timings prints a summary.
+15. CfnClient is usable as a library: operations return result objects, raise CfnError subclasses and ask an
+    injectable confirm policy. The command line modes are thin run_* wrappers.
+16. --region takes a comma separated list or all. Regions are worked on concurrently and describe prints one table.
+17. Describe resolves public and private ips of the stack instances with one describe_instances call for all
+    stacks, filtered on the aws:cloudformation:stack-id tag. Stacks without Outputs get Xshell sessions too.
+18. --mode inventory lists every stack of the region (not only those created here) into a local index and
+    queries it by --filter name pattern and --status. Listings younger than 5 minutes are reused, --refresh forces one.
+19. --mode bulk-delete deletes every stack matching --filter, --status and/or --older-than after one confirmation,
+    rate limited and concurrently, then tracks completion and reports per-stack durations and DELETE_FAILED stacks.
+20. --mode drift detects drift of all tracked stacks (or -i) concurrently and stores drifted resources in the stack
+    store. Results younger than 30 minutes are reused, --refresh forces a new detection.
+21. Logging goes through log_setup.py: a queue listener thread writes cfn_launch.log, -l sets the level and
+    --log-json switches to JSON lines. Stack descriptions are only logged at debug. Logging and the exception hook
+    are set up by the command line only, importing cfn_launch leaves those of a host process alone.
+22. Templates are read through cfn_templates.py, cached by path, mtime and size. --mode convert converts the YAML
+    templates of -d to JSON (--to yaml: JSON to YAML) in parallel with LibYAML, skipping up-to-date targets.
+23. --compact submits templates as minified JSON without descriptions, --dedupe-strings also moves repeated long
+    strings into a Mapping. The compacted template is checked against the original and the bytes saved are logged.
 
 History:
 ---------
@@ -33,8 +59,6 @@ History:
 03/07/2019 Kaiyuan Wang 1
     Change stack create to boto3. Encapsulation stack management into class CfnClient. Documentation.
 
-TODO:
-    open interfaces
 """
 
 __author__ = "Kaiyuan Wang"
@@ -43,17 +67,23 @@ import requests
 import re
 import os
 import json
-import yaml
-import boto3
 import botocore
 import sys
 import signal
-import logging
-import logging.handlers
 import datetime
+import time
+import itertools
+import atexit
+import hashlib
+import logging
+import ipaddress
+import queue
+import threading
 import subprocess
 import shutil
 import platform, getpass
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 try:
     import ConfigParser
 except:
@@ -61,19 +91,71 @@ except:
 from argparse import ArgumentParser
 from warnings import filterwarnings
 
-""" 
-TODO: currently check on stacks created by this script, add option to check all stacks in region
-TODO: retrieve server ip from instance instead of output
-"""
-
-
-
-LOG_LEVELS = { 'debug':logging.DEBUG,
-            'info':logging.INFO,
-            'warning':logging.WARNING,
-            'error':logging.ERROR,
-            'critical':logging.CRITICAL
-            }
+from aws_clients import get_client
+from cfn_store import StackStore, DRIFT_MAX_AGE
+from cfn_throttle import TokenBucket, call_with_backoff
+from cfn_metrics import recorder
+from log_setup import set_up_logging, LazyJson
+from cfn_templates import templates, convert_file, convert_dir, NON_TEMPLATE_FILES
+
+
+
+# fetch_local_ip: public ip lookup endpoints, queried concurrently, first valid answer wins
+LOCAL_IP_ENDPOINTS = [
+    "http://txt.go.sohu.com/ip/soip",
+    "https://checkip.amazonaws.com",
+    "https://api.ipify.org",
+    "https://ifconfig.me/ip"
+]
+LOCAL_IP_TIMEOUT = 5
+LOCAL_IP_CACHE_TTL = 3600
+# the cache is per machine and kept out of the template dir, where validate-all and convert would pick it up
+LOCAL_IP_CACHE = os.path.join(os.path.expanduser('~'), '.cfn-local-ip.json')
+
+# query_cfn_status: above this many stacks, list the region once instead of one call per stack
+BULK_QUERY_THRESHOLD = 5
+QUERY_MAX_WORKERS = 10
+
+# wait_stacks: describe_stack_events poll interval (seconds), grows while stacks are quiet
+WAIT_POLL_MIN = 5
+WAIT_POLL_MAX = 60
+WAIT_POLL_BACKOFF = 1.5
+# validate_templates: template file extensions, NON_TEMPLATE_FILES are skipped
+TEMPLATE_EXTENSIONS = (".yaml", ".yml", ".json", ".template")
+
+# templates above the inline TemplateBody limit are staged in S3 and passed as TemplateURL
+TEMPLATE_BODY_LIMIT = 51200
+TEMPLATE_S3_BUCKET = "ansible-test-kaiyuan"
+TEMPLATE_S3_PREFIX = "cfn-templates/"
+
+# create_stacks: concurrent create_stack calls and their rate limit (calls per second)
+BATCH_MAX_WORKERS = 10
+CREATE_RATE_LIMIT = 2
+# bulk delete: delete_stack calls per second, and how long to track completion (seconds)
+DELETE_RATE_LIMIT = 2
+DELETE_TIMEOUT = 3600
+# consecutive describe errors after which a deleting stack is no longer tracked
+TRACK_MAX_ERRORS = 3
+# drift: detect_stack_drift calls per second, and how long to poll detections (seconds)
+DRIFT_RATE_LIMIT = 2
+DRIFT_TIMEOUT = 900
+# several --region values (or all) are worked on concurrently, one worker per region
+DEFAULT_REGION = "ap-southeast-2"
+REGION_MAX_WORKERS = 20
+# resolve_instance_ips: describe_instances accepts at most 200 values per filter
+EC2_FILTER_CHUNK = 200
+INSTANCE_LIVE_STATES = ["pending", "running", "stopping", "stopped"]
+# inventory: list_stacks StackStatusFilter (every status but DELETE_COMPLETE) and seconds a listing is reused
+INVENTORY_STATUSES = ["CREATE_IN_PROGRESS", "CREATE_FAILED", "CREATE_COMPLETE", "ROLLBACK_IN_PROGRESS", "ROLLBACK_FAILED",
+    "ROLLBACK_COMPLETE", "DELETE_IN_PROGRESS", "DELETE_FAILED", "UPDATE_IN_PROGRESS", "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS",
+    "UPDATE_COMPLETE", "UPDATE_FAILED", "UPDATE_ROLLBACK_IN_PROGRESS", "UPDATE_ROLLBACK_FAILED",
+    "UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS", "UPDATE_ROLLBACK_COMPLETE", "REVIEW_IN_PROGRESS", "IMPORT_IN_PROGRESS",
+    "IMPORT_COMPLETE", "IMPORT_ROLLBACK_IN_PROGRESS", "IMPORT_ROLLBACK_FAILED", "IMPORT_ROLLBACK_COMPLETE"]
+INVENTORY_MAX_AGE = 300
+STACK_TERMINAL_STATUSES = ("CREATE_COMPLETE", "UPDATE_COMPLETE", "DELETE_COMPLETE", "ROLLBACK_COMPLETE",
+            "UPDATE_ROLLBACK_COMPLETE", "IMPORT_COMPLETE", "IMPORT_ROLLBACK_COMPLETE")
+# stack events that start an operation, rollbacks continue the operation they undo
+STACK_OPERATION_STARTS = ("CREATE_IN_PROGRESS", "UPDATE_IN_PROGRESS", "DELETE_IN_PROGRESS", "IMPORT_IN_PROGRESS")
 
 
 
@@ -82,41 +164,90 @@ def exception_hook(exc_type, exc_value, exc_traceback):
                 "Uncaught exception",
                 exc_info=(exc_type, exc_value, exc_traceback)
         )
-sys.excepthook = exception_hook
 
 
 def log():
     def decorator(func):
         def wrapper(*args, **kw):
-            logger.info("Running {0}()...".format(func.__name__))
-            a=func(*args, **kw) 
+            logger.info("Running %s()...", func.__name__)
+            start = time.time()
+            try:
+                a=func(*args, **kw) 
+            finally:
+                recorder.record('method', func.__name__, time.time() - start)
             return a
         return wrapper
     return decorator
 
-def set_up_logging(log_level):
-    """Set up logger."""
-    logger = logging.getLogger('ConfigAnsibleLogger')
-    logger.setLevel(LOG_LEVELS[log_level])
+def log_dir():
     if os.path.exists(os.path.join(os.getcwd(), 'logs')):
-        log_file=os.path.join(os.getcwd(), 'logs', 'cfn_launch.log')
-    else:
-        log_file=os.path.join(os.getcwd(), 'cfn_launch.log')
-    formatter = logging.Formatter('[%(asctime)s  %(levelname)s] %(message)s')
-    handler = logging.handlers.TimedRotatingFileHandler(log_file, when='D', backupCount=10)
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    return logger
-
-logger = set_up_logging('info')
-
-
-
-def fetch_local_ip():
-    response = requests.get("http://txt.go.sohu.com/ip/soip")
-    ip = re.findall(r'\d+.\d+.\d+.\d+',response.text)
-    pub_ip = ip[0]
-    
+        return os.path.join(os.getcwd(), 'logs')
+    return os.getcwd()
+
+# handlers, the log file and the exception hook are set up by the command line only, a host process keeps its own
+logger = logging.getLogger('ConfigAnsibleLogger')
+
+
+
+def query_ip_endpoint(url):
+    """Return the first public IPv4 address in the response of url, or None."""
+    try:
+        response = requests.get(url, timeout=LOCAL_IP_TIMEOUT)
+        for candidate in re.findall(r'\d+\.\d+\.\d+\.\d+', response.text):
+            if ipaddress.ip_address(candidate).is_global:
+                return candidate
+    except Exception as e:
+        logger.info("%s public ip lookup failed. %s", url, e)
+    return None
+
+def resolve_public_ip(local_ip=None, offline=False, endpoints=None, ttl=LOCAL_IP_CACHE_TTL):
+    """Return the public IP of this machine.
+
+    An explicit local_ip (or CFN_LOCAL_IP) wins. Otherwise a cached answer younger
+    than ttl is used, then all endpoints are queried concurrently and the first
+    valid answer is cached. offline=True, or every endpoint failing, falls back to
+    the cached answer whatever its age.
+    """
+    local_ip = local_ip or os.environ.get('CFN_LOCAL_IP')
+    if local_ip:
+        return local_ip.split('/')[0]
+
+    cached = {}
+    try:
+        with open(LOCAL_IP_CACHE) as fh:
+            cached = json.load(fh)
+    except Exception:
+        pass
+    if cached.get('ip') and (offline or time.time() - cached.get('resolved_at', 0) < ttl):
+        return cached['ip']
+    if offline:
+        raise RuntimeError("No cached public ip in {0} for offline mode. Use --local-ip.".format(LOCAL_IP_CACHE))
+
+    endpoints = endpoints or LOCAL_IP_ENDPOINTS
+    # daemon threads: slower endpoints are abandoned once one answered, also at interpreter exit
+    answers = queue.Queue()
+    for url in endpoints:
+        threading.Thread(target=lambda u: answers.put(query_ip_endpoint(u)), args=(url,), daemon=True).start()
+    pub_ip = None
+    for _ in endpoints:
+        try:
+            pub_ip = answers.get(timeout=LOCAL_IP_TIMEOUT*2)
+        except queue.Empty:
+            break
+        if pub_ip:
+            break
+
+    if pub_ip is None:
+        if cached.get('ip'):
+            logger.warning("Public ip lookup failed, using cached %s", cached['ip'])
+            return cached['ip']
+        raise RuntimeError("Public ip lookup failed on {0}".format(", ".join(endpoints)))
+    with open(LOCAL_IP_CACHE, 'w') as fh:
+        json.dump({'ip': pub_ip, 'resolved_at': time.time()}, fh)
+    return pub_ip
+
+def fetch_local_ip(local_ip=None, offline=False):
+    pub_ip = resolve_public_ip(local_ip, offline)
 
     local_ip_param = [
                         {
@@ -125,15 +256,47 @@ def fetch_local_ip():
                             "ResolvedValue": "string"
                         }
                     ]
-    with open(os.path.join('cfn_template','cfn-parameters.json'), 'w') as fh: 
-        json.dump(local_ip_param, fh)
+    param_file = os.path.join('cfn_template','cfn-parameters.json')
+    try:
+        with open(param_file) as fh:
+            changed = json.load(fh) != local_ip_param
+    except Exception:
+        changed = True
+    if changed:
+        with open(param_file, 'w') as fh: 
+            json.dump(local_ip_param, fh)
     return local_ip_param
 
+def stack_region(stack_id):
+    """Region part of a stack ARN, None for a stack name."""
+    parts = stack_id.split(':')
+    return parts[3] if stack_id.startswith('arn:') and len(parts) > 5 else None
+
+def resolve_regions(region_arg, profile=None):
+    """Turn --region into a list of regions: one region, a comma separated list or all.
+
+    all lists the regions enabled for the account with one ec2 describe_regions call.
+    """
+    if region_arg.strip().lower() == 'all':
+        regions = get_client('ec2', region=DEFAULT_REGION, profile=profile).describe_regions()['Regions']
+        return sorted(r['RegionName'] for r in regions)
+    return list(OrderedDict.fromkeys(r.strip() for r in region_arg.split(',') if r.strip()))
+
+def expand_param_matrix(param_matrix):
+    """Expand a parameter matrix into a list of {ParameterKey: value} dicts.
+
+    A dict of lists is expanded to its cartesian product, e.g.
+    {"InstanceType": ["t2.micro", "t2.small"], "KeyName": ["MyEC2KeyPair"]} gives 2 sets.
+    A list of dicts is taken as is.
+    """
+    if isinstance(param_matrix, dict):
+        keys = sorted(param_matrix.keys())
+        values = [v if isinstance(v, list) else [v] for v in (param_matrix[k] for k in keys)]
+        return [dict(zip(keys, combo)) for combo in itertools.product(*values)]
+    return list(param_matrix)
+
 def yaml2json(yaml_file, json_file):
-    with open(yaml_file, 'r', encoding='utf8') as fh:
-      datastream = yaml.load(fh)
-    with open(json_file, 'w') as fh: 
-        json.dump(datastream, fh)
+    convert_file(yaml_file, json_file, "json", force=True)
 
 class MyConfigParser(ConfigParser.ConfigParser): 
     def optionxform(self, optionstr): 
@@ -183,221 +346,1224 @@ class XshellAccess(object):
         os.remove(stack_name+'.xsh')
 
 
+class CfnError(Exception):
+    """Base class of errors raised by CfnClient operations."""
+
+class TemplateError(CfnError):
+    """Template can not be read or fails validate_template."""
+
+class StackNotFoundError(CfnError):
+    """Requested stack does not exist (or is DELETE_COMPLETE)."""
+
+class OperationAborted(CfnError):
+    """The confirm policy declined the operation."""
+
+class StackOperationError(CfnError):
+    """A CloudFormation call failed or a change set could not be created."""
+
+
+# stack_instances: {logical id: instance ips}, filled by describe_stacks(connect=True)
+class StackResult(namedtuple('StackResult', 'stack_id stack_name stack_status stack_parameters stack_output stack_instances')):
+    @classmethod
+    def from_info(cls, stack_id, stack_info):
+        return cls(stack_id, stack_info['stack_name'], stack_info['stack_status'],
+            stack_info.get('stack_parameters', []), stack_info.get('stack_output', {}), stack_info.get('stack_instances', {}))
+
+# created: [StackResult], failed: [(stack_name, error)]
+BatchCreateResult = namedtuple('BatchCreateResult', 'created failed')
+# deleted, declined: [StackResult], failed: [(stack_id, error)]
+DeleteResult = namedtuple('DeleteResult', 'deleted declined failed')
+# final_events: {stack_id: final stack event}, failed: [stack_id]
+WaitResult = namedtuple('WaitResult', 'final_events failed')
+# changes: [ResourceChange], executed: False for a planned or empty change set,
+# start_event_id: newest stack event before execution, the watermark to wait from
+UpdateResult = namedtuple('UpdateResult', 'stack_id stack_name change_set_name changes executed start_event_id')
+# inventory row, times in epoch seconds
+StackSummary = namedtuple('StackSummary', 'stack_id stack_name region stack_status name_prefix creation_time last_updated_time')
+# deleted: [(StackSummary, seconds)], failed: [(StackSummary, reason)], pending: [StackSummary] still deleting at timeout
+BulkDeleteResult = namedtuple('BulkDeleteResult', 'deleted failed pending')
+# resources: drifted (MODIFIED or DELETED) resources, cached: served from the stack store
+DriftResult = namedtuple('DriftResult', 'stack_id stack_name drift_status detection_status detail resources checked_at cached')
+
+
+# confirm policies: callable(prompt) -> bool
+def always_confirm(prompt):
+    return True
+
+def never_confirm(prompt):
+    return False
+
+def interactive_confirm(prompt):
+    return input(prompt) == "y"
+
+
 class CfnClient(object):
-    def __init__(self, cfn_dir, region='ap-southeast-2', ):
+    """Create, update, describe, delete and wait on CloudFormation stacks.
+
+    Operations return result objects and raise CfnError subclasses, so one client can
+    be driven from a long-lived process. confirm is the policy asked before creating
+    next to other stacks, deleting a stack or executing a change set. The default
+    never_confirm refuses, so a library caller opts in to those operations with
+    always_confirm or its own policy; the CLI passes interactive_confirm.
+    """
+    def __init__(self, cfn_dir, region=DEFAULT_REGION, s3_bucket=TEMPLATE_S3_BUCKET, profile=None, local_ip=None, offline=False,
+            confirm=never_confirm, compact=False, dedupe_strings=False):
         self.region = region
-        self.cfn_conn = boto3.client('cloudformation', region_name=self.region)
+        self.profile = profile
+        self.local_ip = local_ip
+        self.offline = offline
+        self.confirm = confirm
+        self.compact = compact
+        self.dedupe_strings = dedupe_strings
+        self.cfn_conn = recorder.attach(get_client('cloudformation', region=self.region, profile=self.profile))
+        # calls made through call_with_backoff, retried there rather than in botocore as well
+        self.batch_cfn_conn = recorder.attach(get_client('cloudformation', region=self.region, profile=self.profile, batch=True))
+        self.s3_conn = recorder.attach(get_client('s3', region=self.region, profile=self.profile))
+        self.ec2_conn = recorder.attach(get_client('ec2', region=self.region, profile=self.profile))
+        self.s3_bucket = s3_bucket
+        self.staged_templates = {}
+        self.s3_bucket_region = None
         self.stack_info_json = os.path.join(cfn_dir,'cfn-StackInfo.json')
-        self.stack_info_dict = {}
-        #with open(self.template_yaml) as yh:
-        #    self.cfn_template = yaml.load(yh)
-            #self.cfn_template = json.dumps(yh)
+        self.stack_store = StackStore(os.path.join(cfn_dir,'cfn-StackInfo.db'), legacy_json=self.stack_info_json)
+        self.create_limiter = TokenBucket(CREATE_RATE_LIMIT)
+        self.delete_limiter = TokenBucket(DELETE_RATE_LIMIT)
+        self.drift_limiter = TokenBucket(DRIFT_RATE_LIMIT)
 
 
-    def load_stack_info(self):
-        try:
-            with open(self.stack_info_json) as fh:
-                self.stack_info_dict = json.load(fh)
-        except Exception as e:
-            logger.error("{0} loading error. {1}".format(self.stack_info_json, e))
-            self.stack_info_dict = {}
+    def tracked_stack_ids(self):
+        return list(self.stack_store.get(region=self.region).keys())
 
+    def _describe_one_stack(self, stack_id):
+        try:
+            return self.cfn_conn.describe_stacks(StackName=stack_id)['Stacks'][0]
+        except botocore.exceptions.ClientError as e:
+            logger.error("describe_stacks %s error. %s", stack_id, e)
+            return None
+
+    def describe_stacks_bulk(self, stack_id_list):
+        """Fetch stack descriptions for stack_id_list in as few round-trips as possible.
+
+        More than BULK_QUERY_THRESHOLD stacks: page through describe_stacks without a
+        name and filter locally. Anything left over (few stacks, or stacks the listing
+        no longer returns such as DELETE_COMPLETE) is fetched by ID on a bounded pool.
+        Returns {stack_id: stack_details}, ordered as stack_id_list.
+        """
+        stack_id_list = list(stack_id_list)
+        found = {}
+        if len(stack_id_list) > BULK_QUERY_THRESHOLD:
+            wanted = set(stack_id_list)
+            for page in self.cfn_conn.get_paginator('describe_stacks').paginate():
+                for stack in page['Stacks']:
+                    for key in (stack['StackId'], stack['StackName']):
+                        if key in wanted:
+                            found[key] = stack
+
+        missing = [stack_id for stack_id in stack_id_list if stack_id not in found]
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(QUERY_MAX_WORKERS, len(missing))) as pool:
+                for stack_id, stack in zip(missing, pool.map(self._describe_one_stack, missing)):
+                    if stack is not None:
+                        found[stack_id] = stack
+
+        return OrderedDict((stack_id, found[stack_id]) for stack_id in stack_id_list if stack_id in found)
 
+    @log()
+    def resolve_instance_ips(self, stack_id_list):
+        """Return {stack_id: {logical_id: instance ips}} for the EC2 instances of stack_id_list.
+
+        Instances are found by their aws:cloudformation:stack-id tag, so every stack
+        is covered by one paginated describe_instances call (per EC2_FILTER_CHUNK
+        stacks), Outputs or not. stack_id_list must be stack ARNs, the tag holds the ARN.
+        Terminated instances are left out.
+        """
+        stack_id_list = list(stack_id_list)
+        instance_ips = OrderedDict((stack_id, {}) for stack_id in stack_id_list)
+        paginator = self.ec2_conn.get_paginator('describe_instances')
+        for i in range(0, len(stack_id_list), EC2_FILTER_CHUNK):
+            filters = [{'Name': 'tag:aws:cloudformation:stack-id', 'Values': stack_id_list[i:i+EC2_FILTER_CHUNK]},
+                {'Name': 'instance-state-name', 'Values': INSTANCE_LIVE_STATES}]
+            for page in paginator.paginate(Filters=filters):
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        tags = {t['Key']: t['Value'] for t in instance.get('Tags', [])}
+                        stack_id = tags.get('aws:cloudformation:stack-id')
+                        if stack_id not in instance_ips:
+                            continue
+                        instance_ips[stack_id][tags.get('aws:cloudformation:logical-id', instance['InstanceId'])] = {
+                            "InstanceId": instance['InstanceId'],
+                            "State": instance['State']['Name'],
+                            "PublicIpAddress": instance.get('PublicIpAddress'),
+                            "PrivateIpAddress": instance.get('PrivateIpAddress')
+                        }
+        return instance_ips
 
-    def dump_stack_info(self):
-        with open(self.stack_info_json, 'w') as fh: 
-            json.dump(self.stack_info_dict, fh)
+    @staticmethod
+    def control_ip(stack_info):
+        """Public ip of the control host: ControlPublicIp output, else the *Control* instance."""
+        control_ip = stack_info.get('stack_output', {}).get('ControlPublicIp')
+        if control_ip:
+            return control_ip
+        for logical_id, ips in sorted(stack_info.get('stack_instances', {}).items()):
+            if 'Control' in logical_id and ips['PublicIpAddress']:
+                return ips['PublicIpAddress']
+        return None
 
     @log()
-    def query_cfn_status(self, stack_id_list, connect=False):
-        # change to use *list
-        logger.info(stack_id_list)
-        stack_dict_tmp = {}
-        for stack_id in stack_id_list:
-            boto_resp = self.cfn_conn.describe_stacks(StackName=stack_id)
+    def query_cfn_status(self, stack_id_list, connect=False, refresh=False):
+        """Return {stack_id: stack_info} for stacks not yet DELETE_COMPLETE.
+
+        Stacks whose stored status is still fresh (see cfn_store.STATUS_MAX_AGE) are
+        served from the stack store. The rest are queried in bulk and written back
+        to the store in one transaction. refresh=True queries every stack.
+        connect=True also resolves the instance ips of all returned stacks in one
+        EC2 call and creates Xshell sessions for them.
+        """
+        stack_id_list = list(stack_id_list)
+        logger.debug("query_cfn_status: %s", stack_id_list)
+        if refresh:
+            cached, stale_id_list = {}, stack_id_list
+        else:
+            cached, stale_id_list = self.stack_store.split_fresh(stack_id_list)
+        logger.info("%s stacks served from stack store, %s to refresh", len(cached), len(stale_id_list))
+
+        refreshed = {}
+        # requested id (ARN or stack name) -> ARN, instance tags hold the ARN
+        stack_arns = {}
+        for stack_id, stack_details in self.describe_stacks_bulk(stale_id_list).items():
             #output_dict = {d["OutputKey"]:d["OutputValue"] for d in boto_resp['Stacks'][0]['Outputs']}
-            stack_details = boto_resp['Stacks'][0]
-            stack_name = stack_id.split('/')[1]
+            stack_name = stack_details['StackName']
             stack_status = stack_details['StackStatus']
-            stack_parameters = stack_details['Parameters']
-            logger.info("stack_details:\n{0}".format(stack_details))
-            logger.info("stack_details['StackStatus']: {0}".format(stack_details['StackStatus']))
-            logger.info("stack_details['Parameters']:\n{0}".format(stack_details['Parameters']))
+            stack_parameters = stack_details.get('Parameters', [])
+            logger.info("%s %s", stack_name, stack_status)
+            logger.debug("stack_details:\n%s", LazyJson(stack_details))
 
             stack_info = {"stack_name":stack_name, "stack_status":stack_status, "stack_parameters":stack_parameters}
 
+            if 'Outputs' in stack_details.keys():
+                stack_output = {d["OutputKey"]:d["OutputValue"] for d in stack_details['Outputs']}
+                stack_info.update({"stack_output":stack_output})
+
+            refreshed.update({stack_details['StackId']:stack_info})
+            cached.update({stack_id:stack_info})
+            stack_arns[stack_id] = stack_details['StackId']
+        self.stack_store.upsert(refreshed, region=self.region)
+
+        stack_dict_tmp = {}
+        for stack_id in stack_id_list:
+            stack_info = cached.get(stack_id)
+            if stack_info is None:
+                continue
+            stack_name, stack_status = stack_info['stack_name'], stack_info['stack_status']
             if stack_status == "DELETE_COMPLETE":
                 logger.info(" ".join([stack_name, stack_status]))
                 continue
 
-            if 'Outputs' in stack_details.keys():
-                stack_output = {d["OutputKey"]:d["OutputValue"] for d in stack_details['Outputs']}
-                logger.info("stack_details['Outputs']:\n{0}".format(stack_details['Outputs']))
-                #print("ControlPublicIp: "+stack_output['ControlPublicIp'])
-                
-                if not stack_status.startswith("DELETE") and connect and platform.system() == 'Windows':
+            stack_dict_tmp.update({stack_id:stack_info})
+
+        if connect and stack_dict_tmp:
+            live_ids = [k for k,v in stack_dict_tmp.items() if not v['stack_status'].startswith("DELETE")]
+            live_arns = OrderedDict((k, stack_arns.get(k, k)) for k in live_ids)
+            try:
+                instance_ips = self.resolve_instance_ips([arn for arn in live_arns.values() if stack_region(arn)])
+            except botocore.exceptions.ClientError as e:
+                logger.error("describe_instances error. %s", e)
+                instance_ips = {}
+            for stack_id, stack_arn in live_arns.items():
+                stack_info = stack_dict_tmp[stack_id] = dict(stack_dict_tmp[stack_id], stack_instances=instance_ips.get(stack_arn, {}))
+                control_ip = self.control_ip(stack_info)
+                if control_ip and platform.system() == 'Windows':
                     try:
-                        XshellAccess.create(stack_name, stack_output['ControlPublicIp'])
+                        XshellAccess.create(stack_info['stack_name'], control_ip)
                     except:
                         pass
-                stack_info.update({"stack_output":stack_output})
-            
-            stack_dict_tmp.update({stack_id:stack_info})
 
-            
         return stack_dict_tmp
 
 
 
 
     @log()
-    def build_cfn(self, cfn_template, stack_name):
-        ''' aws cli connection. AWS cli supports JASON only
-        # yaml2json for aws cli
-        if re.split("\.", options.cfn_template)[-1] in ["yml", "yaml"]:
-            cfn_template =  re.split("\.", options.cfn_template)[0]+'.json'
-            yaml2json(options.cfn_template, cfn_template)
-        else:
-            cfn_template = options.cfn_template
-        # cfn-StackId.json: [{"StackId": "arn:aws:cloudformation:ap-southeast-2:813556749890:stack/AnsibleTest-20190302115934/73f8a4f0-3c86-11e9-9b63-02181cf5d610"}]
-        #aws cloudformation create-stack --stack-name example-cli-stack --template-body file://cfn_ansible_test_one_server.json --parameters file://cfn-parameters.json --region ap-southeast-2
-        aws_cmd = "aws cloudformation create-stack --stack-name {0} --template-body file://{1} --parameters file://{2} --region {3}".format(stack_name, cfn_template, "cfn-parameters.json", options.region)
-        p = subprocess.Popen(aws_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        logger.info(p.communicate())
-        stack_id_dict = json.loads(p.communicate()[0].decode('utf-8'))
-
-        '''
-
-        self.cfn_parameters = []
-        self.cfn_template = cfn_template
-        self.stack_name = stack_name
-        self.validate_cfn()
-        self.cfn_parameters = fetch_local_ip()
-
-        self.load_stack_info()
-        logger.debug(self.stack_info_dict.keys())
-        self.stack_info_dict = self.query_cfn_status(self.stack_info_dict.keys())
-        logger.debug(self.stack_info_dict.keys())
-     
-
-        if self.stack_info_dict:
-            create_confirm=input("Stacks {0} in system. \nAre you sure you want to create another stack from template {1} (y or n)?\n".format(list(self.stack_info_dict.keys()),self.cfn_template))
-            if create_confirm != "y":
-                sys.exit("Stack creation aborted. Script exit now!")
+    def create_stack(self, cfn_template, stack_name, parameters=None):
+        """Create one stack from cfn_template and return its StackResult.
+
+        parameters default to SSHLocation of this machine. When other tracked stacks
+        are up the confirm policy is asked first.
+        """
+        template_body, template_info = self.load_template(cfn_template)
+        if parameters is None:
+            parameters = fetch_local_ip(self.local_ip, self.offline)
+
+        stack_info_dict = self.query_cfn_status(self.tracked_stack_ids())
+        logger.debug(stack_info_dict.keys())
+        if stack_info_dict and not self.confirm("Stacks {0} in system. \nAre you sure you want to create another stack from template {1} (y or n)?\n".format(list(stack_info_dict.keys()), cfn_template)):
+            raise OperationAborted("Stack creation aborted.")
 
         try:
-            with open(self.cfn_template, 'r', encoding='utf8') as fh:
-                stack_id = self.cfn_conn.create_stack(
-                    StackName=self.stack_name,
-                    TemplateBody=fh.read(),
-                    Parameters=self.cfn_parameters,
-                    # when creating IAM
-                    Capabilities=['CAPABILITY_IAM']
-                    )['StackId']
-        except  Exception as e:
-            logger.error("{0} loading error. {1}".format(self.cfn_template, e))
-            sys.exit("{0} loading error. {1}".format(self.cfn_template, e))
+            stack_id = self.cfn_conn.create_stack(
+                StackName=stack_name,
+                Parameters=parameters,
+                # when creating IAM
+                Capabilities=['CAPABILITY_IAM'],
+                **self.template_source(template_body)
+                )['StackId']
+        except botocore.exceptions.ClientError as e:
+            logger.error("%s create error. %s", cfn_template, e)
+            raise StackOperationError("{0} create error. {1}".format(cfn_template, e))
         logger.debug(stack_id)
-        stack_id_list = list(self.stack_info_dict.keys())+[stack_id]
-        logger.debug(stack_id_list)
-        self.stack_info_dict= self.query_cfn_status(stack_id_list)
-        self.dump_stack_info()
 
+        stack_info = {"stack_name": stack_name, "stack_status": "CREATE_IN_PROGRESS", "stack_parameters": parameters}
+        self.stack_store.upsert({stack_id: stack_info}, region=self.region)
         logger.info("""Create cloudformation stack finished. """)
-        sys.exit("Stack creation initiated. Exit now!")
+        return StackResult.from_info(stack_id, stack_info)
 
 
+    def _create_one_stack(self, stack_name, template_source, parameters):
+        try:
+            return call_with_backoff(self.create_limiter, self.batch_cfn_conn.create_stack,
+                StackName=stack_name,
+                Parameters=parameters,
+                Capabilities=['CAPABILITY_IAM'],
+                **template_source)['StackId'], None
+        except botocore.exceptions.ClientError as e:
+            logger.error("create_stack %s error. %s", stack_name, e)
+            return None, str(e)
+
     @log()
-    def describe_cfn(self, input_stack_id=""):
-        if input_stack_id:
-            logger.info(input_stack_id)
-            self.print_cfn_desc([input_stack_id])
-        else:
-            self.load_stack_info()
-            self.stack_info_dict = self.print_cfn_desc(self.stack_info_dict.keys())
-            self.dump_stack_info()
-        
-        if not self.stack_info_dict:
-            logger.info("""Describe cloudformation stack finished. \nNo cloudformatation stack can be found. Exit now!""")
-            sys.exit("No cloudformatation stack can be found. Exit now!")
-        else:
-            logger.info("""Describe cloudformation stack finished. """)
-            sys.exit("""Describe cloudformation stack finished. """)
-        
+    def create_stacks(self, cfn_template, stack_name, count=1, param_matrix=None):
+        """Create count stacks per parameter combination of param_matrix from one template.
+
+        create_stack calls run concurrently through a shared token bucket that backs off
+        on throttling. Stacks are named <stack_name>-<n> and all resulting stack ids
+        are written to the stack store in one transaction. Returns BatchCreateResult.
+        """
+        template_body, template_info = self.load_template(cfn_template)
+        template_source = self.template_source(template_body)
+        base_parameters = fetch_local_ip(self.local_ip, self.offline)
+
+        param_sets = expand_param_matrix(param_matrix) if param_matrix is not None else [{}]
+        jobs = []
+        for params in param_sets:
+            parameters = [p for p in base_parameters if p['ParameterKey'] not in params]
+            parameters += [{"ParameterKey": k, "ParameterValue": str(v)} for k,v in sorted(params.items())]
+            for _ in range(int(count)):
+                jobs.append(("{0}-{1}".format(stack_name, len(jobs)+1), parameters))
+        if not jobs:
+            logger.info("No stack to create from %s", cfn_template)
+            return BatchCreateResult([], [])
+        logger.info("Creating %s stacks from %s", len(jobs), cfn_template)
+
+        with ThreadPoolExecutor(max_workers=min(BATCH_MAX_WORKERS, len(jobs))) as pool:
+            responses = list(pool.map(lambda job: self._create_one_stack(job[0], template_source, job[1]), jobs))
+
+        created, failed = OrderedDict(), []
+        for (name, parameters), (stack_id, error) in zip(jobs, responses):
+            if stack_id:
+                created[stack_id] = {"stack_name": name, "stack_status": "CREATE_IN_PROGRESS", "stack_parameters": parameters}
+            else:
+                failed.append((name, error))
+        self.stack_store.upsert(created, region=self.region)
+
+        logger.info("""Batch create cloudformation stack finished. %s of %s initiated.""", len(created), len(jobs))
+        return BatchCreateResult([StackResult.from_info(k, v) for k,v in created.items()], failed)
+
 
-    def print_cfn_desc(self, stack_id_list):
-        stack_info_dict = self.query_cfn_status(stack_id_list, connect=True)
+    def change_set_changes(self, stack_name, change_set_name):
+        """Return (status, status reason, resource changes) of a change set, all pages."""
+        changes, kw = [], {}
+        while True:
+            resp = self.cfn_conn.describe_change_set(StackName=stack_name, ChangeSetName=change_set_name, **kw)
+            changes += [c['ResourceChange'] for c in resp.get('Changes', []) if c.get('Type') == 'Resource']
+            if not resp.get('NextToken'):
+                return resp['Status'], resp.get('StatusReason', ''), changes
+            kw = {'NextToken': resp['NextToken']}
+
+    @log()
+    def plan_update(self, cfn_template, input_stack_id):
+        """Create a change set updating input_stack_id to cfn_template, without executing it.
+
+        SSHLocation is refreshed, every other parameter keeps its previous value.
+        An empty change set is deleted right away and returned with no changes.
+        """
+        template_body, template_info = self.load_template(cfn_template)
+        template_param_keys = [p['ParameterKey'] for p in template_info.get('Parameters', [])]
+
+        stack_info_dict = self.query_cfn_status([input_stack_id], refresh=True)
         if not stack_info_dict:
-            return stack_info_dict
-            
+            raise StackNotFoundError("Stack {0} can not be found.".format(input_stack_id))
+        stack_id, stack_info = list(stack_info_dict.items())[0]
+        stack_name = stack_info['stack_name']
 
-        for si in stack_info_dict.keys():
-            print(si)
-            logger.info(stack_info_dict[si])
-            print("Stack Status: "+stack_info_dict[si].get('stack_status'))
-            output = stack_info_dict[si].get("stack_output")
-            if output:
-                for k,v in sorted(output.items()):
-                    print(': '.join([k,v]))
-        return stack_info_dict
+        parameters = [p for p in fetch_local_ip(self.local_ip, self.offline) if p['ParameterKey'] in template_param_keys]
+        new_keys = [p['ParameterKey'] for p in parameters]
+        parameters += [{"ParameterKey": p['ParameterKey'], "UsePreviousValue": True} for p in stack_info['stack_parameters']
+            if p['ParameterKey'] in template_param_keys and p['ParameterKey'] not in new_keys]
 
+        change_set_name = "cfn-launch-" + datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        try:
+            self.cfn_conn.create_change_set(
+                StackName=stack_name,
+                ChangeSetName=change_set_name,
+                ChangeSetType='UPDATE',
+                Parameters=parameters,
+                Capabilities=['CAPABILITY_IAM'],
+                **self.template_source(template_body))
+        except botocore.exceptions.ClientError as e:
+            raise StackOperationError("Change set for {0} error. {1}".format(stack_name, e))
+        try:
+            self.cfn_conn.get_waiter('change_set_create_complete').wait(StackName=stack_name, ChangeSetName=change_set_name,
+                WaiterConfig={'Delay': 5})
+        except botocore.exceptions.WaiterError as e:
+            logger.info("change set %s not created. %s", change_set_name, e)
+        status, reason, changes = self.change_set_changes(stack_name, change_set_name)
+
+        if status == 'FAILED':
+            self.cfn_conn.delete_change_set(StackName=stack_name, ChangeSetName=change_set_name)
+            if "didn't contain changes" in reason or "No updates" in reason:
+                return UpdateResult(stack_id, stack_name, change_set_name, [], False, None)
+            raise StackOperationError("Change set {0} failed: {1}".format(change_set_name, reason))
+        return UpdateResult(stack_id, stack_name, change_set_name, changes, False, None)
+
+    def discard_update(self, update):
+        self.cfn_conn.delete_change_set(StackName=update.stack_name, ChangeSetName=update.change_set_name)
 
     @log()
-    def delete_cfn(self,input_stack_id=""):
-        if input_stack_id:
-            stack_info_dict = self.query_cfn_status([input_stack_id])
-            self.del_cfn_action(stack_info_dict)
-        else:
-            self.load_stack_info()
-            self.stack_info_dict = self.query_cfn_status(self.stack_info_dict)
-            if not self.stack_info_dict:
-                sys.exit("No cloudformatation stack created by {0} is in the system. Exit now!".format(sys.argv[0]))
-            else:
-                self.del_cfn_action(self.stack_info_dict)
-                
+    def execute_update(self, update):
+        """Execute a change set returned by plan_update.
 
+        The newest stack event before execution is kept as start_event_id, so waiting
+        on the update does not take the outcome of an earlier operation.
+        """
+        start_event_id = self.latest_event_id(update.stack_id)
+        try:
+            self.cfn_conn.execute_change_set(StackName=update.stack_name, ChangeSetName=update.change_set_name)
+        except botocore.exceptions.ClientError as e:
+            raise StackOperationError("Change set {0} error. {1}".format(update.change_set_name, e))
+        stack_info = self.query_cfn_status([update.stack_id], refresh=True).get(update.stack_id)
+        if stack_info:
+            self.stack_store.upsert({update.stack_id: dict(stack_info, stack_status='UPDATE_IN_PROGRESS')}, region=self.region)
+        logger.info("""Update cloudformation stack finished. """)
+        return update._replace(executed=True, start_event_id=start_event_id)
+
+    def update_stack(self, cfn_template, input_stack_id):
+        """plan_update, ask the confirm policy, then execute_update. Empty change sets are not executed."""
+        update = self.plan_update(cfn_template, input_stack_id)
+        if not update.changes:
+            return update
+        if not self.confirm("Are you sure you want to execute change set {0} with {1} changes (y or n)?\n".format(update.change_set_name, len(update.changes))):
+            self.discard_update(update)
+            raise OperationAborted("Stack update aborted.")
+        return self.execute_update(update)
 
-    def del_cfn_action(self, stack_info_dict):
 
-        stack_list_remain, stack_list_delete = [], []
-        if not stack_info_dict:
-            sys.exit('Stack already DELETE_COMPLETE. Exit now!')
+    @log()
+    def describe_stacks(self, stack_id_list=None, connect=False):
+        """Return {stack_id: StackResult} for stack_id_list, or all tracked stacks."""
+        if stack_id_list is None:
+            stack_id_list = self.tracked_stack_ids()
+        stack_info_dict = self.query_cfn_status(stack_id_list, connect=connect)
+        return OrderedDict((k, StackResult.from_info(k, v)) for k,v in stack_info_dict.items())
 
-        for stack_id in stack_info_dict.keys():
-            
-            stack_status = stack_info_dict[stack_id].get('stack_status')
-            print(stack_id, stack_status)
+
+    @log()
+    def delete_stacks(self, stack_id_list=None):
+        """Delete stack_id_list, or all tracked stacks, asking the confirm policy per stack.
+
+        Stacks already deleting are skipped. Raises StackNotFoundError when explicitly
+        requested stacks do not exist. Returns DeleteResult.
+        """
+        explicit = stack_id_list is not None
+        stack_info_dict = self.query_cfn_status(stack_id_list if explicit else self.tracked_stack_ids())
+        if explicit and not stack_info_dict:
+            raise StackNotFoundError("Stack {0} can not be found or already DELETE_COMPLETE.".format(", ".join(stack_id_list)))
+
+        deleted, declined, failed = [], [], []
+        for stack_id, stack_info in stack_info_dict.items():
+            stack_status = stack_info.get('stack_status')
             if stack_status.startswith('DELETE'):
-                print('Already initiated DELETE action.')
+                logger.info("%s already initiated DELETE action.", stack_id)
                 continue
-            delete_confirm=input("Are you sure you want to delete this stack (y or n)?\n") 
-            if delete_confirm == "y":
-                try:
-                    self.cfn_conn.delete_stack(StackName=stack_id)
-                    logger.info(stack_info_dict)
-                    if platform.system() == 'Windows':
-                        XshellAccess.delete(stack_info_dict[stack_id].get('stack_name'))
-                except:
-                    pass
-                finally:
-                    stack_list_delete.append(stack_id)
-            else:
-                stack_list_remain.append(stack_id) 
+            if not self.confirm("{0} {1}\nAre you sure you want to delete this stack (y or n)?\n".format(stack_id, stack_status)):
+                declined.append(StackResult.from_info(stack_id, stack_info))
+                continue
+            try:
+                self.cfn_conn.delete_stack(StackName=stack_id)
+            except botocore.exceptions.ClientError as e:
+                logger.error("delete_stack %s error. %s", stack_id, e)
+                failed.append((stack_id, str(e)))
+                continue
+            stack_info = dict(stack_info, stack_status='DELETE_IN_PROGRESS')
+            self.stack_store.upsert({stack_id: stack_info}, region=self.region)
+            deleted.append(StackResult.from_info(stack_id, stack_info))
 
         logger.info("""Delete cloudformation stack initiation finished. """)
-        if stack_list_delete:
-            sys.exit("Stack deleting initiated. Exit now!")
-        else:
-            sys.exit("Stack deleting aborted. Exit now!")  
+        return DeleteResult(deleted, declined, failed)
+
+
+    def select_stacks(self, name_glob=None, statuses=None, older_than=None):
+        """Stacks of the region to bulk delete: name pattern, statuses and/or age in hours, from a fresh inventory.
+
+        Stacks already DELETE_IN_PROGRESS are left out. At least one filter is required.
+        """
+        if not (name_glob or statuses or older_than):
+            raise CfnError("Bulk delete needs a selection: name pattern, status or age.")
+        created_before = time.time() - older_than*3600 if older_than else None
+        return [stack for stack in self.inventory(name_glob=name_glob, statuses=statuses, created_before=created_before, max_age=0)
+            if stack.stack_status != 'DELETE_IN_PROGRESS']
+
+    def _delete_one_stack(self, stack):
+        """Delete one stack through the delete rate limit. Returns (start time, error).
+
+        The deletion starts when delete_stack returns, so time waited on the limiter
+        is not counted in its duration.
+        """
+        try:
+            call_with_backoff(self.delete_limiter, self.batch_cfn_conn.delete_stack, StackName=stack.stack_id)
+            return time.time(), None
+        except botocore.exceptions.ClientError as e:
+            logger.error("delete_stack %s error. %s", stack.stack_name, e)
+            return None, str(e)
+
+    def _deletion_status(self, stack_id):
+        """(status, end time, reason) of a deleting stack. A deleted stack stays describable by its ARN.
+
+        A failed describe gives status None and the error as reason, the stack is polled again.
+        """
+        try:
+            stack = self.cfn_conn.describe_stacks(StackName=stack_id)['Stacks'][0]
+        except botocore.exceptions.ClientError as e:
+            if 'does not exist' in str(e):
+                return 'DELETE_COMPLETE', None, ''
+            logger.error("describe_stacks %s error. %s", stack_id, e)
+            return None, None, str(e)
+        end = stack.get('DeletionTime') or stack.get('LastUpdatedTime')
+        return stack['StackStatus'], end, stack.get('StackStatusReason', '')
+
+    def track_deletions(self, started, timeout=DELETE_TIMEOUT):
+        """Poll the deletion of {stack_id: (StackSummary, start time)} until all are done or timeout.
+
+        Each round describes only the stacks still pending, by ARN and concurrently. A stack
+        whose describe fails TRACK_MAX_ERRORS rounds in a row ends as DESCRIBE_FAILED with the
+        error, the others are tracked on.
+        Returns {stack_id: (final status, seconds, reason)} and the stack ids still pending.
+        """
+        pending = OrderedDict(started)
+        done = {}
+        errors = {}
+        interval = WAIT_POLL_MIN
+        deadline = time.time() + timeout
+        while pending and time.time() < deadline:
+            time.sleep(interval)
+            before = len(pending)
+            with ThreadPoolExecutor(max_workers=min(QUERY_MAX_WORKERS, len(pending))) as pool:
+                statuses = list(pool.map(self._deletion_status, pending.keys()))
+            for stack_id, (status, end, reason) in zip(list(pending.keys()), statuses):
+                if status is None:
+                    errors[stack_id] = errors.get(stack_id, 0) + 1
+                    if errors[stack_id] < TRACK_MAX_ERRORS:
+                        continue
+                    status = 'DESCRIBE_FAILED'
+                elif status not in ('DELETE_COMPLETE', 'DELETE_FAILED'):
+                    errors.pop(stack_id, None)
+                    continue
+                stack, start = pending.pop(stack_id)
+                seconds = max(0, (end.timestamp() if end else time.time()) - start)
+                done[stack_id] = (status, seconds, reason)
+            interval = WAIT_POLL_MIN if len(pending) < before else min(interval*WAIT_POLL_BACKOFF, WAIT_POLL_MAX)
+            logger.debug("%s stacks still deleting, next poll in %.0fs", len(pending), interval)
+        return done, list(pending)
+
+    @log()
+    def bulk_delete_stacks(self, stacks, timeout=DELETE_TIMEOUT):
+        """Delete [StackSummary] concurrently through the delete rate limit and wait for the outcome.
+
+        No confirmation is asked, see delete_selection. Returns BulkDeleteResult.
+        """
+        if not stacks:
+            return BulkDeleteResult([], [], [])
+        with ThreadPoolExecutor(max_workers=min(BATCH_MAX_WORKERS, len(stacks))) as pool:
+            responses = list(pool.map(self._delete_one_stack, stacks))
+
+        failed = [(stack, error) for stack, (start, error) in zip(stacks, responses) if error]
+        started = OrderedDict((stack.stack_id, (stack, start)) for stack, (start, error) in zip(stacks, responses) if not error)
+        tracked = self.stack_store.get(list(started))
+        self.stack_store.upsert({k: dict(v, stack_status="DELETE_IN_PROGRESS") for k,v in tracked.items()}, region=self.region)
+        done, pending = self.track_deletions(started, timeout)
+
+        deleted = []
+        for stack_id, (stack, start) in started.items():
+            if stack_id not in done:
+                continue
+            status, seconds, reason = done[stack_id]
+            if status == 'DELETE_COMPLETE':
+                deleted.append((stack, seconds))
+            else:
+                failed.append((stack, reason or status))
+        # tracked stacks and the inventory catch up with the outcome
+        self.query_cfn_status(list(tracked), refresh=True)
+        self.refresh_inventory(max_age=0)
+        logger.info("Bulk delete finished. %s deleted, %s failed, %s pending", len(deleted), len(failed), len(pending))
+        return BulkDeleteResult(deleted, failed, [started[k][0] for k in pending])
+
+    def delete_selection(self, name_glob=None, statuses=None, older_than=None, timeout=DELETE_TIMEOUT):
+        """select_stacks, one confirmation for the whole selection, then bulk_delete_stacks."""
+        stacks = self.select_stacks(name_glob, statuses, older_than)
+        if not stacks:
+            raise StackNotFoundError("No stack matches the selection.")
+        if not self.confirm("{0}\nAre you sure you want to delete these {1} stacks (y or n)?\n".format(
+                "\n".join("{0} {1} {2}".format(s.region, s.stack_name, s.stack_status) for s in stacks), len(stacks))):
+            raise OperationAborted("Bulk delete aborted.")
+        return self.bulk_delete_stacks(stacks, timeout)
+
+
+    def _start_drift_detection(self, stack_id):
+        try:
+            return call_with_backoff(self.drift_limiter, self.batch_cfn_conn.detect_stack_drift, StackName=stack_id)['StackDriftDetectionId'], None
+        except botocore.exceptions.ClientError as e:
+            logger.error("detect_stack_drift %s error. %s", stack_id, e)
+            return None, str(e)
+
+    def _drift_detection_status(self, detection_id):
+        try:
+            return self.cfn_conn.describe_stack_drift_detection_status(StackDriftDetectionId=detection_id)
+        except botocore.exceptions.ClientError as e:
+            return {'StackDriftDetectionId': detection_id, 'DetectionStatus': 'DETECTION_FAILED', 'DetectionStatusReason': str(e)}
+
+    def stack_resource_drifts(self, stack_id):
+        """Drifted (MODIFIED or DELETED) resources of the last drift detection of stack_id, all pages."""
+        drifts, kw = [], {}
+        while True:
+            resp = self.cfn_conn.describe_stack_resource_drifts(StackName=stack_id,
+                StackResourceDriftStatusFilters=['MODIFIED', 'DELETED'], **kw)
+            for d in resp['StackResourceDrifts']:
+                drifts.append({
+                    "LogicalResourceId": d['LogicalResourceId'],
+                    "ResourceType": d['ResourceType'],
+                    "PhysicalResourceId": d.get('PhysicalResourceId'),
+                    "StackResourceDriftStatus": d['StackResourceDriftStatus'],
+                    "PropertyDifferences": d.get('PropertyDifferences', [])
+                })
+            if not resp.get('NextToken'):
+                return drifts
+            kw = {'NextToken': resp['NextToken']}
+
+    @log()
+    def detect_drift(self, stack_id_list=None, max_age=DRIFT_MAX_AGE, timeout=DRIFT_TIMEOUT):
+        """Drift of stack_id_list, or all tracked stacks, as OrderedDict{stack_id: DriftResult}.
+
+        Results younger than max_age come from the stack store. For the rest
+        detect_stack_drift is started concurrently through the drift rate limit and
+        all detection ids are polled together each round, backing off while nothing
+        finishes. Completed detections are written to the stack store in one go.
+        """
+        explicit = stack_id_list is not None
+        stack_info_dict = self.query_cfn_status(stack_id_list if explicit else self.tracked_stack_ids())
+        if explicit and not stack_info_dict:
+            raise StackNotFoundError("Stack {0} can not be found or already DELETE_COMPLETE.".format(", ".join(stack_id_list)))
+        stack_info_dict = OrderedDict((k,v) for k,v in stack_info_dict.items() if not v['stack_status'].startswith('DELETE'))
+
+        results = OrderedDict()
+        for stack_id, row in self.stack_store.get_drift(stack_info_dict.keys(), max_age).items():
+            results[stack_id] = DriftResult(stack_id, row['stack_name'], row['drift_status'], row['detection_status'], row['detail'],
+                row['resources'], row['checked_at'], True)
+        to_check = [k for k in stack_info_dict if k not in results]
+        logger.info("%s drift results served from stack store, %s to detect", len(results), len(to_check))
+
+        def drift_result(stack_id, drift_status, detection_status, detail, resources):
+            return DriftResult(stack_id, stack_info_dict[stack_id]['stack_name'], drift_status, detection_status, detail,
+                resources, time.time(), False)
+
+        pending = OrderedDict()
+        if to_check:
+            with ThreadPoolExecutor(max_workers=min(QUERY_MAX_WORKERS, len(to_check))) as pool:
+                started = list(pool.map(self._start_drift_detection, to_check))
+            for stack_id, (detection_id, error) in zip(to_check, started):
+                if detection_id:
+                    pending[detection_id] = stack_id
+                else:
+                    results[stack_id] = drift_result(stack_id, 'UNKNOWN', 'DETECTION_FAILED', error, [])
+
+        interval = WAIT_POLL_MIN
+        deadline = time.time() + timeout
+        while pending and time.time() < deadline:
+            time.sleep(interval)
+            with ThreadPoolExecutor(max_workers=min(QUERY_MAX_WORKERS, len(pending))) as pool:
+                statuses = list(pool.map(self._drift_detection_status, list(pending)))
+            finished = [status for status in statuses if status['DetectionStatus'] != 'DETECTION_IN_PROGRESS']
+            for status in finished:
+                stack_id = pending.pop(status['StackDriftDetectionId'])
+                drift_status = status.get('StackDriftStatus', 'UNKNOWN')
+                resources = self.stack_resource_drifts(stack_id) if drift_status == 'DRIFTED' else []
+                results[stack_id] = drift_result(stack_id, drift_status, status['DetectionStatus'],
+                    status.get('DetectionStatusReason', ''), resources)
+            interval = WAIT_POLL_MIN if finished else min(interval*WAIT_POLL_BACKOFF, WAIT_POLL_MAX)
+        for stack_id in pending.values():
+            results[stack_id] = drift_result(stack_id, 'UNKNOWN', 'DETECTION_IN_PROGRESS', "still detecting at timeout", [])
+
+        # only complete detections are reused, failed ones are retried next time
+        self.stack_store.put_drift([dict(r._asdict()) for r in results.values() if not r.cached and r.detection_status == 'DETECTION_COMPLETE'])
+        return OrderedDict((k, results[k]) for k in stack_info_dict if k in results)
+
+
+    def new_stack_events(self, stack_id, last_event_id=None):
+        """Return events of stack_id newer than last_event_id, oldest first.
+
+        describe_stack_events pages newest first, so paging stops at the high-watermark
+        and a quiet stack costs one small page. Without a watermark paging stops at the
+        stack event that started the latest operation, so terminal or failed events of
+        earlier operations are never taken for its outcome.
+        """
+        events = []
+        for page in self.cfn_conn.get_paginator('describe_stack_events').paginate(StackName=stack_id):
+            for event in page['StackEvents']:
+                if event['EventId'] == last_event_id:
+                    return events[::-1]
+                events.append(event)
+                if last_event_id is None and self.is_stack_event(event) and event['ResourceStatus'] in STACK_OPERATION_STARTS:
+                    return events[::-1]
+        return events[::-1]
+
+    def latest_event_id(self, stack_id):
+        """EventId of the newest event of stack_id, a watermark taken before starting an operation."""
+        try:
+            events = self.cfn_conn.describe_stack_events(StackName=stack_id)['StackEvents']
+        except botocore.exceptions.ClientError as e:
+            logger.info("describe_stack_events %s error. %s", stack_id, e)
+            return None
+        return events[0]['EventId'] if events else None
 
+    @staticmethod
+    def is_stack_event(event):
+        """An event of the stack itself, not of one of its resources (or nested stacks)."""
+        return event['ResourceType'] == 'AWS::CloudFormation::Stack' and event['PhysicalResourceId'] == event['StackId']
+
+    @staticmethod
+    def is_final_event(event):
+        """A failed resource, or the stack itself reaching a terminal status."""
+        status = event['ResourceStatus']
+        if status.endswith('_FAILED'):
+            return True
+        return CfnClient.is_stack_event(event) and status in STACK_TERMINAL_STATUSES
 
-    def validate_cfn(self):
+    @log()
+    def follow_stack_events(self, stack_id_list, on_event=None, since=None):
+        """Tail stack events of all stacks in stack_id_list until each shows a final event.
+
+        All followed stacks are polled together each round. The interval resets to
+        WAIT_POLL_MIN whenever a round brings new events and backs off towards
+        WAIT_POLL_MAX while nothing happens. on_event is called with every new event.
+        since maps stack ids to the EventId to follow from, e.g. latest_event_id taken
+        before an operation was sent. Returns {stack_id: final event}.
+        """
+        since = since or {}
+        watermarks = OrderedDict((stack_id, since.get(stack_id)) for stack_id in stack_id_list)
+        final_events = {}
+        interval = WAIT_POLL_MIN
+        while watermarks:
+            with ThreadPoolExecutor(max_workers=min(QUERY_MAX_WORKERS, len(watermarks))) as pool:
+                new_events = list(pool.map(self.new_stack_events, watermarks.keys(), watermarks.values()))
+
+            for stack_id, events in zip(list(watermarks.keys()), new_events):
+                for event in events:
+                    if on_event is not None:
+                        on_event(event)
+                    watermarks[stack_id] = event['EventId']
+                    if self.is_final_event(event):
+                        final_events[stack_id] = event
+                        break
+                if stack_id in final_events:
+                    del watermarks[stack_id]
+
+            if not watermarks:
+                break
+            interval = WAIT_POLL_MIN if any(new_events) else min(interval*WAIT_POLL_BACKOFF, WAIT_POLL_MAX)
+            logger.debug("Following %s stacks, next poll in %.0fs", len(watermarks), interval)
+            time.sleep(interval)
+        return final_events
+
+    @log()
+    def wait_stacks(self, stack_id_list=None, on_event=None, since=None):
+        """Follow stack_id_list, or all tracked stacks in progress, until each completes or fails.
+
+        since: {stack_id: EventId} watermarks, see follow_stack_events.
+        """
+        if stack_id_list is None:
+            stack_info_dict = self.query_cfn_status(self.tracked_stack_ids())
+            stack_id_list = [k for k,v in stack_info_dict.items() if v['stack_status'].endswith('IN_PROGRESS')]
         try:
-            with open(self.cfn_template, 'r', encoding='utf8') as fh:
-                response = self.cfn_conn.validate_template(TemplateBody=fh.read())
+            final_events = self.follow_stack_events(stack_id_list, on_event, since) if stack_id_list else {}
+        except botocore.exceptions.ClientError as e:
+            raise StackOperationError("describe_stack_events error. {0}".format(e))
+        failed = [k for k,v in final_events.items() if v['ResourceStatus'].endswith('FAILED')]
+        logger.info("""Wait cloudformation stack finished. %s stacks, %s failed.""", len(final_events), len(failed))
+        logger.debug("final events: %s", LazyJson(final_events))
+        # refresh the store, the stacks have left *_IN_PROGRESS
+        self.query_cfn_status(list(final_events.keys()), refresh=True)
+        return WaitResult(final_events, failed)
+
+
+    @log()
+    def refresh_inventory(self, max_age=INVENTORY_MAX_AGE):
+        """List every stack of the region into the inventory unless the last listing is younger than max_age.
+
+        Pages through list_stacks with INVENTORY_STATUSES. Only summaries whose status or
+        LastUpdatedTime changed are rewritten. Returns the number of changed rows, or
+        None when the stored listing was reused.
+        """
+        synced_at = self.stack_store.inventory_synced_at(self.region)
+        if synced_at is not None and max_age is not None and time.time() - synced_at < max_age:
+            return None
+        summaries = []
+        for page in self.cfn_conn.get_paginator('list_stacks').paginate(StackStatusFilter=INVENTORY_STATUSES):
+            for stack in page['StackSummaries']:
+                last_updated = stack.get('LastUpdatedTime')
+                summaries.append((stack['StackId'], stack['StackName'], stack['StackStatus'], stack['CreationTime'].timestamp(),
+                    last_updated.timestamp() if last_updated else None))
+        changed, removed = self.stack_store.sync_inventory(self.region, summaries)
+        logger.info("%s: %s stacks listed, %s changed, %s gone", self.region, len(summaries), changed, removed)
+        return changed
+
+    def inventory(self, name_glob=None, prefix=None, statuses=None, created_before=None, max_age=INVENTORY_MAX_AGE):
+        """Stacks of the region matching the filters, as [StackSummary]. max_age=0 forces a new listing."""
+        self.refresh_inventory(max_age)
+        return [StackSummary(row['stack_id'], row['stack_name'], row['region'], row['stack_status'], row['name_prefix'],
+                row['creation_time'], row['last_updated_time'])
+            for row in self.stack_store.query_inventory(self.region, name_glob, prefix, statuses, created_before)]
+
+
+    @staticmethod
+    def read_template(cfn_template):
+        return templates.text(cfn_template)
+
+    def bucket_region(self):
+        """Region of s3_bucket, looked up once. The staging bucket is shared by stacks of every region."""
+        if self.s3_bucket_region is None:
+            location = self.s3_conn.get_bucket_location(Bucket=self.s3_bucket).get('LocationConstraint')
+            # us-east-1 has no location constraint, EU is the legacy name of eu-west-1
+            self.s3_bucket_region = {None: 'us-east-1', '': 'us-east-1', 'EU': 'eu-west-1'}.get(location, location)
+        return self.s3_bucket_region
+
+    def stage_template(self, template_body):
+        """Upload template_body to S3 under its SHA-256 and return the TemplateURL.
+
+        An object with the same content hash is reused, so a repeated launch of the
+        same template costs one HEAD request. Upload and URL use the region of the
+        bucket, which may differ from the region of the stack.
+        """
+        template_sha256 = hashlib.sha256(template_body.encode('utf8')).hexdigest()
+        if template_sha256 in self.staged_templates:
+            return self.staged_templates[template_sha256]
+        key = TEMPLATE_S3_PREFIX + template_sha256 + '.template'
+        bucket_region = self.bucket_region()
+        s3_conn = recorder.attach(get_client('s3', region=bucket_region, profile=self.profile))
+        try:
+            s3_conn.head_object(Bucket=self.s3_bucket, Key=key)
+            logger.info("Template already staged at s3://%s/%s", self.s3_bucket, key)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+                raise
+            s3_conn.put_object(Bucket=self.s3_bucket, Key=key, Body=template_body.encode('utf8'))
+            logger.info("Template staged at s3://%s/%s", self.s3_bucket, key)
+        url = "https://{0}.s3.{1}.amazonaws.com/{2}".format(self.s3_bucket, bucket_region, key)
+        self.staged_templates[template_sha256] = url
+        return url
+
+    def template_source(self, template_body):
+        """TemplateBody for templates within the inline limit, TemplateURL of the staged copy otherwise."""
+        if len(template_body.encode('utf8')) <= TEMPLATE_BODY_LIMIT or not self.s3_bucket:
+            return {"TemplateBody": template_body}
+        return {"TemplateURL": self.stage_template(template_body)}
+
+    def validate_template_body(self, template_body, cfn_template=""):
+        """validate_template through the content-addressed cache in the stack store.
+
+        Returns (result, cached). Only successful validations are cached, so an
+        invalid template is re-checked once it is fixed. Raises ClientError.
+        """
+        template_sha256 = hashlib.sha256(template_body.encode('utf8')).hexdigest()
+        result = self.stack_store.get_validation(template_sha256)
+        if result is not None:
+            logger.info("%s validation served from cache (%s)", cfn_template, template_sha256)
+            return result, True
+        result = self.cfn_conn.validate_template(**self.template_source(template_body))
+        result.pop('ResponseMetadata', None)
+        self.stack_store.put_validation(template_sha256, cfn_template, result)
+        return result, False
+
+    def compact_template(self, cfn_template):
+        """Compacted body of cfn_template, see cfn_templates.compact_body."""
+        template_body, report = templates.compact(cfn_template, self.dedupe_strings)
+        logger.info("%s compacted: %s", cfn_template, report)
+        return template_body
+
+    def load_template(self, cfn_template):
+        """Read (and with compact, compact) and validate cfn_template. Returns (template_body, validate_template result)."""
+        try:
+            template_body = self.compact_template(cfn_template) if self.compact else self.read_template(cfn_template)
+            result, cached = self.validate_template_body(template_body, cfn_template)
+        except (IOError, OSError, ValueError, botocore.exceptions.ClientError) as e:
+            raise TemplateError(': '.join([cfn_template,str(e)]))
+        return template_body, result
+
+    def _validate_file(self, cfn_template):
+        try:
+            template_body = self.read_template(cfn_template)
+            result, cached = self.validate_template_body(template_body, cfn_template)
+            return [os.path.basename(cfn_template), len(template_body), "CACHED" if cached else "VALID",
+                len(result.get('Parameters', [])), ",".join(result.get('Capabilities', []))]
         except Exception as e:
-            sys.exit(': '.join([self.cfn_template,str(e)]))
-        
+            return [os.path.basename(cfn_template), os.path.getsize(cfn_template), "INVALID", "", str(e)]
+
+    @log()
+    def validate_templates(self, cfn_dir):
+        """Validate every template under cfn_dir concurrently.
+
+        Returns one row per template: [file, bytes, VALID|CACHED|INVALID, parameter count, capabilities or error].
+        """
+        paths = sorted(os.path.join(cfn_dir, f) for f in os.listdir(cfn_dir)
+            if os.path.splitext(f)[1] in TEMPLATE_EXTENSIONS and f not in NON_TEMPLATE_FILES and not f.startswith('.'))
+        if not paths:
+            return []
+        with ThreadPoolExecutor(max_workers=min(QUERY_MAX_WORKERS, len(paths))) as pool:
+            rows = list(pool.map(self._validate_file, paths))
+        logger.info("""Validate cloudformation templates finished. %s templates, %s invalid.""", len(rows),
+            len([r for r in rows if r[2] == "INVALID"]))
+        return rows
+
+
+class MultiRegionCfnClient(object):
+    """Run CfnClient operations in several regions at once, one CfnClient per region.
+
+    Regions are worked on concurrently, so an operation takes as long as the slowest
+    region. Results of all regions are merged into the result types of CfnClient.
+    A stack ARN is routed to its own region. Prompts of the confirm policy are
+    serialized so that interactive questions of different regions do not interleave.
+    Errors of single regions are logged and kept in region_errors.
+    """
+    def __init__(self, cfn_dir, regions, s3_bucket=TEMPLATE_S3_BUCKET, profile=None, local_ip=None, offline=False,
+            confirm=never_confirm, compact=False, dedupe_strings=False):
+        self.regions = list(regions)
+        self.local_ip = local_ip
+        self.offline = offline
+        self.confirm_lock = threading.Lock()
+        self.confirm = confirm
+        self.region_errors = []
+        self.clients = OrderedDict((region, CfnClient(cfn_dir, region=region, s3_bucket=s3_bucket, profile=profile,
+            local_ip=local_ip, offline=offline, confirm=self._serial_confirm, compact=compact, dedupe_strings=dedupe_strings))
+            for region in self.regions)
+
+    def _serial_confirm(self, prompt):
+        with self.confirm_lock:
+            return self.confirm(prompt)
+
+    def _fan_out(self, func, regions=None):
+        """Call func(region, client) in every region concurrently. Returns OrderedDict{region: result}."""
+        regions = self.regions if regions is None else regions
+        results = OrderedDict()
+        self.region_errors = []
+        if not regions:
+            return results
+        with ThreadPoolExecutor(max_workers=min(REGION_MAX_WORKERS, len(regions))) as pool:
+            futures = [(region, pool.submit(func, region, self.clients[region])) for region in regions]
+            for region, future in futures:
+                try:
+                    results[region] = future.result()
+                except (CfnError, botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+                    logger.error("%s error. %s", region, e)
+                    self.region_errors.append((region, str(e)))
+        if not results and self.region_errors:
+            raise StackOperationError("All regions failed. {0}".format(self.region_errors[-1][1]))
+        return results
+
+    def _group_by_region(self, stack_id_list):
+        """{region: [stack_id]} for stack_id_list. Stack names are looked up in every region."""
+        grouped = OrderedDict()
+        for stack_id in stack_id_list:
+            region = stack_region(stack_id)
+            for r in ([region] if region in self.clients else [] if region else self.regions):
+                grouped.setdefault(r, []).append(stack_id)
+        return grouped
+
+    def client_for(self, stack_id):
+        region = stack_region(stack_id)
+        if region in self.clients:
+            return self.clients[region]
+        if len(self.regions) == 1:
+            return self.clients[self.regions[0]]
+        raise StackNotFoundError("Stack {0}: pass a stack id to pick one of {1} regions.".format(stack_id, len(self.regions)))
+
+    def _resolve_local_ip(self):
+        # look the ip up once instead of once per region
+        if not self.local_ip:
+            self.local_ip = resolve_public_ip(offline=self.offline)
+            for client in self.clients.values():
+                client.local_ip = self.local_ip
+
+    def describe_stacks(self, stack_id_list=None, connect=False):
+        if stack_id_list is None:
+            results = self._fan_out(lambda region, client: client.describe_stacks(None, connect))
+        else:
+            grouped = self._group_by_region(stack_id_list)
+            results = self._fan_out(lambda region, client: client.describe_stacks(grouped[region], connect), list(grouped))
+        merged = OrderedDict()
+        for stacks in results.values():
+            merged.update(stacks)
+        return merged
+
+    def create_stacks(self, cfn_template, stack_name, count=1, param_matrix=None):
+        """Create the stacks in every region. count=1 without param_matrix creates stack_name itself."""
+        self._resolve_local_ip()
+        def create(region, client):
+            if count != 1 or param_matrix is not None:
+                return client.create_stacks(cfn_template, stack_name, count, param_matrix)
+            return BatchCreateResult([client.create_stack(cfn_template, stack_name)], [])
+        results = self._fan_out(create)
+        created, failed = [], []
+        for result in results.values():
+            created += result.created
+            failed += result.failed
+        failed += [("{0} {1}".format(region, stack_name), error) for region, error in self.region_errors]
+        return BatchCreateResult(created, failed)
+
+    def delete_stacks(self, stack_id_list=None):
+        if stack_id_list is None:
+            results = self._fan_out(lambda region, client: client.delete_stacks(None))
+        else:
+            grouped = self._group_by_region(stack_id_list)
+            def delete(region, client):
+                # a stack name only exists in some of the regions
+                try:
+                    return client.delete_stacks(grouped[region])
+                except StackNotFoundError:
+                    return DeleteResult([], [], [])
+            results = self._fan_out(delete, list(grouped))
+        deleted, declined, failed = [], [], []
+        for result in results.values():
+            deleted += result.deleted
+            declined += result.declined
+            failed += result.failed
+        failed += self.region_errors
+        if stack_id_list is not None and not (deleted or declined or failed):
+            raise StackNotFoundError("Stack {0} can not be found or already DELETE_COMPLETE.".format(", ".join(stack_id_list)))
+        return DeleteResult(deleted, declined, failed)
+
+    def detect_drift(self, stack_id_list=None, max_age=DRIFT_MAX_AGE, timeout=DRIFT_TIMEOUT):
+        if stack_id_list is None:
+            results = self._fan_out(lambda region, client: client.detect_drift(None, max_age, timeout))
+        else:
+            grouped = self._group_by_region(stack_id_list)
+            def detect(region, client):
+                # a stack name only exists in some of the regions
+                try:
+                    return client.detect_drift(grouped[region], max_age, timeout)
+                except StackNotFoundError:
+                    return OrderedDict()
+            results = self._fan_out(detect, list(grouped))
+        merged = OrderedDict()
+        for drifts in results.values():
+            merged.update(drifts)
+        return merged
+
+    def delete_selection(self, name_glob=None, statuses=None, older_than=None, timeout=DELETE_TIMEOUT):
+        """Select in every region, confirm the whole selection once, then delete all regions concurrently."""
+        selected = self._fan_out(lambda region, client: client.select_stacks(name_glob, statuses, older_than))
+        stacks = list(itertools.chain(*selected.values()))
+        if not stacks:
+            raise StackNotFoundError("No stack matches the selection.")
+        if not self.confirm("{0}\nAre you sure you want to delete these {1} stacks (y or n)?\n".format(
+                "\n".join("{0} {1} {2}".format(s.region, s.stack_name, s.stack_status) for s in stacks), len(stacks))):
+            raise OperationAborted("Bulk delete aborted.")
+        results = self._fan_out(lambda region, client: client.bulk_delete_stacks(selected[region], timeout), list(selected))
+        deleted, failed, pending = [], [], []
+        for result in results.values():
+            deleted += result.deleted
+            failed += result.failed
+            pending += result.pending
+        return BulkDeleteResult(deleted, failed, pending)
+
+    def inventory(self, name_glob=None, prefix=None, statuses=None, created_before=None, max_age=INVENTORY_MAX_AGE):
+        results = self._fan_out(lambda region, client: client.inventory(name_glob, prefix, statuses, created_before, max_age))
+        return sorted(itertools.chain(*results.values()), key=lambda s: s.creation_time)
+
+    def wait_stacks(self, stack_id_list=None, on_event=None, since=None):
+        if stack_id_list is None:
+            results = self._fan_out(lambda region, client: client.wait_stacks(None, on_event))
+        else:
+            grouped = self._group_by_region(stack_id_list)
+            results = self._fan_out(lambda region, client: client.wait_stacks(grouped[region], on_event, since), list(grouped))
+        final_events, failed = {}, []
+        for result in results.values():
+            final_events.update(result.final_events)
+            failed += result.failed
+        return WaitResult(final_events, failed)
+
+
+
+def print_stack_event(event):
+    print(" ".join([str(event['Timestamp']), event['StackName'], event['LogicalResourceId'],
+        event['ResourceType'], event['ResourceStatus'], event.get('ResourceStatusReason', '')]))
+
+def print_table(header, rows):
+    widths = [max(len(str(r[i])) for r in rows+[header]) for i in range(len(header)-1)]
+    for row in [header]+rows:
+        print("  ".join(str(c).ljust(w) for c,w in zip(row, widths)) + "  " + str(row[-1]))
+
+
+# CLI wrappers over CfnClient: print results and exit with a status message
+def run_create(cfn_client, cfn_template, stack_name, count=1, param_matrix=None, wait=False):
+    if count != 1 or param_matrix is not None or isinstance(cfn_client, MultiRegionCfnClient):
+        result = cfn_client.create_stacks(cfn_template, stack_name, count, param_matrix)
+        for stack in result.created:
+            print(stack.stack_name, stack.stack_id)
+        for name, error in result.failed:
+            print(name, "CREATE_FAILED", error)
+        if wait and result.created:
+            run_wait(cfn_client, [s.stack_id for s in result.created])
+        sys.exit("{0} of {1} stack creations initiated. Exit now!".format(len(result.created), len(result.created)+len(result.failed)))
+
+    stack = cfn_client.create_stack(cfn_template, stack_name)
+    print(stack.stack_id)
+    if wait:
+        run_wait(cfn_client, [stack.stack_id])
+    sys.exit("Stack creation initiated. Exit now!")
+
+def run_update(cfn_client, cfn_template, stack_id, wait=False):
+    if not stack_id:
+        sys.exit("Stack update needs a stack id (-i) or name (-n). Exit now!")
+    if isinstance(cfn_client, MultiRegionCfnClient):
+        cfn_client = cfn_client.client_for(stack_id)
+    update = cfn_client.plan_update(cfn_template, stack_id)
+    if not update.changes:
+        sys.exit("Stack {0} is up to date. No update needed. Exit now!".format(update.stack_name))
+
+    print("Change set {0} for stack {1}:".format(update.change_set_name, update.stack_name))
+    for c in update.changes:
+        print("  {0:<8} {1:<40} {2:<30} Replacement: {3}  Scope: {4}".format(c['Action'], c['LogicalResourceId'],
+            c['ResourceType'], c.get('Replacement', '-'), ",".join(c.get('Scope', []))))
+    if not cfn_client.confirm("Are you sure you want to execute change set {0} (y or n)?\n".format(update.change_set_name)):
+        cfn_client.discard_update(update)
+        sys.exit("Stack update aborted. Exit now!")
+    update = cfn_client.execute_update(update)
+    if wait:
+        run_wait(cfn_client, [update.stack_id], since={update.stack_id: update.start_event_id})
+    sys.exit("Stack update initiated. Exit now!")
+
+def run_describe(cfn_client, stack_id=""):
+    stacks = cfn_client.describe_stacks([stack_id] if stack_id else None, connect=True)
+    if isinstance(cfn_client, MultiRegionCfnClient):
+        # one table over all regions
+        if stacks:
+            print_table(["Region", "Stack Name", "Status", "Outputs", "Instances", "Stack Id"], [[stack_region(s.stack_id), s.stack_name,
+                s.stack_status, " ".join("{0}={1}".format(k,v) for k,v in sorted(s.stack_output.items())) or "-",
+                " ".join("{0}={1}".format(k, v['PublicIpAddress'] or v['PrivateIpAddress']) for k,v in sorted(s.stack_instances.items())) or "-",
+                s.stack_id] for s in stacks.values()])
+        for region, error in cfn_client.region_errors:
+            print(region, "ERROR", error)
+    else:
+        for stack in stacks.values():
+            print(stack.stack_id)
+            logger.debug("%s", stack)
+            print("Stack Status: "+stack.stack_status)
+            for k,v in sorted(stack.stack_output.items()):
+                print(': '.join([k,v]))
+            for k,v in sorted(stack.stack_instances.items()):
+                print("{0}: {1} {2} public {3} private {4}".format(k, v['InstanceId'], v['State'], v['PublicIpAddress'] or '-',
+                    v['PrivateIpAddress'] or '-'))
+
+    if not stacks:
+        logger.info("""Describe cloudformation stack finished. \nNo cloudformatation stack can be found. Exit now!""")
+        sys.exit("No cloudformatation stack can be found. Exit now!")
+    logger.info("""Describe cloudformation stack finished. """)
+    sys.exit("""Describe cloudformation stack finished. """)
+
+def run_delete(cfn_client, stack_id=""):
+    result = cfn_client.delete_stacks([stack_id] if stack_id else None)
+    for stack in result.deleted:
+        print(stack.stack_id, stack.stack_status)
+        if platform.system() == 'Windows':
+            try:
+                XshellAccess.delete(stack.stack_name)
+            except:
+                pass
+    for failed_id, error in result.failed:
+        print(failed_id, "DELETE_FAILED", error)
+    if not (result.deleted or result.declined or result.failed):
+        sys.exit("No cloudformatation stack created by {0} is in the system. Exit now!".format(sys.argv[0]))
+    if result.deleted:
+        sys.exit("Stack deleting initiated. Exit now!")
+    sys.exit("Stack deleting aborted. Exit now!")
+
+def run_bulk_delete(cfn_client, name_glob=None, statuses=None, older_than=None):
+    result = cfn_client.delete_selection(name_glob, statuses, older_than)
+    rows = [[s.region, s.stack_name, "DELETE_COMPLETE", "{0:.0f}".format(seconds), ""] for s, seconds in result.deleted]
+    rows += [[s.region, s.stack_name, "DELETE_FAILED", "-", reason] for s, reason in result.failed]
+    rows += [[s.region, s.stack_name, "DELETE_IN_PROGRESS", "-", "still deleting at timeout"] for s in result.pending]
+    print_table(["Region", "Stack Name", "Result", "Seconds", "Reason"], rows)
+    if platform.system() == 'Windows':
+        for stack, seconds in result.deleted:
+            try:
+                XshellAccess.delete(stack.stack_name)
+            except:
+                pass
+    if result.failed or result.pending:
+        sys.exit("{0} stacks deleted, {1} failed, {2} still deleting. Exit now!".format(len(result.deleted), len(result.failed),
+            len(result.pending)))
+    sys.exit("All {0} stacks deleted. Exit now!".format(len(result.deleted)))
+
+def run_drift(cfn_client, stack_id="", refresh=False):
+    drifts = cfn_client.detect_drift([stack_id] if stack_id else None, max_age=0 if refresh else DRIFT_MAX_AGE)
+    if not drifts:
+        sys.exit("No cloudformatation stack to check for drift. Exit now!")
+    print_table(["Stack Name", "Drift", "Detection", "Checked", "Drifted Resources / Detail"], [[d.stack_name, d.drift_status,
+        d.detection_status, datetime.datetime.fromtimestamp(d.checked_at).strftime("%Y-%m-%d %H:%M:%S") + (" (cached)" if d.cached else ""),
+        " ".join(r['LogicalResourceId'] for r in d.resources) or d.detail or "-"] for d in drifts.values()])
+    for d in drifts.values():
+        for r in d.resources:
+            print("{0} {1} {2} {3}".format(d.stack_name, r['LogicalResourceId'], r['ResourceType'], r['StackResourceDriftStatus']))
+            for diff in r['PropertyDifferences']:
+                print("    {0} {1}: expected {2} actual {3}".format(diff['DifferenceType'], diff['PropertyPath'],
+                    diff.get('ExpectedValue'), diff.get('ActualValue')))
+    drifted = [d.stack_name for d in drifts.values() if d.drift_status == 'DRIFTED']
+    if drifted:
+        sys.exit("Drifted stacks: {0}. Exit now!".format(", ".join(drifted)))
+    sys.exit("No drift detected on {0} stacks. Exit now!".format(len(drifts)))
+
+def run_wait(cfn_client, stack_id_list=None, since=None):
+    result = cfn_client.wait_stacks(stack_id_list, on_event=print_stack_event, since=since)
+    if not result.final_events:
+        sys.exit("No cloudformatation stack in progress. Exit now!")
+    if result.failed:
+        sys.exit("Stack operation failed: {0}. Exit now!".format(", ".join(result.failed)))
+    sys.exit("Stack operation finished. Exit now!")
+
+def run_inventory(cfn_client, name_glob=None, statuses=None, refresh=False):
+    stacks = cfn_client.inventory(name_glob=name_glob, statuses=statuses, max_age=0 if refresh else INVENTORY_MAX_AGE)
+    fmt = lambda t: datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S") if t else "-"
+    if stacks:
+        print_table(["Region", "Stack Name", "Status", "Prefix", "Created", "Last Updated", "Stack Id"], [[s.region, s.stack_name,
+            s.stack_status, s.name_prefix, fmt(s.creation_time), fmt(s.last_updated_time), s.stack_id] for s in stacks])
+    for region, error in getattr(cfn_client, 'region_errors', []):
+        print(region, "ERROR", error)
+    sys.exit("{0} stacks in inventory match. Exit now!".format(len(stacks)))
+
+def run_validate_all(cfn_client, cfn_dir):
+    rows = cfn_client.validate_templates(cfn_dir)
+    if not rows:
+        sys.exit("No cloudformation template under {0}. Exit now!".format(cfn_dir))
+    print_table(["Template", "Bytes", "Result", "Parameters", "Capabilities / Error"], rows)
+    invalid = [r[0] for r in rows if r[2] == "INVALID"]
+    if invalid:
+        sys.exit("Invalid templates: {0}. Exit now!".format(", ".join(invalid)))
+    sys.exit("All {0} templates valid. Exit now!".format(len(rows)))
+
+def run_convert(cfn_dir, fmt, force=False):
+    start = time.time()
+    rows = convert_dir(cfn_dir, fmt, force)
+    if not rows:
+        sys.exit("No template to convert under {0}. Exit now!".format(cfn_dir))
+    print_table(["Source", "Target", "Result"],
+        [[os.path.basename(src), os.path.basename(dst), "CONVERTED" if done else "UP TO DATE"] for src, dst, done in rows])
+    logger.info("Converted %d of %d templates in %.2fs", sum(1 for r in rows if r[2]), len(rows), time.time() - start)
+
 
 
 if __name__ == '__main__':
@@ -419,37 +1585,138 @@ if __name__ == '__main__':
         help='Cloudformation parameter file. default: cfn-parameter.json',
         default='cfn-parameter.json', action='store')
     parser.add_argument('-r', '--region', dest='region',          
-        help='Cloudformation parameter file. default: ap-southeast-2',
-        default="ap-southeast-2", action='store')
+        help='AWS region, comma separated regions or all. Several regions are worked on concurrently. default: ap-southeast-2',
+        default=DEFAULT_REGION, action='store')
+    parser.add_argument('--s3-bucket', dest='s3_bucket',
+        help='S3 bucket for staging templates larger than 51200 bytes. Default: {0}'.format(TEMPLATE_S3_BUCKET),
+        default=TEMPLATE_S3_BUCKET, action='store')
+    parser.add_argument('--profile', dest='profile',
+        help='AWS credentials profile. Default: default credential chain',
+        default=None, action='store')
+    parser.add_argument('--local-ip', dest='local_ip',
+        help='Public ip allowed to ssh (SSHLocation). Default: looked up online and cached for an hour',
+        default=None, action='store')
+    parser.add_argument('--offline', dest='offline',
+        help='Do not look up the public ip online, use the cached value.',
+        default=False, action='store_true')
     parser.add_argument('-m', '--mode', dest='mode',          
-        help='Cloudformation management mode. Available options: create, delete, describe.',
+        help='Cloudformation management mode. Available options: create, update, delete, bulk-delete, describe, wait, drift, validate-all, inventory, convert.',
         default="describe", action='store')
+    parser.add_argument('-c', '--count', dest='count', type=int,
+        help='Number of stacks to create from the template (per parameter set of --param-matrix). Default: 1',
+        default=1, action='store')
+    parser.add_argument('--param-matrix', dest='param_matrix',
+        help='JSON file with stack parameters for batch create. {"Key": [values]} creates every combination, [{"Key": value}] one stack per entry.',
+        default='', action='store')
+    parser.add_argument('-w', '--wait', dest='wait',
+        help='Follow stack events after create until the stack completes or fails.',
+        default=False, action='store_true')
+    parser.add_argument('--filter', dest='name_glob',
+        help='Inventory, bulk-delete: stack name pattern, e.g. "AnsibleTest-*".',
+        default=None, action='store')
+    parser.add_argument('--status', dest='statuses',
+        help='Inventory, bulk-delete: comma separated stack statuses, e.g. CREATE_COMPLETE,ROLLBACK_COMPLETE.',
+        default='', action='store')
+    parser.add_argument('--older-than', dest='older_than', type=float,
+        help='Bulk-delete: only stacks created more than this many hours ago.',
+        default=None, action='store')
+    parser.add_argument('--refresh', dest='refresh',
+        help='Inventory, drift: query AWS again even if the local result is recent.',
+        default=False, action='store_true')
+    parser.add_argument('--compact', dest='compact',
+        help='Create, update: submit the template as minified JSON without descriptions.',
+        default=False, action='store_true')
+    parser.add_argument('--dedupe-strings', dest='dedupe_strings',
+        help='With --compact: move repeated long strings into a Mapping read with Fn::FindInMap.',
+        default=False, action='store_true')
+    parser.add_argument('--to', dest='convert_to',
+        help='Convert: target format, json or yaml. Default: json',
+        default='json', action='store')
+    parser.add_argument('--force', dest='force',
+        help='Convert: rewrite targets that are newer than their source.',
+        default=False, action='store_true')
+    parser.add_argument('--timings', dest='timings',
+        help='Print wall time, retries and response size per AWS call and method at exit.',
+        default=False, action='store_true')
+    parser.add_argument('--prom-file', dest='prom_file',
+        help='Also write call timings to this Prometheus textfile at exit.',
+        default='', action='store')
     parser.add_argument('-l', '--log-level', dest='log_level',          
         help='Availalbe log_level: debug, info, warning, error, critical.',
         default="info", action='store')
+    parser.add_argument('--log-json', dest='log_json',
+        help='Write cfn_launch.log as JSON lines.',
+        default=False, action='store_true')
     args = parser.parse_args()  
 
-    logger.info("""script start. \n{0}""".format(args))
+    sys.excepthook = exception_hook
+    set_up_logging('ConfigAnsibleLogger', os.path.join(log_dir(), 'cfn_launch.log'), args.log_level, json_lines=args.log_json or None)
 
+    logger.info("""script start. \n%s""", args)
 
-    # CREATE CfnClient INSTANCE
-    cfn_client = CfnClient(args.cfn_dir)
+    # every AWS call and decorated method goes to cfn_timings.jsonl next to the log file
+    recorder.configure(jsonl_file=os.path.join(log_dir(), 'cfn_timings.jsonl'), prom_file=args.prom_file)
+    if args.prom_file:
+        atexit.register(recorder.write_prometheus)
+    if args.timings:
+        atexit.register(recorder.print_summary)
 
-    # CREATE STACK
-    if args.mode == "create":
-        if args.stack_name:
-            stack_name = args.stack_name
-        else:
-            stack_name = '-'.join(re.findall("([0-9a-zA-Z]+)",args.cfn_template)[:-1]+[datetime.datetime.now().strftime("%Y%m%d%H%M%S")])
-        cfn_client.build_cfn(os.path.join(args.cfn_dir,args.cfn_template), stack_name)
+    # CONVERT TEMPLATES, local only
+    if args.mode == "convert":
+        run_convert(args.cfn_dir, args.convert_to, args.force)
+        sys.exit(0)
 
-    elif args.mode == "describe":
-        cfn_client.describe_cfn(args.stack_id)
+    # CREATE CfnClient INSTANCE, one per region when several regions are given
+    regions = resolve_regions(args.region, args.profile)
+    if len(regions) == 1:
+        cfn_client = CfnClient(args.cfn_dir, region=regions[0], s3_bucket=args.s3_bucket, profile=args.profile, local_ip=args.local_ip,
+            offline=args.offline, confirm=interactive_confirm, compact=args.compact, dedupe_strings=args.dedupe_strings)
+    else:
+        cfn_client = MultiRegionCfnClient(args.cfn_dir, regions, s3_bucket=args.s3_bucket, profile=args.profile, local_ip=args.local_ip,
+            offline=args.offline, confirm=interactive_confirm, compact=args.compact, dedupe_strings=args.dedupe_strings)
+
+    try:
+        # CREATE STACK
+        if args.mode == "create":
+            if args.stack_name:
+                stack_name = args.stack_name
+            else:
+                stack_name = '-'.join(re.findall("([0-9a-zA-Z]+)",args.cfn_template)[:-1]+[datetime.datetime.now().strftime("%Y%m%d%H%M%S")])
+            param_matrix = None
+            if args.param_matrix:
+                with open(args.param_matrix) as fh:
+                    param_matrix = json.load(fh)
+            run_create(cfn_client, os.path.join(args.cfn_dir,args.cfn_template), stack_name, args.count, param_matrix, wait=args.wait)
 
-    elif args.mode == "delete":
-        cfn_client.delete_cfn(args.stack_id)
+        elif args.mode == "update":
+            run_update(cfn_client, os.path.join(args.cfn_dir,args.cfn_template), args.stack_id or args.stack_name, wait=args.wait)
 
-    else:
-        sys.exit("Not a valid mode option!")
+        elif args.mode == "describe":
+            run_describe(cfn_client, args.stack_id)
+
+        elif args.mode == "delete":
+            run_delete(cfn_client, args.stack_id)
+
+        elif args.mode == "wait":
+            run_wait(cfn_client, [args.stack_id] if args.stack_id else None)
 
+        elif args.mode == "bulk-delete":
+            run_bulk_delete(cfn_client, args.name_glob, [x.strip() for x in args.statuses.split(',') if x.strip()], args.older_than)
 
+        elif args.mode == "drift":
+            run_drift(cfn_client, args.stack_id, args.refresh)
+
+        elif args.mode == "inventory":
+            run_inventory(cfn_client, args.name_glob, [x.strip() for x in args.statuses.split(',') if x.strip()], args.refresh)
+
+        elif args.mode == "validate-all":
+            # templates validate the same in every region
+            if isinstance(cfn_client, MultiRegionCfnClient):
+                cfn_client = list(cfn_client.clients.values())[0]
+            run_validate_all(cfn_client, args.cfn_dir)
+
+        else:
+            sys.exit("Not a valid mode option!")
+    except CfnError as e:
+        logger.error(e)
+        sys.exit("{0} Exit now!".format(e))
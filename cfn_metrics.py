@@ -0,0 +1,178 @@
+#!/usr/bin/python
+# -*- coding:utf8 -*-
+
+"""
+Name: cfn_metrics.py
+
+Latency instrumentation for cfn_launch.py.
+
+Functions:
+1. CallRecorder hooks botocore events of a client and records wall time, retry count and
+   response size of every API call.
+2. Methods decorated with cfn_launch.log() are timed through the same recorder.
+3. Calls are aggregated per (kind, name) as they are recorded, and only the latest records are
+   kept in memory, so a long-lived process polling many stacks runs in constant memory.
+4. Records are appended to a JSON-lines file by a QueueListener thread, so callers never wait on
+   file I/O or on each other. A Prometheus textfile (node_exporter textfile collector format) and
+   a summary table can be written on demand, e.g. at exit.
+"""
+
+import os
+import json
+import time
+import queue
+import atexit
+import threading
+import logging
+import logging.handlers
+from collections import deque
+
+logger = logging.getLogger('ConfigAnsibleLogger')
+
+# records kept in memory for inspection, older ones only live in the aggregates and the JSON-lines file
+RECENT_RECORDS = 1000
+
+
+class CallRecorder(object):
+    def __init__(self, jsonl_file=None, prom_file=None, recent=RECENT_RECORDS):
+        self.jsonl_file = jsonl_file
+        self.prom_file = prom_file
+        self.records = deque(maxlen=recent)
+        self.aggregates = {}
+        self.lock = threading.Lock()
+        self.writes = None
+        self.listener = None
+
+    def configure(self, jsonl_file=None, prom_file=None):
+        if jsonl_file and jsonl_file != self.jsonl_file:
+            self.close()
+        self.jsonl_file = jsonl_file or self.jsonl_file
+        self.prom_file = prom_file or self.prom_file
+
+    def _start_writer(self):
+        """Queue and listener thread appending records to jsonl_file, started by the first record."""
+        handler = logging.FileHandler(self.jsonl_file, delay=True)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.writes = queue.Queue(-1)
+        self.listener = logging.handlers.QueueListener(self.writes, handler)
+        self.listener.start()
+        atexit.register(self.close)
+
+    def close(self):
+        """Write out queued records and stop the writer thread."""
+        with self.lock:
+            listener, self.listener, self.writes = self.listener, None, None
+        if listener is not None:
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+
+    def attach(self, client):
+        """Record every API call made through client. Safe to call more than once per client."""
+        events = client.meta.events
+        uid = "cfn-metrics-{0}".format(id(self))
+        events.register('before-call.*.*', self._before_call, unique_id=uid+'-before')
+        events.register('after-call.*.*', self._after_call, unique_id=uid+'-after')
+        events.register('after-call-error.*.*', self._after_call_error, unique_id=uid+'-error')
+        return client
+
+    # botocore hooks must never raise, an error in one would replace the outcome of the API call
+    def _before_call(self, model=None, context=None, **kw):
+        try:
+            context['cfn_metrics_start'] = time.time()
+            context['cfn_metrics_name'] = "{0}.{1}".format(model.service_model.service_name, model.name)
+        except Exception as e:
+            logger.debug("call timing not started. %s", e)
+
+    def _after_call(self, http_response=None, parsed=None, context=None, **kw):
+        try:
+            start = (context or {}).get('cfn_metrics_start')
+            if start is None:
+                return
+            self.record('api', context['cfn_metrics_name'], time.time() - start,
+                retries=(parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0),
+                bytes=len(getattr(http_response, 'content', None) or b''),
+                status=getattr(http_response, 'status_code', None))
+        except Exception as e:
+            logger.debug("call timing not recorded. %s", e)
+
+    def _after_call_error(self, exception=None, context=None, event_name='', **kw):
+        """Transport errors (connection, timeout): botocore passes only exception and context."""
+        try:
+            start = (context or {}).get('cfn_metrics_start')
+            if start is None:
+                return
+            # after-call-error.<service>.<Operation>
+            name = context.get('cfn_metrics_name') or ".".join(event_name.split('.')[1:]) or "unknown"
+            self.record('api', name, time.time() - start, retries=0, bytes=0, status=type(exception).__name__)
+        except Exception as e:
+            logger.debug("call timing not recorded. %s", e)
+
+    def record(self, kind, name, elapsed, **extra):
+        entry = dict(ts=time.time(), kind=kind, name=name, elapsed=round(elapsed, 6), **extra)
+        with self.lock:
+            self.records.append(entry)
+            row = self.aggregates.get((kind, name))
+            if row is None:
+                row = self.aggregates[(kind, name)] = {'kind': kind, 'name': name, 'calls': 0,
+                    'total': 0.0, 'max': 0.0, 'retries': 0, 'bytes': 0}
+            row['calls'] += 1
+            row['total'] += entry['elapsed']
+            row['max'] = max(row['max'], entry['elapsed'])
+            row['retries'] += extra.get('retries', 0)
+            row['bytes'] += extra.get('bytes', 0)
+            if self.jsonl_file and self.writes is None:
+                self._start_writer()
+            writes = self.writes
+        if writes is not None:
+            writes.put_nowait(logging.makeLogRecord({'msg': json.dumps(entry), 'levelno': logging.INFO}))
+
+    def summary(self):
+        """Aggregates by (kind, name): calls, total/max seconds, retries, bytes."""
+        with self.lock:
+            rows = [dict(row) for row in self.aggregates.values()]
+        return sorted(rows, key=lambda x: -x['total'])
+
+    def call_counts(self, kind='api'):
+        """{name: calls} of kind so far. The difference of two snapshots counts the calls in between."""
+        with self.lock:
+            return {name: row['calls'] for (k, name), row in self.aggregates.items() if k == kind}
+
+    def print_summary(self):
+        rows = self.summary()
+        if not rows:
+            return
+        print("{0:<7} {1:<45} {2:>6} {3:>9} {4:>9} {5:>9} {6:>8} {7:>10}".format(
+            "Kind", "Name", "Calls", "Total(s)", "Mean(s)", "Max(s)", "Retries", "Bytes"))
+        for row in rows:
+            print("{0:<7} {1:<45} {2:>6} {3:>9.3f} {4:>9.3f} {5:>9.3f} {6:>8} {7:>10}".format(row['kind'], row['name'],
+                row['calls'], row['total'], row['total']/row['calls'], row['max'], row['retries'], row['bytes']))
+
+    def write_prometheus(self, prom_file=None):
+        """Write the summary as a Prometheus textfile, atomically."""
+        prom_file = prom_file or self.prom_file
+        if not prom_file:
+            return
+        lines = [
+            "# HELP cfn_launch_calls_total Calls made by cfn_launch.py.",
+            "# TYPE cfn_launch_calls_total counter",
+            "# HELP cfn_launch_call_seconds_total Wall time spent in calls.",
+            "# TYPE cfn_launch_call_seconds_total counter",
+            "# HELP cfn_launch_call_retries_total botocore retries of API calls.",
+            "# TYPE cfn_launch_call_retries_total counter",
+            "# HELP cfn_launch_response_bytes_total Response bytes of API calls.",
+            "# TYPE cfn_launch_response_bytes_total counter",
+        ]
+        for row in self.summary():
+            labels = 'kind="{0}",name="{1}"'.format(row['kind'], row['name'])
+            lines.append("cfn_launch_calls_total{{{0}}} {1}".format(labels, row['calls']))
+            lines.append("cfn_launch_call_seconds_total{{{0}}} {1:.6f}".format(labels, row['total']))
+            if row['kind'] == 'api':
+                lines.append("cfn_launch_call_retries_total{{{0}}} {1}".format(labels, row['retries']))
+                lines.append("cfn_launch_response_bytes_total{{{0}}} {1}".format(labels, row['bytes']))
+        with open(prom_file + '.tmp', 'w') as fh:
+            fh.write("\n".join(lines) + "\n")
+        os.replace(prom_file + '.tmp', prom_file)
+
+
+recorder = CallRecorder()
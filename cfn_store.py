@@ -0,0 +1,310 @@
+#!/usr/bin/python
+# -*- coding:utf8 -*-
+
+"""
+Name: cfn_store.py
+
+Local stack state store for cfn_launch.py, replacing the cfn-StackInfo.json rewrite.
+
+Functions:
+1. sqlite database keyed by stack id with status, outputs, parameters, region and last refresh time.
+2. Incremental upserts in one transaction per write. WAL journal and busy timeout so that
+   concurrent cfn_launch.py invocations serialize their writes instead of clobbering the file.
+3. Per-status freshness policy: stacks in a stable status are served locally, stacks in
+   progress are always refreshed from the API.
+4. One-off import of a legacy cfn-StackInfo.json.
+5. validate_template results keyed by the SHA-256 of the template body.
+6. Region-wide inventory of list_stacks summaries, indexed by name, status, creation time and
+   name prefix, so filtered queries do not list the region again.
+7. Drift detection results per stack, with the drifted resources, reused within DRIFT_MAX_AGE.
+"""
+
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+from contextlib import closing
+
+logger = logging.getLogger('ConfigAnsibleLogger')
+
+
+# seconds a stored status stays fresh. None: never refreshed again.
+STATUS_MAX_AGE = {
+    "DELETE_COMPLETE": None,
+    "CREATE_COMPLETE": 600,
+    "UPDATE_COMPLETE": 600,
+    "IMPORT_COMPLETE": 600,
+    "ROLLBACK_COMPLETE": 3600,
+    "UPDATE_ROLLBACK_COMPLETE": 3600,
+    "IMPORT_ROLLBACK_COMPLETE": 3600,
+}
+# *_FAILED statuses only change through a user action, treat them as stable
+FAILED_MAX_AGE = 3600
+# anything else (*_IN_PROGRESS) always hits the API
+DEFAULT_MAX_AGE = 0
+
+# seconds a drift detection result is reused
+DRIFT_MAX_AGE = 1800
+
+# stack names end with the creation timestamp, batch created stacks with -<n> on top (-n batch -c 3 gives
+# batch-1, batch-2, batch-3 without a timestamp)
+STACK_NAME_SUFFIX = re.compile(r'-\d{14}(-\d+)?$|-\d+$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stacks (
+    stack_id TEXT PRIMARY KEY,
+    stack_name TEXT NOT NULL,
+    region TEXT,
+    stack_status TEXT NOT NULL,
+    stack_parameters TEXT,
+    stack_output TEXT,
+    refreshed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stacks_status ON stacks (stack_status);
+CREATE INDEX IF NOT EXISTS stacks_name ON stacks (stack_name);
+CREATE TABLE IF NOT EXISTS inventory (
+    stack_id TEXT PRIMARY KEY,
+    stack_name TEXT NOT NULL,
+    region TEXT NOT NULL,
+    stack_status TEXT NOT NULL,
+    name_prefix TEXT NOT NULL,
+    creation_time REAL NOT NULL,
+    last_updated_time REAL,
+    listed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS inventory_prefix ON inventory (region, name_prefix, stack_status);
+CREATE INDEX IF NOT EXISTS inventory_status ON inventory (region, stack_status, creation_time);
+CREATE INDEX IF NOT EXISTS inventory_name ON inventory (stack_name);
+CREATE TABLE IF NOT EXISTS inventory_sync (
+    region TEXT PRIMARY KEY,
+    synced_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS drift (
+    stack_id TEXT PRIMARY KEY,
+    stack_name TEXT NOT NULL,
+    drift_status TEXT NOT NULL,
+    detection_status TEXT,
+    detail TEXT,
+    resources TEXT,
+    checked_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS validations (
+    template_sha256 TEXT PRIMARY KEY,
+    template_file TEXT,
+    result TEXT NOT NULL,
+    validated_at REAL NOT NULL
+);
+"""
+
+
+def stack_name_prefix(stack_name):
+    """Template derived part of a stack name: cfn-ansible-test-20190307101010-2 -> cfn-ansible-test, batch-2 -> batch."""
+    return STACK_NAME_SUFFIX.sub('', stack_name)
+
+def status_max_age(stack_status):
+    if stack_status in STATUS_MAX_AGE:
+        return STATUS_MAX_AGE[stack_status]
+    if stack_status.endswith('_FAILED'):
+        return FAILED_MAX_AGE
+    return DEFAULT_MAX_AGE
+
+
+class StackStore(object):
+    def __init__(self, db_file, legacy_json=None, timeout=30):
+        self.db_file = db_file
+        self.timeout = timeout
+        is_new = not os.path.exists(db_file)
+        with closing(self.connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+        if is_new and legacy_json and os.path.exists(legacy_json):
+            self.import_json(legacy_json)
+
+    def connect(self):
+        # isolation_level=None: transactions are opened explicitly with BEGIN IMMEDIATE
+        conn = sqlite3.connect(self.db_file, timeout=self.timeout, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def import_json(self, json_file):
+        """Import a legacy cfn-StackInfo.json. Imported rows are stale and refresh on first use."""
+        try:
+            with open(json_file) as fh:
+                stack_info_dict = json.load(fh)
+        except Exception as e:
+            logger.error("%s loading error. %s", json_file, e)
+            return
+        self.upsert(stack_info_dict, refreshed_at=0)
+        logger.info("Imported %s stacks from %s", len(stack_info_dict), json_file)
+
+    @staticmethod
+    def _row_to_info(row):
+        stack_info = {
+            "stack_name": row["stack_name"],
+            "stack_status": row["stack_status"],
+            "stack_parameters": json.loads(row["stack_parameters"] or "[]")
+        }
+        if row["stack_output"]:
+            stack_info["stack_output"] = json.loads(row["stack_output"])
+        return stack_info
+
+    def upsert(self, stack_info_dict, region=None, refreshed_at=None):
+        """Insert or update {stack_id: stack_info} rows in a single transaction."""
+        if not stack_info_dict:
+            return
+        refreshed_at = time.time() if refreshed_at is None else refreshed_at
+        rows = [(stack_id, v["stack_name"], region, v["stack_status"], json.dumps(v.get("stack_parameters", [])),
+                json.dumps(v["stack_output"]) if v.get("stack_output") else None, refreshed_at)
+            for stack_id, v in stack_info_dict.items()]
+        with closing(self.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("""INSERT INTO stacks (stack_id, stack_name, region, stack_status, stack_parameters, stack_output, refreshed_at)
+                    VALUES (?, ?, COALESCE(?, ''), ?, ?, ?, ?)
+                    ON CONFLICT(stack_id) DO UPDATE SET stack_name=excluded.stack_name,
+                        region=COALESCE(NULLIF(excluded.region, ''), stacks.region), stack_status=excluded.stack_status,
+                        stack_parameters=excluded.stack_parameters, stack_output=excluded.stack_output,
+                        refreshed_at=excluded.refreshed_at""", rows)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def get(self, stack_id_list=None, include_deleted=False, region=None):
+        """Return {stack_id: stack_info} for stack_id_list, or for every tracked stack.
+
+        region limits the result to one region. Rows imported without a region are
+        matched on the region part of their stack ARN.
+        """
+        query = "SELECT * FROM stacks"
+        clauses, params = [], []
+        if region is not None:
+            clauses.append("(region = ? OR (region = '' AND stack_id LIKE ?))")
+            params.extend([region, "arn:%:cloudformation:{0}:%".format(region)])
+        if stack_id_list is not None:
+            stack_id_list = list(stack_id_list)
+            if not stack_id_list:
+                return {}
+            clauses.append("stack_id IN ({0})".format(",".join("?"*len(stack_id_list))))
+            params.extend(stack_id_list)
+        if not include_deleted:
+            clauses.append("stack_status != 'DELETE_COMPLETE'")
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        with closing(self.connect()) as conn:
+            rows = conn.execute(query + " ORDER BY rowid", params).fetchall()
+        return {row["stack_id"]: self._row_to_info(row) for row in rows}
+
+    def split_fresh(self, stack_id_list, now=None):
+        """Split stack_id_list into ({stack_id: stack_info} servable locally, [stack_id] to refresh)."""
+        now = time.time() if now is None else now
+        stack_id_list = list(stack_id_list)
+        if not stack_id_list:
+            return {}, []
+        with closing(self.connect()) as conn:
+            rows = conn.execute("SELECT * FROM stacks WHERE stack_id IN ({0})".format(",".join("?"*len(stack_id_list))),
+                stack_id_list).fetchall()
+        fresh = {}
+        for row in rows:
+            max_age = status_max_age(row["stack_status"])
+            if max_age is None or now - row["refreshed_at"] < max_age:
+                fresh[row["stack_id"]] = self._row_to_info(row)
+        return fresh, [stack_id for stack_id in stack_id_list if stack_id not in fresh]
+
+    def get_validation(self, template_sha256):
+        """Return the cached validate_template result of a template body, or None."""
+        with closing(self.connect()) as conn:
+            row = conn.execute("SELECT result FROM validations WHERE template_sha256 = ?", (template_sha256,)).fetchone()
+        return json.loads(row["result"]) if row else None
+
+    def put_validation(self, template_sha256, template_file, result):
+        with closing(self.connect()) as conn:
+            conn.execute("INSERT OR REPLACE INTO validations (template_sha256, template_file, result, validated_at) VALUES (?, ?, ?, ?)",
+                (template_sha256, template_file, json.dumps(result, default=str), time.time()))
+
+    def inventory_synced_at(self, region):
+        with closing(self.connect()) as conn:
+            row = conn.execute("SELECT synced_at FROM inventory_sync WHERE region = ?", (region,)).fetchone()
+        return row["synced_at"] if row else None
+
+    def sync_inventory(self, region, summaries, synced_at=None):
+        """Bring the inventory of region in line with a full list_stacks listing.
+
+        summaries: [(stack_id, stack_name, stack_status, creation_time, last_updated_time)].
+        Only rows whose status or last updated time changed are written, stacks missing
+        from the listing are dropped. Returns (changed, removed) counts.
+        """
+        synced_at = time.time() if synced_at is None else synced_at
+        with closing(self.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # rows stored with a prefix of an older stack_name_prefix are rewritten too
+                known = {row["stack_id"]: (row["stack_status"], row["last_updated_time"], row["name_prefix"]) for row in
+                    conn.execute("SELECT stack_id, stack_status, last_updated_time, name_prefix FROM inventory WHERE region = ?", (region,))}
+                rows = [(stack_id, stack_name, region, stack_status, stack_name_prefix(stack_name), creation_time,
+                        last_updated_time, synced_at)
+                    for stack_id, stack_name, stack_status, creation_time, last_updated_time in summaries
+                    if known.get(stack_id) != (stack_status, last_updated_time, stack_name_prefix(stack_name))]
+                conn.executemany("INSERT OR REPLACE INTO inventory (stack_id, stack_name, region, stack_status, name_prefix, "
+                    "creation_time, last_updated_time, listed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                removed = set(known) - set(summary[0] for summary in summaries)
+                conn.executemany("DELETE FROM inventory WHERE stack_id = ?", [(stack_id,) for stack_id in removed])
+                conn.execute("INSERT OR REPLACE INTO inventory_sync (region, synced_at) VALUES (?, ?)", (region, synced_at))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return len(rows), len(removed)
+
+    def query_inventory(self, region=None, name_glob=None, prefix=None, statuses=None, created_before=None):
+        """Filtered inventory rows, oldest first. name_glob is a shell style pattern, e.g. AnsibleTest-*."""
+        clauses, params = [], []
+        if region is not None:
+            clauses.append("region = ?")
+            params.append(region)
+        if name_glob:
+            clauses.append("stack_name GLOB ?")
+            params.append(name_glob)
+        if prefix:
+            clauses.append("name_prefix = ?")
+            params.append(prefix)
+        if statuses:
+            clauses.append("stack_status IN ({0})".format(",".join("?"*len(statuses))))
+            params.extend(statuses)
+        if created_before is not None:
+            clauses.append("creation_time < ?")
+            params.append(created_before)
+        query = "SELECT * FROM inventory"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        with closing(self.connect()) as conn:
+            return [dict(row) for row in conn.execute(query + " ORDER BY creation_time", params).fetchall()]
+
+    def get_drift(self, stack_id_list, max_age=DRIFT_MAX_AGE, now=None):
+        """Return {stack_id: drift row} of stack_id_list checked less than max_age seconds ago."""
+        now = time.time() if now is None else now
+        stack_id_list = list(stack_id_list)
+        if not stack_id_list or not max_age:
+            return {}
+        with closing(self.connect()) as conn:
+            rows = conn.execute("SELECT * FROM drift WHERE stack_id IN ({0}) AND checked_at > ?".format(",".join("?"*len(stack_id_list))),
+                stack_id_list + [now - max_age]).fetchall()
+        return {row["stack_id"]: dict(row, resources=json.loads(row["resources"] or "[]")) for row in rows}
+
+    def put_drift(self, drift_rows):
+        """Store [{stack_id, stack_name, drift_status, detection_status, detail, resources, checked_at}] in one transaction."""
+        if not drift_rows:
+            return
+        with closing(self.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("INSERT OR REPLACE INTO drift (stack_id, stack_name, drift_status, detection_status, detail, "
+                    "resources, checked_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(r["stack_id"], r["stack_name"], r["drift_status"], r["detection_status"], r["detail"],
+                        json.dumps(r["resources"], default=str), r["checked_at"]) for r in drift_rows])
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
@@ -0,0 +1,321 @@
+#!/usr/bin/python
+# -*- coding:utf8 -*-
+
+"""
+Name: cfn_templates.py
+
+Template reading and YAML/JSON conversion for cfn_launch.py. cfn2py.py is Python 2 code and still reads
+its input directly.
+
+Functions:
+1. Parse and dump with LibYAML (CSafeLoader/CSafeDumper) when PyYAML is built with it, pure Python
+   SafeLoader/SafeDumper otherwise.
+2. CloudFormation short-form tags (!Ref, !Sub, !GetAtt, !Join, ...) are read into their long form
+   ({"Ref": ...}, {"Fn::Sub": ...}), so YAML and JSON templates give the same dict. Dates such as
+   AWSTemplateFormatVersion stay strings.
+3. TemplateCache: raw text, parsed template and converted output of a file are cached by
+   (path, mtime, size). Every template read in cfn_launch.py goes through the shared `templates` cache,
+   so a file is read and parsed once per process however many stacks or validations use it.
+4. convert_dir converts every YAML template of a directory to JSON (or back) on a process pool,
+   skipping targets that are newer than their source. Replaces keeping the copies in sync by hand.
+5. compact_body shrinks a template before submission: minified JSON, no Description fields or console
+   parameter groups (AWS::CloudFormation::Interface), and optionally long literal strings that occur
+   more than once moved into one Mapping read back with Fn::FindInMap. The compacted body is parsed
+   again and checked against the original before it is used.
+6. stream_template writes a template dict straight to an open file as YAML or compact JSON, used by
+   cfn_generate.py instead of building the whole document as a string.
+"""
+
+import os
+import json
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as BaseLoader, CSafeDumper as BaseDumper
+    LIBYAML = True
+except ImportError:
+    from yaml import SafeLoader as BaseLoader, SafeDumper as BaseDumper
+    LIBYAML = False
+
+YAML_EXTENSIONS = (".yaml", ".yml", ".template")
+JSON_EXTENSIONS = (".json",)
+# files of a template dir that are not templates, skipped by convert_dir and cfn_launch validate-all
+MATRIX_MANIFEST = "cfn-matrix-manifest.json"
+NON_TEMPLATE_FILES = ("cfn-parameters.json", "cfn-StackInfo.json", MATRIX_MANIFEST)
+CONVERT_MAX_WORKERS = 4
+
+# compaction: Description fields and Metadata keys without effect on the stack
+INFORMATIONAL_METADATA = ("AWS::CloudFormation::Interface",)
+# compaction: strings shorter than this cost more as a Fn::FindInMap than they save
+DEDUPE_MIN_LENGTH = 64
+DEDUPE_MAPPING = "CompactStrings"
+
+YAML_DUMP_OPTIONS = {"default_flow_style": False, "sort_keys": False, "allow_unicode": True, "width": 1000}
+
+# short-form tags that are not Fn::<tag>
+SHORT_FORM_NAMES = {"Ref": "Ref", "Condition": "Condition"}
+
+
+class CfnLoader(BaseLoader):
+    """Safe loader with CloudFormation short-form tags and without timestamp resolution."""
+
+CfnLoader.yaml_implicit_resolvers = {
+    first: [(tag, regexp) for tag, regexp in resolvers if tag != 'tag:yaml.org,2002:timestamp']
+    for first, resolvers in BaseLoader.yaml_implicit_resolvers.items()
+}
+
+def construct_short_form(loader, tag_suffix, node):
+    name = SHORT_FORM_NAMES.get(tag_suffix, "Fn::" + tag_suffix)
+    if isinstance(node, yaml.ScalarNode):
+        value = loader.construct_scalar(node)
+        # !GetAtt Resource.Attribute
+        if tag_suffix == "GetAtt":
+            value = value.split(".", 1)
+    elif isinstance(node, yaml.SequenceNode):
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = loader.construct_mapping(node, deep=True)
+    return {name: value}
+
+CfnLoader.add_multi_constructor("!", construct_short_form)
+
+
+class CfnDumper(BaseDumper):
+    """Safe dumper that keeps key order and writes long-form intrinsic functions."""
+
+def represent_str(dumper, data):
+    # multi-line strings such as UserData as literal blocks
+    if "\n" in data:
+        return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='|')
+    return dumper.represent_scalar('tag:yaml.org,2002:str', data)
+
+CfnDumper.add_representer(str, represent_str)
+
+
+def parse_template(text, name=""):
+    """Template dict of a JSON or YAML template body. Raises ValueError if it does not parse."""
+    if name.endswith(JSON_EXTENSIONS) or text.lstrip().startswith("{"):
+        return json.loads(text)
+    try:
+        return yaml.load(text, Loader=CfnLoader)
+    except yaml.YAMLError as e:
+        raise ValueError(str(e))
+
+def dump_template(template, fmt="json", indent=2):
+    """Template dict as JSON (indent None: one line) or YAML text."""
+    if fmt == "json":
+        return json.dumps(template, indent=indent, default=str)
+    return yaml.dump(template, Dumper=CfnDumper, **YAML_DUMP_OPTIONS)
+
+def stream_template(template, fh, fmt="yaml"):
+    """Write template to the open file fh as it is serialized. JSON is written compact."""
+    if fmt == "json":
+        json.dump(template, fh, separators=(',', ':'), default=str)
+    else:
+        yaml.dump(template, fh, Dumper=CfnDumper, **YAML_DUMP_OPTIONS)
+
+
+class TemplateCache(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    @staticmethod
+    def key(path):
+        st = os.stat(path)
+        return (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+    def _get(self, path, kind, build):
+        key = self.key(path) + (kind,)
+        with self.lock:
+            if key in self.entries:
+                return self.entries[key]
+        value = build()
+        with self.lock:
+            # drop entries of older versions of the file
+            for old in [k for k in self.entries if k[0] == key[0] and k[1:3] != key[1:3]]:
+                del self.entries[old]
+            self.entries[key] = value
+        return value
+
+    def text(self, path):
+        def read():
+            with open(path, 'r', encoding='utf8') as fh:
+                return fh.read()
+        return self._get(path, "text", read)
+
+    def load(self, path):
+        """Parsed template of path. Callers must not modify it, it is shared."""
+        return self._get(path, "parsed", lambda: parse_template(self.text(path), path))
+
+    def dumps(self, path, fmt="json", indent=2):
+        return self._get(path, (fmt, indent), lambda: dump_template(self.load(path), fmt, indent))
+
+    def compact(self, path, dedupe=False):
+        """compact_body of path as (minified JSON, TemplateSizeReport)."""
+        return self._get(path, ("compact", dedupe), lambda: compact_body(self.text(path), path, dedupe))
+
+templates = TemplateCache()
+
+
+def target_path(src, fmt):
+    return os.path.splitext(src)[0] + (".json" if fmt == "json" else ".yaml")
+
+def convert_file(src, dst=None, fmt="json", force=False):
+    """Write src converted to fmt to dst. Returns False when dst is already newer than src."""
+    dst = dst or target_path(src, fmt)
+    if not force and os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+        return False
+    output = templates.dumps(src, fmt)
+    with open(dst + '.tmp', 'w', encoding='utf8') as fh:
+        fh.write(output)
+    os.replace(dst + '.tmp', dst)
+    return True
+
+def convert_dir(src_dir, fmt="json", force=False, max_workers=CONVERT_MAX_WORKERS):
+    """Convert every YAML (fmt json) or JSON (fmt yaml) template of src_dir in parallel.
+
+    Returns [(source, target, converted)], converted False for targets that were up to date.
+    """
+    extensions = YAML_EXTENSIONS if fmt == "json" else JSON_EXTENSIONS
+    sources = sorted(os.path.join(src_dir, f) for f in os.listdir(src_dir)
+        if f.endswith(extensions) and f not in NON_TEMPLATE_FILES and not f.startswith('.'))
+    if not sources:
+        return []
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(sources))) as pool:
+        converted = list(pool.map(convert_file, sources, [None]*len(sources), [fmt]*len(sources), [force]*len(sources)))
+    return [(src, target_path(src, fmt), done) for src, done in zip(sources, converted)]
+
+
+class TemplateSizeReport(namedtuple('TemplateSizeReport', ['original_bytes', 'compact_bytes', 'deduplicated'])):
+    @property
+    def saved_bytes(self):
+        return self.original_bytes - self.compact_bytes
+
+    def __str__(self):
+        return "{0} -> {1} bytes, {2} saved ({3:.1f}%), {4} strings deduplicated".format(self.original_bytes,
+            self.compact_bytes, self.saved_bytes, 100.0 * self.saved_bytes / max(self.original_bytes, 1), self.deduplicated)
+
+
+def strip_descriptions(template):
+    """Copy of template without Description fields and informational Metadata. Properties are kept as is."""
+    template = dict(template)
+    template.pop("Description", None)
+    if isinstance(template.get("Metadata"), dict):
+        template["Metadata"] = {k: v for k, v in template["Metadata"].items() if k not in INFORMATIONAL_METADATA}
+        if not template["Metadata"]:
+            del template["Metadata"]
+    for section in ("Parameters", "Resources", "Outputs"):
+        if isinstance(template.get(section), dict):
+            template[section] = {name: {k: v for k, v in body.items() if k != "Description"} if isinstance(body, dict) else body
+                for name, body in template[section].items()}
+    return template
+
+def _string_sites(node, found):
+    """Count the literal strings of node that may be replaced by Fn::FindInMap.
+
+    Intrinsic function arguments are left alone (Ref targets, Fn::Sub bodies, Fn::If conditions
+    and Fn::Join delimiters must stay literal) except the values of Fn::Join, Fn::Base64 and Fn::If.
+    """
+    if isinstance(node, str):
+        if len(node) >= DEDUPE_MIN_LENGTH:
+            found[node] = found.get(node, 0) + 1
+    elif isinstance(node, list):
+        for item in node:
+            _string_sites(item, found)
+    elif isinstance(node, dict):
+        if len(node) == 1:
+            name, args = next(iter(node.items()))
+            if name == "Fn::Base64":
+                return _string_sites(args, found)
+            if name == "Fn::Join" and isinstance(args, list) and len(args) == 2:
+                return _string_sites(args[1], found)
+            if name == "Fn::If" and isinstance(args, list):
+                return _string_sites(args[1:], found)
+            if name == "Ref" or name == "Condition" or name.startswith("Fn::"):
+                return
+        for value in node.values():
+            _string_sites(value, found)
+
+def _replace_strings(node, keys):
+    if isinstance(node, str):
+        return {"Fn::FindInMap": [DEDUPE_MAPPING, keys[node], "v"]} if node in keys else node
+    if isinstance(node, list):
+        return [_replace_strings(item, keys) for item in node]
+    if isinstance(node, dict):
+        if len(node) == 1:
+            name, args = next(iter(node.items()))
+            if name == "Fn::Base64":
+                return {name: _replace_strings(args, keys)}
+            if name == "Fn::Join" and isinstance(args, list) and len(args) == 2:
+                return {name: [args[0], _replace_strings(args[1], keys)]}
+            if name == "Fn::If" and isinstance(args, list):
+                return {name: args[:1] + _replace_strings(args[1:], keys)}
+            if name == "Ref" or name == "Condition" or name.startswith("Fn::"):
+                return node
+        return {k: _replace_strings(v, keys) for k, v in node.items()}
+    return node
+
+def dedupe_strings(template):
+    """Move literal strings repeated in Resources properties and Output values into the DEDUPE_MAPPING Mapping.
+
+    Returns (template, number of strings moved). Templates with a Transform are returned as is,
+    as macros may expect the literal values.
+    """
+    if "Transform" in template or DEDUPE_MAPPING in template.get("Mappings", {}):
+        return template, 0
+    found = {}
+    for resource in template.get("Resources", {}).values():
+        _string_sites(resource.get("Properties", {}), found)
+    for output in template.get("Outputs", {}).values():
+        _string_sites(output.get("Value"), found)
+    repeated = sorted(value for value, count in found.items() if count > 1)
+    if not repeated:
+        return template, 0
+    keys = {value: "s{0}".format(i) for i, value in enumerate(repeated)}
+    template = dict(template)
+    template["Resources"] = {name: dict(resource, Properties=_replace_strings(resource["Properties"], keys)) if "Properties" in resource else resource
+        for name, resource in template.get("Resources", {}).items()}
+    if "Outputs" in template:
+        template["Outputs"] = {name: dict(output, Value=_replace_strings(output["Value"], keys)) if "Value" in output else output
+            for name, output in template["Outputs"].items()}
+    template["Mappings"] = dict(template.get("Mappings", {}), **{DEDUPE_MAPPING: {key: {"v": value} for value, key in keys.items()}})
+    return template, len(keys)
+
+def expand_strings(template):
+    """Inverse of dedupe_strings: resolve Fn::FindInMap lookups of DEDUPE_MAPPING and drop the Mapping."""
+    mapping = template.get("Mappings", {}).get(DEDUPE_MAPPING)
+    if mapping is None:
+        return template
+
+    def expand(node):
+        if isinstance(node, list):
+            return [expand(item) for item in node]
+        if isinstance(node, dict):
+            args = node.get("Fn::FindInMap")
+            if len(node) == 1 and isinstance(args, list) and args[:1] == [DEDUPE_MAPPING]:
+                return mapping[args[1]][args[2]]
+            return {k: expand(v) for k, v in node.items()}
+        return node
+
+    template = expand(template)
+    template["Mappings"] = {k: v for k, v in template["Mappings"].items() if k != DEDUPE_MAPPING}
+    if not template["Mappings"]:
+        del template["Mappings"]
+    return template
+
+def compact_body(template_body, name="", dedupe=False):
+    """Compacted template_body as (minified JSON, TemplateSizeReport).
+
+    Raises ValueError if the compacted body does not parse back to the original without its descriptions.
+    """
+    expected = strip_descriptions(parse_template(template_body, name))
+    template, deduplicated = dedupe_strings(expected) if dedupe else (expected, 0)
+    compact = json.dumps(template, separators=(',', ':'), ensure_ascii=False, default=str)
+    if expand_strings(json.loads(compact)) != json.loads(json.dumps(expected, default=str)):
+        raise ValueError("compacted template differs from the original")
+    return compact, TemplateSizeReport(len(template_body.encode('utf8')), len(compact.encode('utf8')), deduplicated)
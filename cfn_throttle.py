@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# -*- coding:utf8 -*-
+
+"""
+Name: cfn_throttle.py
+
+Client side rate limiting for bursts of CloudFormation API calls (batch create, bulk delete).
+
+Functions:
+1. TokenBucket: thread-safe token bucket shared by all worker threads of a batch.
+2. call_with_backoff: run one API call through the bucket, retrying throttling errors with
+   exponential backoff and jitter. Each throttling error also slows the bucket down. Wrapped
+   calls go through aws_clients batch clients, which make one attempt, so throttling is not
+   retried by botocore as well.
+"""
+
+import time
+import random
+import threading
+import logging
+
+import botocore
+
+logger = logging.getLogger('ConfigAnsibleLogger')
+
+
+THROTTLING_CODES = ("Throttling", "ThrottlingException", "RequestLimitExceeded", "TooManyRequestsException")
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity=None, min_rate=0.2):
+        """rate: tokens per second. capacity: burst size, default one second worth of tokens."""
+        self.rate = float(rate)
+        self.min_rate = min(float(min_rate), self.rate)
+        self.capacity = float(capacity or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        """Halve the rate after the API pushed back."""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+        logger.warning("API throttled, rate limit lowered to %.2f/s", self.rate)
+
+
+def call_with_backoff(bucket, func, max_attempts=8, base_delay=1, max_delay=30, **kw):
+    """Call func(**kw) once a token is available, retrying throttling errors."""
+    for attempt in range(max_attempts):
+        bucket.acquire()
+        try:
+            return func(**kw)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in THROTTLING_CODES or attempt == max_attempts - 1:
+                raise
+            bucket.throttled()
+            delay = min(max_delay, base_delay * 2 ** attempt)
+            time.sleep(random.uniform(delay / 2, delay))
@@ -93,7 +93,6 @@ if sys.version < '3':
 import abc
 import yaml
 import logging
-import logging.handlers
 import datetime
 from argparse import ArgumentParser
 from warnings import filterwarnings
@@ -109,14 +108,10 @@ import pandas as pd
 import shutil
 from collections import Counter
 import tempfile
-import boto3
+from aws_clients import get_client
+from log_setup import set_up_logging, LazyJson, LOG_LEVELS
 
-LOG_LEVELS = { 'debug':logging.DEBUG,
-            'info':logging.INFO,
-            'warning':logging.WARNING,
-            'error':logging.ERROR,
-            'critical':logging.CRITICAL
-            }
+LOG_FILE = os.path.join(os.getcwd(), 'config_ansible.log')
 
 """
 def exception_hook(exc_type, exc_value, exc_traceback):
@@ -132,7 +127,7 @@ sys.excepthook = exception_hook
 def log():
     def decorator(func):
         def wrapper(*args, **kw):
-            logger.info("Running {0}()...".format(func.__name__))
+            logger.info("Running %s()...", func.__name__)
             a=func(*args, **kw) 
             return a
         return wrapper
@@ -203,18 +198,20 @@ class Base(object):
 
     @staticmethod
     def set_up_logging(log_level):
-        logger = logging.getLogger('ConfigAnsibleLogger')
-        logger.setLevel(LOG_LEVELS[log_level])
-        log_file=os.path.join(os.getcwd(), 'config_ansible.log')
-        formatter = logging.Formatter('[%(asctime)s  %(levelname)s] %(message)s')
-        handler = logging.handlers.TimedRotatingFileHandler(log_file, when='D', backupCount=10)
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-        return logger
+        # in the lambdas log_cfg sends the root logger to stdout (CloudWatch): propagate to it
+        # instead of attaching a file handler of our own
+        if logging.getLogger().handlers:
+            logger = logging.getLogger('ConfigAnsibleLogger')
+            logger.setLevel(LOG_LEVELS.get(log_level, log_level))
+            logger.propagate = True
+            return logger
+        # handlers are attached once per process, every parser shares them. Lambdas log
+        # synchronously, the runtime may freeze before a listener thread drains
+        return set_up_logging('ConfigAnsibleLogger', LOG_FILE, log_level, queued='AWS_LAMBDA_FUNCTION_NAME' not in os.environ)
 
     def log(func):
         def wrapper(self,*args, **kw):
-            self.logger.info("Running {0}()...".format(func.__name__))
+            self.logger.info("Running %s()...", func.__name__)
             return func(self,*args, **kw) 
         return wrapper
 
@@ -235,7 +232,7 @@ class AnsibleHostParser(Base):
         if use_s3 is True:
             self.bucket = bucket
             self.data_bucket = data_bucket
-            self.s3_client = boto3.client('s3')
+            self.s3_client = get_client('s3')
         self.parse_ansible_hosts()
  
 
@@ -313,7 +310,7 @@ class AnsibleHostParser(Base):
                 market_dict.update({market:market_submarket_mapping[market]})
             self.host_dict.update({market.split(':')[0]:market_dict})
             self.gen_ansible_hostfile()
-            self.logger.info("Generating ansible config file complete. \nConfig outputs at {0}\n".format(self.dest_dir)+"Exit now!\n")
+            self.logger.info("Generating ansible config file complete. \nConfig outputs at %s\nExit now!\n", self.dest_dir)
             if self.use_s3 is False:
                 sys.exit("{0} Generating ansible config complete. \nConfig outputs at {1}\n".format(datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S"), self.dest_dir)+"Exit now!")
 
@@ -356,7 +353,7 @@ class SvrInfoParser(Base):
         if use_s3 is True:
             self.bucket = bucket
             self.data_bucket = data_bucket
-            self.s3_client = boto3.client('s3')
+            self.s3_client = get_client('s3')
             #self.s3_resource = boto3.resource('s3')
         self.pd_load_si_file() 
 
@@ -418,7 +415,8 @@ class SvrInfoParser(Base):
             #self.s3_resource.Bucket(self.bucket).put_object(Key=self.tc_svr_info_file, Body=data)
             self.s3_client.put_object(Bucket=self.bucket,Key=self.tc_svr_info_file,Body=data)
 
-        self.logger.info("Appended {0} rows to {1}!\n".format(len(append_rows), self.tc_svr_info_file)+json.dumps(append_rows)+"Exit now!\n")
+        self.logger.info("Appended %s rows to %s!\nExit now!\n", len(append_rows), self.tc_svr_info_file)
+        self.logger.debug("Appended rows: %s", LazyJson(append_rows))
         if self.use_s3 is False:
             sys.exit("Appended {0} rows to {1}!\n".format(len(append_rows), self.tc_svr_info_file)+json.dumps(append_rows)+"\nExit now!")
 
@@ -431,7 +429,7 @@ class SvrInfoParser(Base):
             self.val_res_df[column] = self.val_res_df.apply(lambda x:check_if_NaN(x['default value']) and check_if_NaN(x[column]) and x.mandatory and (set(self.val_res_df.loc[5,column].split(',')) & set(map(lambda y:'common_lte_'+y, x['server type'].split(','))) or 'all' in x['server type'].split(',')), axis=1)
         if self.val_res_df.iloc[:,4:].sum().sum():
             self.val_res = {c: self.val_res_df.loc[i,'field'] for c in self.val_res_df.columns[4:] for i in self.val_res_df.index if self.val_res_df.loc[i,c]==True}
-            self.logger.error("Ansible configuration file generation failed!\ntruecall_server_info file missing mandatory fields:\n "+json.dumps(self.val_res))
+            self.logger.error("Ansible configuration file generation failed!\ntruecall_server_info file missing mandatory fields:\n %s", LazyJson(self.val_res))
             if self.use_s3 is False:
                 sys.exit("Ansible configuration file generation failed!\ntruecall_server_info file missing mandatory fields:\n "+json.dumps(self.val_res))  
 
@@ -457,14 +455,14 @@ class SvrInfoParser(Base):
         #logger.info(self.tc_svr_info_df.iloc[3,4:])
         vtch_server_types = reduce(lambda x,y: x | y, map(lambda x:set(x.split(',')), self.tc_svr_info_df.iloc[5,4:])) 
         total_server_types = list(map(lambda x:x.split('_')[-1], vtch_server_types))
-        self.logger.info(total_server_types)
+        self.logger.debug("%s", total_server_types)
         for i in range(4,len(self.tc_svr_info_df.columns)):
             column = self.tc_svr_info_df.columns[i]
             market = self.tc_svr_info_df.loc[3,column]
             submarket = self.tc_svr_info_df.loc[4,column]
             server_type = list(map(lambda x:x.strip(), set(self.tc_svr_info_df.loc[5,column].split(','))))
             vdr_tech = self.tc_svr_info_df.loc[6,column]
-            self.logger.info(server_type)
+            self.logger.debug("%s", server_type)
 
             # DONE: if any server of server type in the submarket (or market if empty submarket) has data, not write default data 
             # TODO: ADD OTHER SERVER TYPES data in yml  
@@ -482,14 +480,13 @@ class SvrInfoParser(Base):
 
         # generate common_dict
         common_dict, common_indexes, partial_common_dict = self.pd_gen_common_dict(self.tc_svr_info_df, basic_info_index_set, {})
-        self.logger.info("partial_common_dict: ")
-        self.logger.info(partial_common_dict)
+        self.logger.debug("partial_common_dict: %s", partial_common_dict)
         # generate market_common_dicts
         markets = set(self.tc_svr_info_df.iloc[3,4:])
         market_dict = dict(zip(*[markets,[[]]*len(markets)]))
         group_common_dicts = [{"TrueCall":common_dict}]
         host_dicts = []
-        self.logger.info(markets)
+        self.logger.debug("%s", markets)
 
         for m in markets:
             m_partial_common_dict = {}
@@ -497,8 +494,7 @@ class SvrInfoParser(Base):
             m_server_columns = [y for y in self.tc_svr_info_df.columns if self.tc_svr_info_df.loc[3,y]==m]
             m_svr_info_df = pd.concat([self.tc_svr_info_df.iloc[:,0:4], self.tc_svr_info_df.loc[:,m_server_columns]],axis=1)
             m_common_dict, m_indexes, m_partial_common_dict = self.pd_gen_common_dict(m_svr_info_df, basic_info_index_set | common_indexes, partial_common_dict)
-            self.logger.info("m_partial_common_dict: ")
-            self.logger.info(m_partial_common_dict)
+            self.logger.debug("m_partial_common_dict: %s", m_partial_common_dict)
             if m_common_dict:
                 group_common_dicts.append({m: m_common_dict}) 
             
@@ -507,8 +503,7 @@ class SvrInfoParser(Base):
             for h in m_server_columns:
                 h_svr_info_df = pd.concat([self.tc_svr_info_df.iloc[:,0:4], self.tc_svr_info_df.loc[:,h]],axis=1)
                 h_common_dict, h_indexes, h_partical_common_dict= self.pd_gen_common_dict(h_svr_info_df, basic_info_index_set | common_indexes | m_indexes, m_partial_common_dict)
-                self.logger.info("h_partical_common_dict")
-                self.logger.info(h_partical_common_dict)
+                self.logger.debug("h_partical_common_dict: %s", h_partical_common_dict)
                 if h_common_dict:
                     host_dicts.append({h: h_common_dict})
 
@@ -551,17 +546,17 @@ class SvrInfoParser(Base):
     @Base.log
     def write_roles_var_files(self, dest_dir):
         # write ansible/roles/tc_install/vars/main.yml and ansible/roles/tc_upgrade/vars/main.yml
-        self.logger.debug(self.basic_info_dict)
+        self.logger.debug("%s", self.basic_info_dict)
         truecall_rpms = set(filter(lambda y: not check_if_NaN(y), map(lambda x:x['truecall_rpm'], self.basic_info_dict)))
         gsrsvcs_rpms = set(filter(lambda y: not check_if_NaN(y), map(lambda x:x['gsrsvcs_rpm'], self.basic_info_dict)))
-        self.logger.info(truecall_rpms)
-        self.logger.info(gsrsvcs_rpms)
+        self.logger.debug("%s", truecall_rpms)
+        self.logger.debug("%s", gsrsvcs_rpms)
         roles_vars = {'truecall_rpm':truecall_rpms.pop(), 'gsrsvcs_rpm':gsrsvcs_rpms.pop()}
 
         for role in ['tc_install', 'tc_upgrade']:
             if self.use_s3 is True:
                 data = yaml.dump(roles_vars, default_flow_style=False)
-                self.logger.debug(data)
+                self.logger.debug("%s", data)
                 self.s3_client.put_object(Bucket=self.data_bucket, Key="/".join([dest_dir, 'roles', role,'vars','main.yml']), Body=data)
             else:
                 mkdir(os.path.join(dest_dir,'roles', role, 'vars'))
@@ -596,26 +591,23 @@ class SvrInfoParser(Base):
     def pd_gen_common_dict(self, common_info_df, excluded_indexes, partial_excluded_dict):
         partial_common_dict ={} 
         """
-        self.logger.info("partial_common_dict")
-        self.logger.info(partial_common_dict)     
-        self.logger.info("partial_excluded_dict")
-        self.logger.info(partial_excluded_dict)  
-        self.logger.info("common_info_df")
-        self.logger.info(common_info_df)
+        self.logger.debug("partial_common_dict: %s", partial_common_dict)
+        self.logger.debug("partial_excluded_dict: %s", partial_excluded_dict)
+        self.logger.debug("common_info_df: %s", common_info_df)
         """
         if partial_excluded_dict.keys():
             for i in partial_excluded_dict.keys():
                 try:
                     common_info_df.loc[i]=common_info_df.loc[i].replace(partial_excluded_dict[i], np.nan)
                 except Exception as e:
-                    self.logger.info(e)
+                    self.logger.info("%s", e)
         self.logger.info("after common_info_df")
         #self.logger.info(common_info_df)
         # common with same values
         try:
             common_indexes = set([i for i in common_info_df.index if len(list(filter(lambda x: not check_if_NaN(x), set(common_info_df.iloc[i, 4:]))))==1]) - excluded_indexes
         except Exception as e:
-                    self.logger.info(e)
+                    self.logger.info("%s", e)
         #self.logger.info("common_indexes")
         #self.logger.info(common_indexes)
 
@@ -636,8 +628,7 @@ class SvrInfoParser(Base):
         partial_common_dict.update(partial_excluded_dict)
         partial_common_dict_1 = partial_common_df.set_index('field').T.to_dict('records')[0]
         common_dict.update(partial_common_dict_1)
-        self.logger.info("common_dict")
-        self.logger.info(common_dict)
+        self.logger.debug("common_dict: %s", common_dict)
 
         # common with regular expression
         if sys.version < '3': 
@@ -645,8 +636,7 @@ class SvrInfoParser(Base):
         else:
             re_common_dict = {common_info_df.loc[i, 'field']: common_info_df.iloc[i, 4].replace(common_info_df.columns[4], u'"{{ inventory_hostname }}"') for i in common_info_df.index if i not in excluded_indexes and list(common_info_df.columns[4:]) == list(map(lambda x: re.split('-', x)[0].strip('\"') if isinstance(x, str) else x, common_info_df.iloc[i,4:]))}
         re_common_indexes = set(self.tc_svr_info_df[common_info_df['field'].isin(re_common_dict.keys())].index)
-        self.logger.info("re_common_dict")
-        self.logger.info(re_common_dict)
+        self.logger.debug("re_common_dict: %s", re_common_dict)
 
         common_dict.update(re_common_dict)
         common_indexes = common_indexes | re_common_indexes
@@ -686,7 +676,7 @@ class SvrInfoParser(Base):
             if missing_field:
                 self.val_res.update({s['hostname']:missing_field})
         if self.val_res:
-            self.logger.error("truecall_server_info.csv missing mandatory fields: ", self.val_res)
+            self.logger.error("truecall_server_info.csv missing mandatory fields: %s", self.val_res)
             raise KeyError("truecall_server_info.csv missing mandatory fields: ", self.val_res)
 
     # depreciated
@@ -699,7 +689,7 @@ class SvrInfoParser(Base):
         with open(dest_gvf, 'w') as file:
             #for k in sorted(self.svr_grp_info.keys()):
             #    file.write(': '.join([k, self.svr_grp_info[k]]) + '\n')
-            self.logger.info(self.tc_svr_info_df['field'])
+            self.logger.debug("%s", self.tc_svr_info_df['field'])
             for k in self.tc_svr_info_fields:
                 if self.svr_grp_info.get(k):
                     file.write(': '.join([k, self.svr_grp_info[k]]) + '\n')
@@ -753,7 +743,7 @@ class SiteBackupParser(Base):
             config = os.path.join(bck_dir, 'etc', 'config.ini')
             pre_upgrade_info = os.path.join(bck_dir, 'sys_info', 'pre_upgrade_info.txt')
             daemon_cron = os.path.join(bck_dir,'cron','daemon')
-            self.logger.info(bck_dir)
+            self.logger.debug("%s", bck_dir)
             tc_host = '_'.join(os.path.basename(bck_dir).split('_')[:2])
             self.tc_info[tc_host] = {}
             is_tcs, is_cyl, is_etl, is_lsr, is_qams = 0, 0, 0, 0, 0
@@ -905,7 +895,7 @@ class SiteBackupParser(Base):
         worksheet = writer.sheets['truecall_server_info']
         worksheet.set_column(0,len(cols),15, format_lft_aln)
         writer.save()
-        self.logger.info("Updated truecall server info spreadsheet with backup data of {0} servers. \nWriting to {1}.\n".format(len(self.tc_info.keys()), self.server_info_output)+"Exit now!\n")
+        self.logger.info("Updated truecall server info spreadsheet with backup data of %s servers. \nWriting to %s.\nExit now!\n", len(self.tc_info.keys()), self.server_info_output)
         if self.use_s3 is False:
             sys.exit("Updated truecall server info spreadsheet with backup data of {0} servers. \nWriting to {1}.\n".format(len(self.tc_info.keys()), self.server_info_output)+"Exit now!")
 
@@ -917,7 +907,7 @@ def process_args(args):
     if not args.overwrite_config_files and os.path.exists(default_output_dir) :
         shutil.move(default_output_dir, os.path.join(default_archive_dir,'_'.join(['config_ansible_output', datetime.datetime.now().strftime("%Y%m%d_%H%M%S")])))
     dest_dirs = list(map(lambda x:os.path.join(args.ansible_dir,x) if args.overwrite_config_files else os.path.join(default_output_dir, x), ['', 'group_vars', 'host_vars']))
-    self.logger.info("dest_dirs: \n"+json.dumps(dest_dirs))
+    self.logger.info("dest_dirs: \n%s", LazyJson(dest_dirs))
 
     for dir in dest_dirs: 
         mkdir(dir)
@@ -988,7 +978,7 @@ if __name__ == '__main__':
 
     args = parser.parse_args() 
 
-    logger = set_up_logging(args.log_level)
+    logger = set_up_logging('ConfigAnsibleLogger', LOG_FILE, args.log_level)
 
     logger.info("""ansible config provisioning starts. """)
 
@@ -1016,7 +1006,7 @@ if __name__ == '__main__':
         # Parse ansible host and group templates host_template.yml and TrueCall_template.yml
         atp = AnsibleTemplateParser(*atp_input)
         atp_output = atp.process_tpt()
-        logger.info("template_all: \n"+json.dumps(atp_output[0]))
+        logger.debug("template_all: \n%s", LazyJson(atp_output[0]))
         sip.pd_update_tc_si_file(atp_output)
     
 
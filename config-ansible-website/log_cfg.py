@@ -1,21 +1,18 @@
-import logging
+import os
 import sys
+import logging
+from log_setup import set_up_logging
 """
 All lambda methods use this loging config.
 Provides a single place where all log config/level/formatting is setup so that one
 can see source file, line numbers, and any other desired log fields. 
+Set LOG_LEVEL (default debug) and CFN_LOG_FORMAT=json in the function environment to change them.
 """
-logger = logging.getLogger()
-for h in logger.handlers:
-    logger.removeHandler(h)
-h = logging.StreamHandler(sys.stdout)
 # use whatever format you want here
 FORMAT = '%(asctime)-15s %(process)d-%(thread)d %(name)s [%(filename)s:%(lineno)d] :%(levelname)8s: %(message)s'
-h.setFormatter(logging.Formatter(FORMAT))
-logger.addHandler(h)
-logger.setLevel(logging.DEBUG)
+# synchronous: the lambda runtime may freeze before a queue listener thread drains
+logger = set_up_logging(None, stream=sys.stdout, log_level=os.environ.get('LOG_LEVEL', 'debug'), fmt=FORMAT, queued=False)
 # Suppress the more verbose modules
 logging.getLogger('__main__').setLevel(logging.DEBUG)
 logging.getLogger('botocore').setLevel(logging.WARN)
 #logging.getLogger('pynamodb').setLevel(logging.INFO)sudo su -
-
@@ -1,5 +1,7 @@
 #!/bin/bash
 
+# shared modules are packaged as copies of the root ones
+cp ../aws_clients.py ../log_setup.py .
 output=`sls deploy`
 echo $output 
 url=`echo $output | tr -s ' ' '\n' | grep https | awk -F/ '{print $3}'`
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# -*- coding:utf8 -*-
+
+"""
+Name: log_setup.py
+
+One logging setup for cfn_launch.py, cfn_generate.py, config_ansible.py and the config-ansible-website lambdas.
+config-ansible-website/log_setup.py is a copy packaged with the lambdas, refreshed by
+sls_start.sh and checked by test_lambda_package.py.
+
+Functions:
+1. set_up_logging attaches handlers to a logger once. Calling it again (every parser built by
+   config_ansible.Base, a second import, the CLI applying -l) only changes level and format, so
+   lines are no longer written 2 to 4 times.
+2. Records are handed to a QueueHandler and written by a QueueListener thread, so file I/O stays
+   off the calling thread. The listener is flushed and stopped at exit. Lambdas log synchronously
+   (queued=False) as the runtime may freeze before a listener thread drains.
+3. Text format '[time  LEVEL] message', or JSON lines (json_lines=True or CFN_LOG_FORMAT=json).
+4. Callers log with lazy %-style arguments. LazyJson defers json.dumps of large payloads until a
+   record is actually emitted, e.g. logger.debug("stack_details: %s", LazyJson(stack_details)).
+
+Usage:
+    from log_setup import set_up_logging
+    logger = set_up_logging('ConfigAnsibleLogger', 'cfn_launch.log', 'info')
+"""
+
+import os
+import sys
+import json
+import queue
+import atexit
+import threading
+import logging
+import logging.handlers
+
+
+LOG_LEVELS = { 'debug':logging.DEBUG,
+            'info':logging.INFO,
+            'warning':logging.WARNING,
+            'error':logging.ERROR,
+            'critical':logging.CRITICAL
+            }
+
+TEXT_FORMAT = '[%(asctime)s  %(levelname)s] %(message)s'
+# rotated daily, 10 days kept
+LOG_WHEN = 'D'
+LOG_BACKUP_COUNT = 10
+
+# logger name -> (QueueListener or None, target handlers)
+_lock = threading.Lock()
+_configured = {}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, thread, source location and message."""
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "module": record.module,
+            "line": record.lineno,
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class LazyJson(object):
+    """Serialize obj only when the log record is formatted."""
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return json.dumps(self.obj, default=str)
+
+
+def make_formatter(json_lines=None, fmt=TEXT_FORMAT):
+    if json_lines or os.environ.get('CFN_LOG_FORMAT', '').lower() == 'json':
+        return JsonFormatter()
+    return logging.Formatter(fmt)
+
+def set_up_logging(name=None, log_file=None, log_level='info', json_lines=None, stream=None, fmt=TEXT_FORMAT, queued=True):
+    """Configure logger name (None: the root logger) and return it.
+
+    The first call attaches a TimedRotatingFileHandler for log_file and/or a StreamHandler
+    for stream, behind a QueueHandler when queued. Later calls for the same logger keep
+    those handlers and only apply log_level, and the format when json_lines is given.
+    """
+    with _lock:
+        return _set_up_logging(name, log_file, log_level, json_lines, stream, fmt, queued)
+
+def _set_up_logging(name, log_file, log_level, json_lines, stream, fmt, queued):
+    logger = logging.getLogger(name)
+    logger.setLevel(LOG_LEVELS.get(log_level, log_level))
+    formatter = make_formatter(json_lines, fmt)
+
+    if name in _configured:
+        if json_lines is not None:
+            for handler in _configured[name][1]:
+                handler.setFormatter(formatter)
+        return logger
+
+    handlers = []
+    if log_file:
+        handlers.append(logging.handlers.TimedRotatingFileHandler(log_file, when=LOG_WHEN, backupCount=LOG_BACKUP_COUNT))
+    if stream is not None or not handlers:
+        handlers.append(logging.StreamHandler(stream or sys.stderr))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    # handlers attached by earlier, non idempotent setups
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    listener = None
+    if queued:
+        records = queue.Queue(-1)
+        listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        logger.addHandler(logging.handlers.QueueHandler(records))
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
+    if name is not None:
+        logger.propagate = False
+    _configured[name] = (listener, handlers)
+    return logger
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+# -*- coding:utf8 -*-
+
+"""
+Name: test_cfn_generate.py
+
+Tests of the ref_<Section>__<name> resolver of CfnGenerator: Ref and Sub results, and the path of
+every token that does not resolve. Tests of the input fingerprint of generate_template, with the
+template built by a FakeGenerator.
+
+Usage:
+    python -m pytest -q test_cfn_generate.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from troposphere import Parameter, Ref, Sub
+
+import cfn_generate
+from cfn_generate import CfnGenerator, InvalidReferenceError, FINGERPRINT_SUFFIX, generate_template
+
+
+def resolver():
+    """CfnGenerator with only the state read by resolve_refs, without building a template."""
+    generator = CfnGenerator.__new__(CfnGenerator)
+    generator.input_config = {
+        "SecurityGroup": {"resource_name": "TestSecurityGroup", "GroupDescription": "Ansible servers"},
+        "Instance": {"resource_name": "", "InstanceType": "t2.micro"}
+    }
+    generator.template_config = {
+        "Parameter": {"KeyName": Parameter("KeyName", Type="String")},
+        "SecurityGroup": {},
+        "SecurityGroupIngress": {},
+        "Instance": {},
+        "Output": {}
+    }
+    return generator
+
+
+class ResolveRefsTest(unittest.TestCase):
+    def setUp(self):
+        self.generator = resolver()
+
+    def test_token_becomes_ref(self):
+        resolved = self.generator.resolve_refs({"KeyName": "ref_Parameter__KeyName", "GroupId": "ref_SecurityGroup__resource_name"})
+        self.assertEqual(resolved["KeyName"].to_dict(), Ref("KeyName").to_dict())
+        self.assertEqual(resolved["GroupId"].to_dict(), Ref("TestSecurityGroup").to_dict())
+
+    def test_token_in_text_becomes_sub(self):
+        resolved = self.generator.resolve_refs(["key ref_Parameter__KeyName in ${AWS::Region}"])
+        self.assertEqual(resolved[0].to_dict(), Sub("key ${KeyName} in ${!AWS::Region}").to_dict())
+
+    def test_nodes_without_tokens_are_returned_as_is(self):
+        node = {"Tags": [{"Key": "Name", "Value": "control"}], "Count": 2}
+        self.assertIs(self.generator.resolve_refs(node), node)
+
+    def test_invalid_refs_are_reported_with_paths(self):
+        node = {
+            "KeyName": "ref_Parameter__Missing",
+            "Tags": [{"Key": "Name", "Value": "ref_Instance__resource_name"}],
+            "Sub": "ref_Vpc__Id and ref_Parameter__KeyName"
+        }
+        with self.assertRaises(InvalidReferenceError) as raised:
+            self.generator.resolve_refs(node, "Resources.Control.Properties")
+        self.assertEqual(sorted(raised.exception.errors), [
+            ("Resources.Control.Properties.KeyName", "ref_Parameter__Missing", "Parameter has no Missing"),
+            ("Resources.Control.Properties.Sub", "ref_Vpc__Id", "unknown section Vpc"),
+            ("Resources.Control.Properties.Tags[0].Value", "ref_Instance__resource_name", "Instance resource_name is not added yet")
+        ])
+        self.assertIn("Resources.Control.Properties.Sub: ref_Vpc__Id (unknown section Vpc)", str(raised.exception))
+
+
+class FakeGenerator(object):
+    """Stands in for CfnGenerator, writes a placeholder template and counts the templates built."""
+    built = 0
+
+    def __init__(self, template_name, config_dir, cfn_usage, server_count, input_config=None, fleet="instances"):
+        self.template_name = template_name
+        self.resources = []
+        FakeGenerator.built += 1
+
+    def add_resource(self, resource_type, resource_name, **resource_data):
+        self.resources.append(resource_name)
+
+    def add_slave_fleet(self, *args, **kw):
+        self.resources.append("SlaveFleet")
+
+    def add_output(self):
+        pass
+
+    def gen_cfn_template(self, cfn_dir, verbose=True, echo=False):
+        with open(os.path.join(cfn_dir, self.template_name), 'w') as fh:
+            fh.write("\n".join(self.resources))
+        return os.path.getsize(os.path.join(cfn_dir, self.template_name)), len(self.resources)
+
+
+class FingerprintTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cfn_dir = os.path.join(self.tmp_dir, 'cfn_template')
+        self.config_dir = os.path.join(self.tmp_dir, 'config')
+        os.makedirs(self.cfn_dir)
+        os.makedirs(self.config_dir)
+        for init_file in ("cfn-hup.conf", "cfn-auto-reloader.conf"):
+            with open(os.path.join(self.config_dir, init_file), 'w') as fh:
+                fh.write("[main]\nstack=${AWS::StackId}\n")
+        patcher = mock.patch.object(cfn_generate, 'CfnGenerator', FakeGenerator)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        FakeGenerator.built = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def generate(self, **kw):
+        return generate_template(["ansible"], 3, self.cfn_dir, self.config_dir, verbose=False, **kw)
+
+    def outputs(self):
+        """{file: mtime} of the template, its fingerprint and the generated init files."""
+        files = [os.path.join(self.cfn_dir, "cfn_ansible_3.yaml"), os.path.join(self.cfn_dir, "cfn_ansible_3.yaml" + FINGERPRINT_SUFFIX)]
+        files += [os.path.join(self.config_dir, f) for f in cfn_generate.GENERATED_INIT_FILES]
+        return {f: os.stat(f).st_mtime_ns for f in files}
+
+    def test_unchanged_inputs_leave_outputs_untouched(self):
+        self.assertEqual(self.generate(), ("cfn_ansible_3.yaml", 5, True))
+        before = self.outputs()
+        self.assertEqual(self.generate(), ("cfn_ansible_3.yaml", 5, False))
+        self.assertEqual(FakeGenerator.built, 1)
+        self.assertEqual(self.outputs(), before)
+
+    def test_changed_init_file_regenerates(self):
+        self.generate()
+        with open(os.path.join(self.config_dir, "cfn-hup.conf"), 'a') as fh:
+            fh.write("interval=1\n")
+        self.assertTrue(self.generate()[2])
+        self.assertEqual(FakeGenerator.built, 2)
+
+    def test_init_files_of_another_template_regenerate(self):
+        self.generate()
+        generate_template(["ansible"], 5, self.cfn_dir, self.config_dir, verbose=False)
+        self.assertTrue(self.generate()[2])
+        self.assertEqual(FakeGenerator.built, 3)
+
+    def test_missing_template_or_force_regenerates(self):
+        self.generate()
+        self.assertTrue(self.generate(force=True)[2])
+        os.remove(os.path.join(self.cfn_dir, "cfn_ansible_3.yaml"))
+        self.assertTrue(self.generate()[2])
+        self.assertEqual(FakeGenerator.built, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+#!/usr/bin/python
+# -*- coding:utf8 -*-
+
+"""
+Name: test_cfn_launch.py
+
+Tests of CfnClient stack event following against a canned describe_stack_events, and of the
+default confirm policy and instance ips of stacks described by name against moto.
+
+Usage:
+    python -m pytest -q test_cfn_launch.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import botocore
+from moto import mock_aws
+
+import cfn_launch
+from cfn_launch import CfnClient
+
+
+STACK_ID = "arn:aws:cloudformation:ap-southeast-2:123456789012:stack/AnsibleTest/1"
+
+
+def stack_event(n, status, logical_id="AnsibleTest", resource_type="AWS::CloudFormation::Stack", physical_id=STACK_ID):
+    return {"EventId": "event-{0}".format(n), "StackId": STACK_ID, "StackName": "AnsibleTest",
+        "LogicalResourceId": logical_id, "PhysicalResourceId": physical_id, "ResourceType": resource_type,
+        "ResourceStatus": status}
+
+def queue_event(n, status):
+    return stack_event(n, status, "Queue", "AWS::SQS::Queue", "https://sqs/queue")
+
+
+class FakePaginator(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def paginate(self, StackName):
+        events = self.conn.events[::-1]
+        for i in range(0, len(events), self.conn.page_size):
+            yield {"StackEvents": events[i:i+self.conn.page_size]}
+
+
+class FakeCfnConn(object):
+    """describe_stack_events of one stack. events are kept oldest first, pages are newest first."""
+    def __init__(self, events, page_size=100):
+        self.events = list(events)
+        self.page_size = page_size
+
+    def get_paginator(self, name):
+        return FakePaginator(self)
+
+    def describe_stack_events(self, StackName):
+        return {"StackEvents": self.events[::-1][:self.page_size]}
+
+
+def fake_client(events, page_size=100):
+    client = CfnClient.__new__(CfnClient)
+    client.cfn_conn = FakeCfnConn(events, page_size)
+    return client
+
+
+class FollowStackEventsTest(unittest.TestCase):
+    created = [stack_event(1, "CREATE_IN_PROGRESS"), queue_event(2, "CREATE_IN_PROGRESS"),
+        queue_event(3, "CREATE_COMPLETE"), stack_event(4, "CREATE_COMPLETE")]
+
+    def test_update_after_finished_create_skips_create_events(self):
+        client = fake_client(self.created + [stack_event(5, "UPDATE_IN_PROGRESS")], page_size=2)
+        events = client.new_stack_events(STACK_ID)
+        self.assertEqual([e["EventId"] for e in events], ["event-5"])
+        self.assertFalse(any(client.is_final_event(e) for e in events))
+
+    def test_update_after_finished_create_waits_for_update(self):
+        client = fake_client(self.created + [stack_event(5, "UPDATE_IN_PROGRESS")])
+        seen = []
+        def on_event(event):
+            seen.append(event["EventId"])
+            # the update finishes after the first poll
+            if event["EventId"] == "event-5":
+                client.cfn_conn.events += [queue_event(6, "UPDATE_COMPLETE"), stack_event(7, "UPDATE_COMPLETE")]
+        poll_min, cfn_launch.WAIT_POLL_MIN = cfn_launch.WAIT_POLL_MIN, 0
+        try:
+            final_events = client.follow_stack_events([STACK_ID], on_event)
+        finally:
+            cfn_launch.WAIT_POLL_MIN = poll_min
+        self.assertEqual(final_events[STACK_ID]["ResourceStatus"], "UPDATE_COMPLETE")
+        self.assertEqual(seen, ["event-5", "event-6", "event-7"])
+
+    def test_earlier_update_failure_is_not_the_outcome(self):
+        client = fake_client(self.created + [stack_event(5, "UPDATE_IN_PROGRESS"), queue_event(6, "UPDATE_FAILED"),
+            stack_event(7, "UPDATE_ROLLBACK_COMPLETE"), stack_event(8, "UPDATE_IN_PROGRESS"), queue_event(9, "UPDATE_IN_PROGRESS")])
+        events = client.new_stack_events(STACK_ID)
+        self.assertEqual([e["EventId"] for e in events], ["event-8", "event-9"])
+        self.assertFalse(any(client.is_final_event(e) for e in events))
+
+    def test_watermark_taken_before_the_operation(self):
+        client = fake_client(self.created)
+        since = {STACK_ID: client.latest_event_id(STACK_ID)}
+        client.cfn_conn.events += [stack_event(5, "UPDATE_IN_PROGRESS"), stack_event(6, "UPDATE_COMPLETE")]
+        final_events = client.follow_stack_events([STACK_ID], since=since)
+        self.assertEqual(final_events[STACK_ID]["EventId"], "event-6")
+
+
+class FakeDeleteConn(object):
+    """describe_stacks of deleting stacks: ARN -> stack, or a ClientError to raise."""
+    def __init__(self, stacks):
+        self.stacks = stacks
+
+    def describe_stacks(self, StackName):
+        stack = self.stacks[StackName]
+        if isinstance(stack, Exception):
+            raise stack
+        return {"Stacks": [stack]}
+
+
+class TrackDeletionsTest(unittest.TestCase):
+    def test_describe_error_of_one_stack_does_not_stop_tracking(self):
+        deleted, denied = STACK_ID, STACK_ID.replace("AnsibleTest", "Denied")
+        client = CfnClient.__new__(CfnClient)
+        client.cfn_conn = FakeDeleteConn({
+            deleted: {"StackId": deleted, "StackStatus": "DELETE_COMPLETE"},
+            denied: botocore.exceptions.ClientError({"Error": {"Code": "AccessDenied", "Message": "denied"}}, "DescribeStacks")})
+        poll_min, cfn_launch.WAIT_POLL_MIN = cfn_launch.WAIT_POLL_MIN, 0
+        try:
+            done, pending = client.track_deletions({deleted: ("deleted", 0), denied: ("denied", 0)}, timeout=60)
+        finally:
+            cfn_launch.WAIT_POLL_MIN = poll_min
+        self.assertEqual(pending, [])
+        self.assertEqual(done[deleted][0], "DELETE_COMPLETE")
+        self.assertEqual(done[denied][0], "DESCRIBE_FAILED")
+        self.assertIn("AccessDenied", done[denied][2])
+
+
+TEMPLATE = """
+Parameters:
+  SSHLocation: {Type: String}
+Resources:
+  Queue: {Type: "AWS::SQS::Queue"}
+  ControlInstance:
+    Type: AWS::EC2::Instance
+    Properties: {ImageId: ami-12c6146b, InstanceType: t2.micro}
+Outputs:
+  SSHLocation: {Value: !Ref SSHLocation}
+"""
+
+class MotoCfnClientTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        # fetch_local_ip writes cfn_template/cfn-parameters.json relative to the cwd
+        os.chdir(self.tmp_dir)
+        os.mkdir('cfn_template')
+        self.template_file = os.path.join('cfn_template', 'queue.yaml')
+        with open(self.template_file, 'w') as fh:
+            fh.write(TEMPLATE)
+        self.env = {k: os.environ.get(k) for k in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY')}
+        os.environ.update(AWS_ACCESS_KEY_ID='testing', AWS_SECRET_ACCESS_KEY='testing')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+        for k, v in self.env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+    @mock_aws
+    def test_default_policy_refuses_deletes(self):
+        creator = CfnClient('cfn_template', local_ip='203.0.113.10', confirm=cfn_launch.always_confirm)
+        stack = creator.create_stack(self.template_file, 'ConfirmTest')
+
+        result = CfnClient('cfn_template', local_ip='203.0.113.10').delete_stacks()
+        self.assertEqual([s.stack_id for s in result.declined], [stack.stack_id])
+        self.assertEqual(result.deleted, [])
+
+        result = creator.delete_stacks([stack.stack_id])
+        self.assertEqual([s.stack_id for s in result.deleted], [stack.stack_id])
+
+    @mock_aws
+    def test_describe_by_name_resolves_instances(self):
+        client = CfnClient('cfn_template', local_ip='203.0.113.10', confirm=cfn_launch.always_confirm)
+        stack = client.create_stack(self.template_file, 'DescribeTest')
+        by_name = client.describe_stacks(['DescribeTest'], connect=True)['DescribeTest']
+        by_arn = client.describe_stacks([stack.stack_id], connect=True)[stack.stack_id]
+        self.assertEqual(list(by_name.stack_instances), ['ControlInstance'])
+        self.assertEqual(by_name.stack_instances, by_arn.stack_instances)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# -*- coding:utf8 -*-
+
+"""
+Name: test_cfn_metrics.py
+
+Tests of CallRecorder botocore hooks on real clients, answered by a Stubber or failing to connect.
+
+Usage:
+    python -m pytest -q test_cfn_metrics.py
+"""
+
+import socket
+import unittest
+
+import boto3
+import botocore
+from botocore.config import Config
+from botocore.stub import Stubber
+
+from cfn_metrics import CallRecorder
+
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def cfn_client(endpoint_url=None):
+    return boto3.client('cloudformation', region_name='ap-southeast-2', endpoint_url=endpoint_url,
+        aws_access_key_id='testing', aws_secret_access_key='testing',
+        config=Config(retries={'mode': 'standard', 'total_max_attempts': 1}, connect_timeout=1, read_timeout=1))
+
+
+class CallRecorderTest(unittest.TestCase):
+    def setUp(self):
+        self.recorder = CallRecorder()
+
+    def test_successful_call(self):
+        client = self.recorder.attach(cfn_client())
+        with Stubber(client) as stubber:
+            stubber.add_response('list_stacks', {'StackSummaries': []})
+            client.list_stacks()
+        self.assertEqual(self.recorder.call_counts(), {'cloudformation.ListStacks': 1})
+        self.assertEqual(self.recorder.records[-1]['status'], 200)
+
+    def test_client_error(self):
+        client = self.recorder.attach(cfn_client())
+        with Stubber(client) as stubber:
+            stubber.add_client_error('describe_stacks', 'ValidationError', 'Stack with id x does not exist')
+            with self.assertRaises(botocore.exceptions.ClientError):
+                client.describe_stacks(StackName='x')
+        self.assertEqual(self.recorder.call_counts(), {'cloudformation.DescribeStacks': 1})
+
+    def test_connection_error_is_not_replaced(self):
+        client = self.recorder.attach(cfn_client('http://127.0.0.1:{0}'.format(closed_port())))
+        with self.assertRaises(botocore.exceptions.EndpointConnectionError):
+            client.list_stacks()
+        self.assertEqual(self.recorder.call_counts(), {'cloudformation.ListStacks': 1})
+        self.assertEqual(self.recorder.records[-1]['status'], 'EndpointConnectionError')
+
+    def test_hook_errors_are_swallowed(self):
+        # a hook called with unexpected arguments records nothing and raises nothing
+        self.recorder._before_call(context={})
+        self.recorder._after_call()
+        self.recorder._after_call_error(exception=ValueError(), context={'cfn_metrics_start': 0}, event_name='after-call-error.x.Y')
+        self.assertEqual(self.recorder.call_counts(), {'x.Y': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
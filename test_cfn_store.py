@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# -*- coding:utf8 -*-
+
+"""
+Name: test_cfn_store.py
+
+Tests of the sqlite stack store: upserts, regions, inventory prefix lookup and concurrent writers.
+
+Usage:
+    python -m pytest -q test_cfn_store.py
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from contextlib import closing
+
+from cfn_store import StackStore, stack_name_prefix
+
+
+def stack_arn(region, name):
+    return "arn:aws:cloudformation:{0}:123456789012:stack/{1}/1".format(region, name)
+
+def stack_info(name, status="CREATE_COMPLETE", **extra):
+    return dict({"stack_name": name, "stack_status": status, "stack_parameters": []}, **extra)
+
+
+class StackStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.tmp_dir, 'cfn-StackInfo.db')
+        self.store = StackStore(self.db_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_upsert_updates_in_place(self):
+        stack_id = stack_arn("ap-southeast-2", "a")
+        self.store.upsert({stack_id: stack_info("a", "CREATE_IN_PROGRESS")}, region="ap-southeast-2")
+        self.store.upsert({stack_id: stack_info("a", stack_output={"ControlIp": "10.0.0.1"})}, region="ap-southeast-2")
+        self.assertEqual(self.store.get(), {stack_id: stack_info("a", stack_output={"ControlIp": "10.0.0.1"})})
+
+    def test_upsert_without_region_keeps_the_stored_region(self):
+        stack_id = stack_arn("us-east-1", "a")
+        self.store.upsert({stack_id: stack_info("a")}, region="us-east-1")
+        self.store.upsert({stack_id: stack_info("a", "DELETE_IN_PROGRESS")})
+        self.assertIn(stack_id, self.store.get(region="us-east-1"))
+        self.assertEqual(self.store.get(region="ap-southeast-2"), {})
+
+    def test_region_of_imported_rows_from_the_arn(self):
+        sydney, virginia = stack_arn("ap-southeast-2", "a"), stack_arn("us-east-1", "b")
+        self.store.upsert({sydney: stack_info("a"), virginia: stack_info("b")}, refreshed_at=0)
+        self.assertEqual(list(self.store.get(region="us-east-1")), [virginia])
+
+    def test_deleted_stacks_are_hidden(self):
+        stack_id = stack_arn("ap-southeast-2", "a")
+        self.store.upsert({stack_id: stack_info("a", "DELETE_COMPLETE")}, region="ap-southeast-2")
+        self.assertEqual(self.store.get(), {})
+        self.assertIn(stack_id, self.store.get(include_deleted=True))
+
+    def test_split_fresh_by_status(self):
+        stable, running = stack_arn("ap-southeast-2", "a"), stack_arn("ap-southeast-2", "b")
+        self.store.upsert({stable: stack_info("a"), running: stack_info("b", "CREATE_IN_PROGRESS")}, refreshed_at=1000)
+        fresh, stale = self.store.split_fresh([stable, running, "missing"], now=1060)
+        self.assertEqual(list(fresh), [stable])
+        self.assertEqual(stale, [running, "missing"])
+
+    def test_inventory_prefix_lookup(self):
+        names = ["cfn-ansible-test-20190307101010", "cfn-ansible-test-20190307101010-2", "cfn-docker-20190307101010"]
+        self.store.sync_inventory("ap-southeast-2", [(stack_arn("ap-southeast-2", n), n, "CREATE_COMPLETE", i, None)
+            for i, n in enumerate(names)])
+        rows = self.store.query_inventory(region="ap-southeast-2", prefix="cfn-ansible-test")
+        self.assertEqual([r["stack_name"] for r in rows], names[:2])
+        self.assertEqual(stack_name_prefix(names[1]), "cfn-ansible-test")
+
+    def test_batch_names_group_under_one_prefix(self):
+        names = ["batch-1", "batch-2", "batch-3", "batch-20190307101010-1"]
+        self.store.sync_inventory("ap-southeast-2", [(stack_arn("ap-southeast-2", n), n, "CREATE_COMPLETE", i, None)
+            for i, n in enumerate(names)])
+        rows = self.store.query_inventory(prefix="batch")
+        self.assertEqual([r["stack_name"] for r in rows], names)
+
+    def test_concurrent_writers(self):
+        errors = []
+        def writer(n):
+            # one store per thread, like separate cfn_launch.py invocations
+            store = StackStore(self.db_file)
+            try:
+                for i in range(50):
+                    name = "w{0}-{1}".format(n, i)
+                    store.upsert({stack_arn("ap-southeast-2", name): stack_info(name)}, region="ap-southeast-2")
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=writer, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.store.get()), 400)
+        with closing(self.store.connect()) as conn:
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding:utf8 -*-
+
+"""
+Name: test_cfn_templates.py
+
+Tests of template compaction: the CompactStrings Mapping and Fn::FindInMap lookups of dedupe_strings
+must expand back to the uncompacted template.
+
+Usage:
+    python -m pytest -q test_cfn_templates.py
+"""
+
+import json
+import unittest
+
+from cfn_templates import (DEDUPE_MAPPING, DEDUPE_MIN_LENGTH, compact_body, dedupe_strings, expand_strings,
+    parse_template, strip_descriptions)
+
+
+SCRIPT = "#!/bin/bash -xe\n/opt/aws/bin/cfn-init -v --stack ${AWS::StackName} --region ${AWS::Region}\n"
+BUCKET_ARN = "arn:aws:s3:::config-ansible-website-artifacts-bucket-for-the-ansible-control-server/*"
+
+TEMPLATE = """
+AWSTemplateFormatVersion: '2010-09-09'
+Description: Ansible control and slave
+Metadata:
+  AWS::CloudFormation::Interface:
+    ParameterGroups: []
+Mappings:
+  RegionMap:
+    ap-southeast-2:
+      AMI: ami-0123456789
+Parameters:
+  KeyName:
+    Type: String
+    Description: key pair of the servers
+Resources:
+  AnsibleControl:
+    Type: AWS::EC2::Instance
+    Properties:
+      ImageId: !FindInMap [RegionMap, !Ref 'AWS::Region', AMI]
+      Tags:
+        - Key: Description
+          Value: "{bucket}"
+      UserData:
+        Fn::Base64: !Join ['', ["{script}", "{bucket}"]]
+  AnsibleSlave1:
+    Type: AWS::EC2::Instance
+    Description: first slave
+    Properties:
+      ImageId: !FindInMap [RegionMap, !Ref 'AWS::Region', AMI]
+      UserData:
+        Fn::Base64: !Join ['', ["{script}", !Sub "{script}"]]
+Outputs:
+  Bucket:
+    Description: artifacts
+    Value: "{bucket}"
+""".format(script=json.dumps(SCRIPT)[1:-1], bucket=BUCKET_ARN)
+
+
+class CompactBodyTest(unittest.TestCase):
+    def setUp(self):
+        self.expected = strip_descriptions(parse_template(TEMPLATE, "ansible.yaml"))
+
+    def test_strings_are_long_enough_to_dedupe(self):
+        self.assertGreaterEqual(len(SCRIPT), DEDUPE_MIN_LENGTH)
+        self.assertGreaterEqual(len(BUCKET_ARN), DEDUPE_MIN_LENGTH)
+
+    def test_dedupe_round_trip(self):
+        compact, report = compact_body(TEMPLATE, "ansible.yaml", dedupe=True)
+        template = json.loads(compact)
+        self.assertEqual(report.deduplicated, 2)
+        self.assertEqual(sorted(v["v"] for v in template["Mappings"][DEDUPE_MAPPING].values()), sorted([SCRIPT, BUCKET_ARN]))
+        self.assertEqual(template["Mappings"]["RegionMap"], self.expected["Mappings"]["RegionMap"])
+        self.assertEqual(template["Outputs"]["Bucket"]["Value"]["Fn::FindInMap"][0], DEDUPE_MAPPING)
+        self.assertEqual(expand_strings(template), self.expected)
+        self.assertLess(report.compact_bytes, report.original_bytes)
+
+    def test_intrinsic_arguments_stay_literal(self):
+        template, _ = dedupe_strings(self.expected)
+        user_data = template["Resources"]["AnsibleSlave1"]["Properties"]["UserData"]["Fn::Base64"]["Fn::Join"]
+        self.assertEqual(user_data[0], "")
+        self.assertIn("Fn::FindInMap", user_data[1][0])
+        self.assertEqual(user_data[1][1], {"Fn::Sub": SCRIPT})
+
+    def test_descriptions_are_stripped_but_tag_values_kept(self):
+        template = json.loads(compact_body(TEMPLATE, "ansible.yaml")[0])
+        self.assertNotIn("Description", template)
+        self.assertNotIn("Metadata", template)
+        self.assertNotIn("Description", template["Parameters"]["KeyName"])
+        self.assertNotIn("Description", template["Resources"]["AnsibleSlave1"])
+        self.assertEqual(template["Resources"]["AnsibleControl"]["Properties"]["Tags"][0], {"Key": "Description", "Value": BUCKET_ARN})
+        self.assertEqual(template, self.expected)
+
+    def test_transform_is_not_deduped(self):
+        template = dict(self.expected, Transform="AWS::Serverless-2016-10-31")
+        self.assertEqual(dedupe_strings(template), (template, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
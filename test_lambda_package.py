@@ -0,0 +1,37 @@
+#!/usr/bin/python
+# -*- coding:utf8 -*-
+
+"""
+Name: test_lambda_package.py
+
+The lambdas of config-ansible-website ship copies of shared root modules, the copies must not drift.
+
+Usage:
+    python -m pytest -q test_lambda_package.py
+"""
+
+import os
+import unittest
+
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(ROOT_DIR, 'config-ansible-website')
+SHARED_MODULES = ('aws_clients.py', 'log_setup.py')
+
+
+class LambdaPackageTest(unittest.TestCase):
+    def test_shared_modules_are_identical(self):
+        for name in SHARED_MODULES:
+            with open(os.path.join(ROOT_DIR, name), 'rb') as fh:
+                root_copy = fh.read()
+            with open(os.path.join(LAMBDA_DIR, name), 'rb') as fh:
+                lambda_copy = fh.read()
+            self.assertEqual(root_copy, lambda_copy, "config-ansible-website/{0} differs from {0}".format(name))
+
+    def test_shared_modules_are_regular_files(self):
+        for name in SHARED_MODULES:
+            self.assertFalse(os.path.islink(os.path.join(LAMBDA_DIR, name)), name)
+
+
+if __name__ == '__main__':
+    unittest.main()